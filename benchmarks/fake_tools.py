@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Fake juju, docker, sudo and cwr commands for the performance suite.
+
+The first argument names the command to fake; the suite installs small
+wrapper scripts called juju, docker, sudo and cwr that run this file.  The
+behaviour is read from the JSON file named by FAKE_TOOLS_CONFIG.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import tarfile
+from tempfile import SpooledTemporaryFile
+from time import sleep
+
+
+DEFAULT_CONFIG = {
+    # Seconds a bootstrap, kill-controller, test run and image pull take.
+    'bootstrap_delay': 0.5,
+    'kill_delay': 0.1,
+    'test_delay': 0.5,
+    'pull_delay': 0,
+    # Machines per model and applications deployed on every machine.
+    'machines': 3,
+    'applications': 5,
+    # Bytes of every remote log file.
+    'log_size': 64 * 1024,
+}
+REMOTE_LOGS = ['cloud-init-output.log', 'juju/machine-0.log', 'syslog']
+JUJU_VERSION = '2.9.42-focal-amd64'
+
+
+def load_config():
+    config = dict(DEFAULT_CONFIG)
+    path = os.environ.get('FAKE_TOOLS_CONFIG')
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    return config
+
+
+def make_status(machines, applications):
+    """Return the juju status of a model that is ready."""
+    status = {'model': {'name': 'fake'}, 'machines': {}, 'applications': {}}
+    for machine in range(machines):
+        status['machines'][str(machine)] = {
+            'juju-status': {'current': 'started'},
+            'dns-name': '10.0.0.{}'.format(machine),
+            'series': 'xenial',
+        }
+    for app in range(applications):
+        name = 'app-{}'.format(app)
+        units = {}
+        for machine in range(machines):
+            units['{}/{}'.format(name, machine)] = {
+                'machine': str(machine),
+                'juju-status': {'current': 'idle'},
+                'workload-status': {'current': 'active', 'message': 'ready'},
+            }
+        status['applications'][name] = {
+            'charm': 'cs:{}-1'.format(name), 'units': units}
+    return status
+
+
+def make_log(size):
+    line = 'Jan  1 00:00:00 machine-0 jujud[1]: fake log line {:08d}\n'
+    lines = []
+    total = 0
+    while total < size:
+        lines.append(line.format(len(lines)))
+        total += len(lines[-1])
+    return ''.join(lines)[:size]
+
+
+def write_log_archive(path, size):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name in REMOTE_LOGS:
+            content = SpooledTemporaryFile()
+            content.write(make_log(size))
+            info = tarfile.TarInfo(os.path.join('var/log', name))
+            info.size = content.tell()
+            content.seek(0)
+            tar.addfile(info, content)
+
+
+def write_report(results_dir, test_id, controllers):
+    """Write a cwr report without benchmarks into results_dir."""
+    report_dir = os.path.join(results_dir, 'fake-bundle', test_id)
+    if not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+    report = {
+        'test_id': test_id,
+        'bundle': {'name': 'fake-bundle'},
+        'results': [{'provider_name': c, 'benchmarks': []}
+                    for c in controllers],
+    }
+    with open(os.path.join(report_dir, 'report.json'), 'w') as f:
+        json.dump(report, f)
+
+
+def juju(config, args):
+    args = [a for a in args if a != '--debug']
+    command = args[0] if args else ''
+    if command == '--version':
+        print(JUJU_VERSION)
+    elif command == 'bootstrap':
+        sleep(config['bootstrap_delay'])
+    elif command == 'kill-controller':
+        sleep(config['kill_delay'])
+    elif command == 'status':
+        print(json.dumps(make_status(
+            config['machines'], config['applications'])))
+    elif command == 'scp':
+        write_log_archive(args[-1], config['log_size'])
+    return 0
+
+
+def docker(config, args):
+    command = args[0] if args else ''
+    if command == 'image':
+        print(json.dumps(['{}@sha256:0'.format(args[-1])]))
+    elif command == 'pull':
+        sleep(config['pull_delay'])
+    elif command == 'run':
+        sleep(config['test_delay'])
+        volumes = [args[i + 1] for i, a in enumerate(args) if a == '-v']
+        for volume in volumes:
+            host_path, container_path = volume.split(':', 1)
+            if container_path.endswith('/results'):
+                write_report(host_path, 'fake', ['fake'])
+    return 0
+
+
+def cwr(config, args):
+    sleep(config['test_delay'])
+    results_dir = args[args.index('--results-dir') + 1]
+    test_id = args[args.index('--test-id') + 1]
+    controllers = args[4:args.index('--test-id') - 1]
+    write_report(results_dir, test_id, controllers)
+    return 0
+
+
+def sudo(config, args):
+    while args and args[0].startswith('-'):
+        args = args[1:]
+    os.execvp(args[0], args)
+
+
+COMMANDS = {
+    'cwr': cwr,
+    'docker': docker,
+    'juju': juju,
+    'sudo': sudo,
+}
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    return COMMANDS[argv[0]](load_config(), argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""Measure full build_cloud runs against fake juju and docker commands.
+
+Every scenario runs build_cloud.main in a child process with 1 to
+--max-controllers controllers, using the commands in fake_tools.py, and
+reports the wall time, the number of subprocesses, the peak RSS of the run
+and the bytes written to the log dir.  With --baseline, the exit code is 1
+if any scenario is slower or heavier than the baseline by more than the
+threshold.
+"""
+
+from __future__ import print_function
+
+from argparse import (
+    ArgumentParser,
+    REMAINDER,
+)
+import json
+import logging
+from multiprocessing import (
+    Process,
+    Queue,
+)
+import os
+import resource
+import sys
+from time import time
+
+from buildcloud import build_cloud
+from buildcloud.report import (
+    get_report,
+    reset_report,
+)
+from buildcloud.utility import temp_dir
+
+
+__metaclass__ = type
+
+FAKE_TOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'fake_tools.py')
+FAKE_COMMANDS = ['cwr', 'docker', 'juju', 'sudo']
+# Controller names are made from these, so that build_cloud finds a cloud
+# for each of them.
+CLOUDS = ['aws', 'gce', 'azure', 'joyent']
+# Metrics compared to the baseline.  Lower is better for all of them.
+METRICS = ['wall_time', 'subprocesses', 'peak_rss_kb', 'bytes_copied']
+DEFAULT_THRESHOLD = 0.2
+TEST_PLAN = 'bundle: cs:fake-bundle\nbundle_name: fake-bundle\n'
+
+
+def get_controllers(count):
+    return ['{}-{}'.format(CLOUDS[i % len(CLOUDS)], i) for i in range(count)]
+
+
+def install_fake_commands(bin_dir):
+    for name in FAKE_COMMANDS:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec {} {} {} "$@"\n'.format(
+                sys.executable, FAKE_TOOLS, name))
+        os.chmod(path, 0o755)
+
+
+def make_workspace(root, config):
+    """Create the fake commands, juju home and test plan under root."""
+    bin_dir = os.path.join(root, 'bin')
+    juju_home = os.path.join(root, 'juju_home')
+    for directory in (bin_dir, juju_home):
+        os.mkdir(directory)
+    install_fake_commands(bin_dir)
+    with open(os.path.join(juju_home, 'staging-juju-rsa'), 'w') as f:
+        f.write('fake key\n')
+    config_file = os.path.join(root, 'fake-tools.json')
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    test_plan = os.path.join(root, 'fake-bundle.yaml')
+    with open(test_plan, 'w') as f:
+        f.write(TEST_PLAN)
+    return {'bin': bin_dir, 'juju_home': juju_home, 'config': config_file,
+            'test_plan': test_plan, 'root': root}
+
+
+def get_dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def run_build_cloud(workspace, controllers, extra_args, log_dir, queue):
+    """Run build_cloud.main and put its metrics on queue."""
+    reset_report()
+    os.environ.update({
+        'PATH': '{}{}{}'.format(
+            workspace['bin'], os.pathsep, os.environ.get('PATH', '')),
+        'HOME': workspace['root'],
+        'JUJU_HOME': workspace['juju_home'],
+        'BUILD_NUMBER': '1',
+        'FAKE_TOOLS_CONFIG': workspace['config'],
+    })
+    argv = controllers + [
+        workspace['test_plan'],
+        '--juju-path', os.path.join(workspace['bin'], 'juju'),
+        '--juju-home', workspace['juju_home'],
+        '--log-dir', log_dir,
+    ] + extra_args
+    error = None
+    started = time()
+    try:
+        build_cloud.main(argv)
+    except BaseException as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    wall_time = time() - started
+    commands = get_report().to_dict()['commands']
+    queue.put({
+        'wall_time': wall_time,
+        'subprocesses': len(commands),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'bytes_copied': get_dir_size(log_dir),
+        'output_bytes': sum(c['output_size'] or 0 for c in commands),
+        'error': error,
+    })
+
+
+def run_scenario(workspace, count, extra_args):
+    """Run build_cloud with count controllers and return its metrics."""
+    log_dir = os.path.join(workspace['root'], 'logs-{}'.format(count))
+    os.mkdir(log_dir)
+    queue = Queue()
+    # A child process keeps the RSS and the module state of every run apart.
+    process = Process(
+        target=run_build_cloud,
+        args=(workspace, get_controllers(count), extra_args, log_dir, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    result['controllers'] = count
+    return result
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run_suite(config, max_controllers, repeat=1, extra_args=()):
+    """Return the median metrics of each scenario, by controller count."""
+    results = []
+    with temp_dir() as root:
+        for count in range(1, max_controllers + 1):
+            runs = []
+            for i in range(repeat):
+                workspace_root = os.path.join(root, '{}-{}'.format(count, i))
+                os.mkdir(workspace_root)
+                workspace = make_workspace(workspace_root, config)
+                runs.append(run_scenario(workspace, count, list(extra_args)))
+            result = dict((metric, median([r[metric] for r in runs]))
+                          for metric in METRICS + ['output_bytes'])
+            result['controllers'] = count
+            result['errors'] = [r['error'] for r in runs if r['error']]
+            results.append(result)
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Return a message for every metric that regressed from baseline."""
+    by_count = dict((b['controllers'], b) for b in baseline)
+    regressions = []
+    for result in results:
+        base = by_count.get(result['controllers'])
+        if base is None:
+            continue
+        for metric in METRICS:
+            if not base.get(metric):
+                continue
+            change = (result[metric] - base[metric]) / float(base[metric])
+            if change > threshold:
+                regressions.append(
+                    '{} controllers: {} {:.4g} -> {:.4g} ({:+.1%})'.format(
+                        result['controllers'], metric, base[metric],
+                        result[metric], change))
+    return regressions
+
+
+def format_result(result):
+    return ('{controllers:>3} controllers: {wall_time:7.2f}s '
+            '{subprocesses:4d} subprocesses {peak_rss_kb:7d} KB RSS '
+            '{bytes_copied:10d} bytes copied'.format(**result))
+
+
+def parse_args(argv=None):
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--max-controllers', type=int, default=4,
+                        help='Run scenarios with 1 to this many controllers.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs per scenario; the median is reported.')
+    parser.add_argument('--machines', type=int, default=3,
+                        help='Machines in every model.')
+    parser.add_argument('--applications', type=int, default=5,
+                        help='Applications in the juju status of a model.')
+    parser.add_argument('--log-size', type=int, default=64,
+                        help='KB of every remote log file.')
+    parser.add_argument('--bootstrap-delay', type=float, default=0.5,
+                        help='Seconds a fake bootstrap takes.')
+    parser.add_argument('--test-delay', type=float, default=0.5,
+                        help='Seconds a fake cwr run takes.')
+    parser.add_argument('--output', help='Write the results as JSON here.')
+    parser.add_argument('--baseline',
+                        help='JSON results of an earlier run to compare to.')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Relative increase flagged as a regression.')
+    parser.add_argument('build_cloud_args', nargs=REMAINDER,
+                        help='Extra build_cloud arguments, after --.')
+    args = parser.parse_args(argv)
+    if args.build_cloud_args[:1] == ['--']:
+        args.build_cloud_args = args.build_cloud_args[1:]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+    config = {
+        'machines': args.machines,
+        'applications': args.applications,
+        'log_size': args.log_size * 1024,
+        'bootstrap_delay': args.bootstrap_delay,
+        'test_delay': args.test_delay,
+    }
+    results = run_suite(config, args.max_controllers, args.repeat,
+                        args.build_cloud_args)
+    failed = False
+    for result in results:
+        print(format_result(result))
+        for error in result['errors']:
+            print('  failed: {}'.format(error))
+            failed = True
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression))
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
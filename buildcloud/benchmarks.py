@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""Keep the benchmark results of cwr runs and compare runs to a baseline."""
+
+from __future__ import print_function
+
+from argparse import ArgumentParser
+from collections import namedtuple
+import csv
+import fcntl
+import json
+import logging
+import os
+import sys
+from time import time
+
+
+__metaclass__ = type
+
+# Number of earlier runs averaged into the baseline.
+DEFAULT_WINDOW = 10
+# Relative change from the baseline that counts as a regression.
+DEFAULT_THRESHOLD = 0.1
+
+BenchmarkResult = namedtuple(
+    'BenchmarkResult',
+    ['date', 'test_id', 'cloud', 'bundle', 'benchmark', 'value', 'units',
+     'direction', 'duration'])
+
+Comparison = namedtuple(
+    'Comparison',
+    ['result', 'baseline', 'change', 'regression'])
+
+
+def get_value(benchmark, test_id, cloud):
+    """Return the value of benchmark for the run test_id on cloud.
+
+    cwr either sets the value on the benchmark or lists the values of past
+    runs under data (or results), one entry per test id and cloud.
+    """
+    if benchmark.get('value') is not None:
+        return benchmark['value']
+    for entry in benchmark.get('data') or benchmark.get('results') or []:
+        if entry.get('test_id') != test_id:
+            continue
+        if entry.get('provider_name', cloud) != cloud:
+            continue
+        return entry.get('value')
+    return None
+
+
+def parse_report(report):
+    """Return the BenchmarkResults found in a cwr report."""
+    test_id = report.get('test_id')
+    bundle = report.get('bundle')
+    if isinstance(bundle, dict):
+        bundle = bundle.get('name')
+    date = report.get('date')
+    results = []
+    for result in report.get('results') or []:
+        cloud = result.get('provider_name')
+        for benchmark in result.get('benchmarks') or []:
+            value = get_value(benchmark, test_id, cloud)
+            if value is None:
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                logging.warning('Ignoring benchmark {} value {!r}'.format(
+                    benchmark.get('name'), value))
+                continue
+            results.append(BenchmarkResult(
+                date=date, test_id=test_id, cloud=cloud, bundle=bundle,
+                benchmark=benchmark.get('name'), value=value,
+                units=benchmark.get('units'),
+                direction=benchmark.get('direction'),
+                duration=result.get('duration')))
+    return results
+
+
+def collect_results(results_dir):
+    """Return the BenchmarkResults of the cwr reports in results_dir."""
+    results = []
+    for root, dirs, files in os.walk(results_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(root, name)) as f:
+                    report = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if isinstance(report, dict):
+                results.extend(parse_report(report))
+    return results
+
+
+def _from_row(row):
+    row = dict((k, v or None) for k, v in row.items())
+    row['value'] = float(row['value'])
+    if row['duration'] is not None:
+        row['duration'] = float(row['duration'])
+    return BenchmarkResult(**row)
+
+
+class BenchmarkStore:
+    """A CSV file with one row per run, cloud, bundle and benchmark."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return [_from_row(row) for row in csv.DictReader(f)]
+        except IOError:
+            return []
+
+    def add(self, results):
+        """Append results that are not stored yet.  Return those added."""
+        with open('{}.lock'.format(self.path), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                stored = set(_key(r) + (r.test_id,) for r in self.load())
+                new = [r for r in results
+                       if _key(r) + (r.test_id,) not in stored]
+                if not new:
+                    return []
+                write_header = not os.path.exists(self.path)
+                with open(self.path, 'a') as f:
+                    writer = csv.writer(f)
+                    if write_header:
+                        writer.writerow(BenchmarkResult._fields)
+                    now = time()
+                    for result in new:
+                        if result.date is None:
+                            result = result._replace(date=now)
+                        writer.writerow(result)
+                return new
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _key(result):
+    return (result.cloud, result.bundle, result.benchmark)
+
+
+def is_regression(change, direction, threshold):
+    if direction == 'desc':
+        # Lower is better.
+        return change > threshold
+    return change < -threshold
+
+
+def compare(results, test_id, window=DEFAULT_WINDOW,
+            threshold=DEFAULT_THRESHOLD):
+    """Compare the results of test_id to the mean of the runs before it."""
+    history = {}
+    comparisons = []
+    for result in results:
+        key = _key(result)
+        if result.test_id == test_id:
+            earlier = history.get(key, [])[-window:]
+            baseline = change = None
+            regression = False
+            if earlier:
+                baseline = sum(earlier) / float(len(earlier))
+                if baseline:
+                    change = (result.value - baseline) / baseline
+                    regression = is_regression(
+                        change, result.direction, threshold)
+            comparisons.append(
+                Comparison(result, baseline, change, regression))
+        else:
+            history.setdefault(key, []).append(result.value)
+    return comparisons
+
+
+def ingest(store_path, results_dir):
+    added = BenchmarkStore(store_path).add(collect_results(results_dir))
+    logging.info('Stored {} benchmark results in {}'.format(
+        len(added), store_path))
+    return added
+
+
+def format_comparison(comparison):
+    result = comparison.result
+    if comparison.baseline is None:
+        baseline = 'no baseline'
+    else:
+        baseline = 'baseline {:.4g} ({:+.1%})'.format(
+            comparison.baseline, comparison.change or 0)
+    return '{} {} {} {}: {:.4g} {} {}{}'.format(
+        result.cloud, result.bundle, result.benchmark, result.test_id,
+        result.value, result.units or '', baseline,
+        ' REGRESSION' if comparison.regression else '')
+
+
+def parse_args(argv=None):
+    parser = ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    ingest_parser = subparsers.add_parser(
+        'ingest', help='Store the benchmark results of a results dir.')
+    ingest_parser.add_argument('store', help='Benchmark CSV file.')
+    ingest_parser.add_argument('results_dir', help='cwr results directory.')
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare a run to the runs before it.')
+    compare_parser.add_argument('store', help='Benchmark CSV file.')
+    compare_parser.add_argument('test_id', help='Test ID of the run.')
+    compare_parser.add_argument(
+        '--window', type=int, default=DEFAULT_WINDOW,
+        help='Number of earlier runs in the baseline.')
+    compare_parser.add_argument(
+        '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='Relative change from the baseline flagged as a regression.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'ingest':
+        ingest(args.store, args.results_dir)
+        return 0
+    comparisons = compare(BenchmarkStore(args.store).load(), args.test_id,
+                          window=args.window, threshold=args.threshold)
+    if not comparisons:
+        print('No benchmark results for {}.'.format(args.test_id))
+        return 1
+    for comparison in comparisons:
+        print(format_comparison(comparison))
+    return 1 if any(c.regression for c in comparisons) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,28 +3,93 @@
 from argparse import ArgumentParser
 from contextlib import contextmanager
 from collections import namedtuple
+from copy import copy
+import errno
 from functools import partial
 import logging
 import os
+from pipes import quote
 import shutil
 import signal
 from tempfile import mkdtemp
+import subprocess
+from threading import (
+    Event,
+    Lock,
+    Thread,
+)
 from uuid import uuid4
+import yaml
 
+from buildcloud.benchmarks import ingest
+from buildcloud.commands import (
+    docker_command,
+    docker_run_args,
+    option_args,
+)
+from buildcloud.failures import BACKOFF
 from buildcloud.host import Host
-from buildcloud.juju import make_client
+from buildcloud.image_cache import ImageCache
+from buildcloud.journal import (
+    get_data_file,
+    Journal,
+    JOURNAL_DATA_FILE,
+    JOURNAL_FILE,
+    TEST_FINISHED,
+    TEST_STARTED,
+)
+from buildcloud.juju import (
+    BOOTSTRAP_RETRIES,
+    LogOptions,
+    make_client,
+)
+from buildcloud.plan_index import (
+    get_default_index_file,
+    get_plan_name,
+    PlanIndex,
+)
+from buildcloud.pool import ControllerPool
+from buildcloud.regions import (
+    get_default_stats_file,
+    RegionStats,
+)
+from buildcloud.report import (
+    get_report,
+    phase,
+)
+from buildcloud.routes import (
+    get_routing_table,
+    load_routing_table,
+)
 from buildcloud.utility import (
     configure_logging,
     copytree_force,
     ensure_dir,
     get_juju_home,
     generate_controller_names,
+    link_tree,
+    load_patterns,
+    merge_tree,
     run_command,
+    run_concurrently,
     temp_dir,
 )
 
+
+__metaclass__ = type
+
 # Assigned a name to the container
 CONTAINER_NAME = 'cwr-{}'.format(uuid4().hex)
+# Names of the containers that are running a test.
+running_containers = set()
+# The controller pool registry, relative to the juju home.
+POOL_FILE = 'cwr-pool.yaml'
+# Juju home files that juju may write to during a run.  They are copied into
+# the temporary juju home; everything else is hard linked.
+JUJU_HOME_MUTABLE = ['*.yaml', 'cookies', 'ssh', 'store-usso-token']
+# Default seconds an interrupted run spends collecting logs before it kills
+# the controllers.
+INTERRUPT_LOG_TIMEOUT = 120
 
 
 def parse_args(argv=None):
@@ -32,7 +97,27 @@ def parse_args(argv=None):
     parser.add_argument(
         'controllers', nargs='+', help='Name of controllers to use')
     parser.add_argument(
-        'test_plan', help='File path to test plan.')
+        'test_plan',
+        help='File path to test plan, or a directory of test plans to run '
+             'one after the other against the same controllers.')
+    parser.add_argument(
+        '--test-plans', nargs='+',
+        help='Names of the test plans to run from the test plan directory.')
+    parser.add_argument(
+        '--plan-index', default=get_default_index_file(),
+        help='File that caches the parsed test plans.')
+    parser.add_argument(
+        '--plan-concurrency', type=int, default=1,
+        help='Number of test plans from the test plan directory to run at '
+             'the same time, each in its own model on every controller.')
+    parser.add_argument(
+        '--model-limits',
+        help='YAML file mapping cloud names to the maximum number of plan '
+             'models in use on that cloud at the same time.')
+    parser.add_argument(
+        '--routes',
+        help='YAML file routing controller names to clouds, default '
+             'constraints and model limits.')
     parser.add_argument(
         '--controllers_bootstrapped', action='store_true',
         help="If set, it won't bootstrap the controllers")
@@ -46,18 +131,91 @@ def parse_args(argv=None):
         '--verbose', action='count', default=0)
     parser.add_argument(
         '--juju-home', help='Juju home directory.', default=get_juju_home())
+    parser.add_argument('--juju-home-include',
+                        help='File listing the only juju home paths to copy, '
+                             'one pattern per line.')
+    parser.add_argument('--juju-home-exclude',
+                        help='File listing juju home paths not to copy, one '
+                             'pattern per line.')
     parser.add_argument('--log-dir', help='The directory to dump logs to.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume the run journaled in the log dir: reuse '
+                             'the controllers that are still alive, skip the '
+                             'tests that passed and clean up what is left.')
     parser.add_argument('--test-id', help='Test ID.',
                         default=os.environ['BUILD_NUMBER'])
+    parser.add_argument('--benchmark-store',
+                        help='CSV file to add the benchmark results of the '
+                             'run to.')
     parser.add_argument('--no-container', action='store_true',
                         help='Run cwr test without container.')
     parser.add_argument('--bootstrap-constraints',
                         help='Bootstrap machine constraints')
     parser.add_argument('--constraints',
                         help='Model constraints', default='mem=3G')
+    parser.add_argument('--bootstrap-concurrency', type=int, default=1,
+                        help='Number of controllers to bootstrap at the same '
+                             'time. Use 0 to bootstrap all of them at once.')
+    parser.add_argument('--bootstrap-retries', type=int,
+                        default=BOOTSTRAP_RETRIES,
+                        help='Number of times to retry a bootstrap that was '
+                             'throttled or failed on the network.')
+    parser.add_argument('--bootstrap-backoff', type=float, default=BACKOFF,
+                        help='Seconds before the first bootstrap retry. It '
+                             'doubles with every retry and is jittered.')
+    parser.add_argument('--region-stats', default=get_default_stats_file(),
+                        help='File that keeps the bootstrap times and '
+                             'capacity failures of every cloud region, used '
+                             'to pick the region to bootstrap in.')
+    parser.add_argument('--destroy-concurrency', type=int, default=1,
+                        help='Number of controllers to kill at the same '
+                             'time. Use 0 to kill all of them at once.')
+    parser.add_argument('--kill-timeout', type=int,
+                        help='Seconds to wait for kill-controller before '
+                             'giving up on a controller.')
+    parser.add_argument('--interrupt-log-timeout', type=float,
+                        default=INTERRUPT_LOG_TIMEOUT,
+                        help='Seconds to collect logs after SIGTERM or '
+                             'SIGINT before killing the controllers.  A '
+                             'second signal kills them at once.')
+    parser.add_argument('--wait-timeout', type=int,
+                        help='Seconds to wait for the bootstrapped models to '
+                             'be ready before testing them.  Models that are '
+                             'not ready in time are not tested.')
+    parser.add_argument('--log-concurrency', type=int, default=8,
+                        help='Number of machines to gather logs from at the '
+                             'same time.')
+    parser.add_argument('--compress-logs', action='store_true',
+                        help='Store the remote logs gzipped in the log dir.')
+    parser.add_argument('--log-file-cap', type=int,
+                        help='Maximum MB kept of each remote log file.  The '
+                             'end of the file is kept.')
+    parser.add_argument('--log-run-cap', type=int,
+                        help='Maximum MB of remote logs kept for the run.')
+    parser.add_argument('--logs-since-bootstrap', action='store_true',
+                        help='Only copy remote logs modified since the '
+                             'bootstrap started.')
+    parser.add_argument('--controller-pool', action='store_true',
+                        help='Lease idle controllers from a pool kept under '
+                             'the juju home and return them to it instead '
+                             'of killing them.')
+    parser.add_argument('--pool-ttl', type=float, default=4,
+                        help='Hours an idle pooled controller is kept.')
+    parser.add_argument('--pool-size', type=int, default=2,
+                        help='Maximum number of idle controllers per cloud.')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Start a separate cwr run on each controller as '
+                             'soon as it is bootstrapped.')
     parser.add_argument('--cwr-path',
                         help='Path to cwr. If path is provided, it will '
                              'execute it with python')
+    parser.add_argument('--image-max-age', type=float, default=24,
+                        help='Hours after which the cwrbox image is pulled '
+                             'again.')
+    parser.add_argument('--image-digest',
+                        help='Pin the cwrbox image to this digest.')
+    parser.add_argument('--image-cache',
+                        help='File that records when images were pulled.')
     # TODO: this should be updated to support a config per controller instead
     # of a single config for all controllers.
     parser.add_argument('--config', default='test-mode=true',
@@ -76,6 +234,8 @@ def parse_args(argv=None):
                              'but the result reports themselves will be '
                              'preserved.')
     args = parser.parse_args(argv)
+    if args.resume and not args.log_dir:
+        parser.error('--resume requires --log-dir')
     if args.juju_path != 'juju':
         args.juju_path = os.path.realpath(args.juju_path)
     return args
@@ -107,8 +267,15 @@ def temp_juju_home(juju_home, juju_path):
 def env(args):
     with temp_dir() as root:
         tmp_juju_home = os.path.join(root, 'tmp_juju_home')
-        shutil.copytree(args.juju_home, tmp_juju_home,
-                        ignore=shutil.ignore_patterns('environments'))
+        exclude = ['environments', '{}*'.format(POOL_FILE),
+                   '{}*'.format(JOURNAL_DATA_FILE.format('*'))]
+        if args.juju_home_exclude:
+            exclude.extend(load_patterns(args.juju_home_exclude))
+        include = None
+        if args.juju_home_include:
+            include = load_patterns(args.juju_home_include)
+        link_tree(args.juju_home, tmp_juju_home, mutable=JUJU_HOME_MUTABLE,
+                  exclude=exclude, include=include)
 
         juju_repository = ensure_dir('juju_repository', parent=root)
         test_results = ensure_dir('results', parent=root)
@@ -152,7 +319,6 @@ def env(args):
 
 
 def get_cwr_options(args, host, container=None):
-    options = []
     if not args.bucket and not args.results_dir:
         args.results_dir = host.test_results
     s3_creds = args.s3_creds
@@ -161,155 +327,532 @@ def get_cwr_options(args, host, container=None):
             raise ValueError('Container is not set.')
         s3_creds = os.path.join(
             container.home, os.path.basename(args.s3_creds))
-    arg_list = [
-        [args.bundle_file, '--bundle'],
-        [args.results_dir, '--results-dir'],
-        [args.bucket, '--bucket'],
-        [s3_creds, '--s3-creds'],
-        [True, '--s3-private'],
-        [args.results_per_bundle, '--results-per-bundle'],
-    ]
-    for arg, opt in arg_list:
-        if arg:
-            options.append(opt)
-            if not isinstance(arg, bool):
-                options.append(arg)
-    options = ' '.join(options) if options else ''
-    return options
+    return option_args([
+        (args.bundle_file, '--bundle'),
+        (args.results_dir, '--results-dir'),
+        (args.bucket, '--bucket'),
+        (s3_creds, '--s3-creds'),
+        (True, '--s3-private'),
+        (args.results_per_bundle, '--results-per-bundle'),
+    ])
 
 
 def get_cwr_path(args):
-    cwr_path = 'cwr'
     if args.cwr_path:
-        cwr_path = 'python {}'.format(args.cwr_path)
-    return cwr_path
+        return ['python', args.cwr_path]
+    return ['cwr']
+
+
+def get_cwr_args(bootstrapped_controllers, test_plan, test_id, options):
+    return (['-F', '-l', 'DEBUG', '-v'] + list(bootstrapped_controllers) +
+            [test_plan, '--test-id', test_id] + options)
 
 
 def run_test_without_container(host, args, bootstrapped_controllers):
     logging.debug('Running test without a container.')
     cwr_options = get_cwr_options(args, host)
-    cwr_path = get_cwr_path(args)
-    cmd = ('{} -F -l DEBUG -v {} {} --test-id {} {}'.
-           format(cwr_path, ' '.join(bootstrapped_controllers), args.test_plan,
-                  args.test_id, cwr_options))
-    run_command(cmd)
+    cmd = get_cwr_path(args) + get_cwr_args(
+        bootstrapped_controllers, args.test_plan, args.test_id, cwr_options)
+    with phase('run-test', controllers=list(bootstrapped_controllers),
+               test_plan=args.test_plan):
+        run_command(cmd, keep_output=False)
+
 
+def make_image_cache(args, container):
+    return ImageCache(container.name, cache_file=args.image_cache,
+                      max_age=args.image_max_age * 60 * 60,
+                      digest=args.image_digest)
 
-def run_test_with_container(host, container, args, bootstrapped_controllers):
+
+def run_test_with_container(host, container, args, bootstrapped_controllers,
+                            image=None, container_name=CONTAINER_NAME,
+                            copy_logs=True):
     logging.debug("Host data: ", host)
     logging.debug("Container data: ", container)
-    run_command('sudo docker pull {}'.format(container.name))
-    s3_creds = ''
+    if image is None:
+        image = make_image_cache(args, container)
+    with phase('image-wait'):
+        image_name = image.wait()
+    volumes = [
+        (host.test_results, container.test_results),
+        (host.tmp_juju_home, container.juju_home),
+        (os.path.join(host.tmp, '.deployer-store-cache'),
+         os.path.join(container.juju_home, '.deployer-store-cache')),
+        (host.juju_repository, container.juju_repository),
+        (host.tmp, host.tmp),
+        (os.path.dirname(args.test_plan), container.test_plans),
+    ]
     if args.s3_creds:
-        s3_creds = '-v {}:{} '.format(
+        volumes.append((
             args.s3_creds,
-            os.path.join(container.home, os.path.basename(args.s3_creds)))
-    container_options = (
-        '--rm '
-        '--entrypoint bash '  # override jujubox entrypoint
-        '--name {} '          # Assign a name to the container
-        '-u {} '
-        '-e HOME={} '
-        '-e JUJU_HOME={} '
-        '-e JUJU_DATA={} '
-        '-e PYTHONPATH={} '
-        '-w {} '
-        '-v {}:{} '   # Test result location
-        '-v {}:{} '   # Temp Juju home
-        '-v {}/.deployer-store-cache:{}/.deployer-store-cache '
-        '-v {}:{} '   # Repository location
-        '-v {}:{} '   # Temp location.
-        '-v {}:{} '   # Test plan
-        '{}'          # S3 creds
-        '-v {}:{} '   # ssh path
-        '-t {} '.format(CONTAINER_NAME,
-                        container.user,
-                        container.home,
-                        container.juju_home,
-                        container.juju_home,
-                        os.path.join(container.home, 'cloud-weather-report'),
-                        container.home,
-                        host.test_results, container.test_results,
-                        host.tmp_juju_home, container.juju_home,
-                        host.tmp, container.juju_home,
-                        host.juju_repository, container.juju_repository,
-                        host.tmp, host.tmp,
-                        os.path.dirname(args.test_plan), container.test_plans,
-                        s3_creds,
-                        host.ssh_path, container.ssh_home,
-                        container.name))
+            os.path.join(container.home, os.path.basename(args.s3_creds))))
+    volumes.append((host.ssh_path, container.ssh_home))
+    container_options = docker_run_args(
+        container_name, image_name, user=container.user,
+        # Override the jujubox entrypoint.
+        entrypoint='bash',
+        env=[('HOME', container.home),
+             ('JUJU_HOME', container.juju_home),
+             ('JUJU_DATA', container.juju_home),
+             ('PYTHONPATH',
+              os.path.join(container.home, 'cloud-weather-report'))],
+        workdir=container.home, volumes=volumes)
     test_plan = os.path.join(
         container.test_plans, os.path.basename(args.test_plan))
     cwr_options = get_cwr_options(args, host, container=container)
     cwr_path = os.path.join(
         container.home, 'cloud-weather-report/cloudweatherreport/run.py')
+    cwr_args = get_cwr_args(
+        bootstrapped_controllers, test_plan, args.test_id, cwr_options)
     shell_options = (
         'sudo juju --version && sudo -HE env PATH=$PATH PYTHONPATH=$PYTHONPATH'
-        ' python2 {} -F -l DEBUG -v {} {} --test-id {} {}'.format(
-            cwr_path, ' '.join(bootstrapped_controllers), test_plan,
-            args.test_id, cwr_options))
+        ' python2 {} {}'.format(
+            cwr_path, ' '.join(quote(arg) for arg in cwr_args)))
     # The '-c [shell_options]' will get passed to to our entrypoint (bash)
-    command = ("sudo docker run {} -c ".format(
-        container_options).split() + [shell_options])
-    run_command(command)
+    command = docker_command(
+        'run', container_options + ['-c', shell_options])
+    running_containers.add(container_name)
+    try:
+        with phase('run-test', controllers=list(bootstrapped_controllers),
+                   test_plan=args.test_plan):
+            run_command(command, keep_output=False)
+    finally:
+        running_containers.discard(container_name)
+
+    if copy_logs:
+        copy_results(host, args)
+
+
+def is_batch(args):
+    return os.path.isdir(args.test_plan)
+
+
+def get_test_plans(args):
+    """Return the paths of the test plans to run.
+
+    The plans of a test plan directory are validated before any of them
+    runs.
+    """
+    if not is_batch(args):
+        return [args.test_plan]
+    index = PlanIndex(args.test_plan, args.plan_index)
+    return [plan.path for plan in index.load(args.test_plans)]
+
+
+def make_plan_run(host, args, test_plan):
+    """Return the host and args to run test_plan with.
+
+    In batch mode every plan gets its own results directory and test id.
+    """
+    if not is_batch(args):
+        return host, args
+    name = get_plan_name(test_plan)
+    plan_host = copy(host)
+    plan_host.test_results = ensure_dir(name, parent=host.test_results)
+    plan_args = copy(args)
+    plan_args.test_plan = test_plan
+    plan_args.test_id = '{}-{}'.format(args.test_id, name)
+    if args.results_dir:
+        plan_args.results_dir = os.path.join(args.results_dir, name)
+    return plan_host, plan_args
+
+
+def run_plans(host, args, bootstrapped_controllers, container, image=None,
+              container_name=CONTAINER_NAME, client=None):
+    """Run cwr for each test plan.
+
+    With a plan concurrency above 1, up to that many plans run at the same
+    time, each in a new model on every controller.  Otherwise the plans run
+    one after the other in the bootstrapped models.  A failed plan does not
+    stop the others; the first failure is raised once all of them have run.
+    Logs are not copied to the log dir.
+    """
+    concurrency = 1
+    if client is not None and is_batch(args):
+        concurrency = args.plan_concurrency
+
+    def run_plan(test_plan):
+        plan_host, plan_args = make_plan_run(host, args, test_plan)
+        if concurrency == 1:
+            run_cwr(plan_host, plan_args, bootstrapped_controllers, container,
+                    image, container_name)
+            return
+        controllers = [m.split(':')[0] for m in bootstrapped_controllers]
+        with client.temp_models(controllers) as models:
+            run_cwr(plan_host, plan_args, models, container, image,
+                    '{}-{}'.format(container_name, get_plan_name(test_plan)))
+
+    def run_journaled_plan(test_plan):
+        run_journaled(client, test_plan, bootstrapped_controllers,
+                      partial(run_plan, test_plan))
+
+    results = run_concurrently(
+        run_journaled_plan, get_test_plans(args), concurrency)
+    error = None
+    for test_plan, _, e in results:
+        if e is not None:
+            logging.error('Test plan {} failed: {}'.format(test_plan, e))
+            if error is None:
+                error = e
+    if error is not None:
+        raise error
+
+
+def run_cwr(host, args, models, container, image, container_name):
+    if args.no_container:
+        run_test_without_container(host, args, models)
+    else:
+        run_test_with_container(
+            host, container, args, models, image=image,
+            container_name=container_name, copy_logs=False)
 
-    # Copy logs
-    if args.log_dir:
-        copytree_force(host.test_results, args.log_dir,
-                       ignore=shutil.ignore_patterns('static'))
 
+def get_journal(client):
+    return None if client is None else client.journal
 
-def run_test(host, args, bootstrapped_controllers, container, client):
-    set_signal(client, no_container=args.no_container)
-    if args.no_container is True:
-        run_test_without_container(
-            host, args, bootstrapped_controllers)
-    else:
-        run_test_with_container(
-            host, container, args, bootstrapped_controllers)
 
+def run_journaled(client, test_plan, models, run):
+    """Call run to test test_plan on models, recording it in the journal.
+
+    The test is skipped if the journal shows that it already passed on the
+    controllers of models.
+    """
+    journal = get_journal(client)
+    if journal is None:
+        return run()
+    controllers = sorted(m.split(':')[0] for m in models)
+    if journal.test_finished(test_plan, controllers):
+        logging.info('Skipping {}, it passed on {}.'.format(
+            test_plan, ', '.join(controllers)))
+        return
+    journal.record(TEST_STARTED, test_plan=test_plan, controllers=controllers)
+    run()
+    journal.record(TEST_FINISHED, test_plan=test_plan,
+                   controllers=controllers)
 
-def handle_signal(client, no_container, signal, frame):
-    logging.info("Signal detected.")
-    if no_container:
-        logging.info('Cleaning up controllers')
-        client.cleanup()
-    else:
-        logging.info("Cleaning up the container: {}".format(CONTAINER_NAME))
-        run_command('sudo docker stop {}'.format(CONTAINER_NAME))
-        run_command('sudo docker rm {}'.format(CONTAINER_NAME))
 
+def tests_finished(journal, args, controllers):
+    """Return True if the journal shows that every test plan passed.
 
-def set_signal(client, no_container):
-    logging.info("Setting signal for controllers: {} container{}".format(
-        client, no_container))
-    signal.signal(
-        signal.SIGTERM, partial(handle_signal, client, no_container))
-    signal.signal(
-        signal.SIGINT, partial(handle_signal, client, no_container))
+    Every plan must have passed on each of controllers, in a single cwr run
+    or, with --pipeline, in one run per controller.
+    """
+    return all(set(controllers) <= journal.get_tested_controllers(test_plan)
+               for test_plan in get_test_plans(args))
 
 
-def main():
-    args = parse_args()
+def copy_results(host, args):
+    """Sync the test results into the log dir, keeping the journal."""
+    if not args.no_container and args.log_dir:
+        copytree_force(host.test_results, args.log_dir,
+                       ignore=shutil.ignore_patterns('static'),
+                       keep=shutil.ignore_patterns(JOURNAL_FILE))
+
+
+def run_test(host, args, bootstrapped_controllers, container, client,
+             image=None):
+    set_signal(client, no_container=args.no_container,
+               log_timeout=args.interrupt_log_timeout)
+    if is_batch(args):
+        try:
+            run_plans(host, args, bootstrapped_controllers, container,
+                      image=image, client=client)
+        finally:
+            copy_results(host, args)
+    elif args.no_container is True:
+        run_journaled(client, args.test_plan, bootstrapped_controllers,
+                      partial(run_test_without_container,
+                              host, args, bootstrapped_controllers))
+    else:
+        run_journaled(client, args.test_plan, bootstrapped_controllers,
+                      partial(run_test_with_container,
+                              host, container, args, bootstrapped_controllers,
+                              image=image))
+
+
+def wait_for_models(client, args, models):
+    """Return the models that are ready to be tested."""
+    if client is None or not args.wait_timeout:
+        return models
+    with phase('wait-for-ready', models=list(models)):
+        not_ready = client.wait_for(models, timeout=args.wait_timeout)
+    return [m for m in models if m not in not_ready]
+
+
+def run_test_pipelined(host, args, container, client, image=None):
+    """Bootstrap the controllers and test each one as soon as it is ready.
+
+    Every controller gets its own cwr run, so a slow or failed bootstrap
+    does not hold back the others.  The results of all runs are merged into
+    host.test_results and copied to the log dir before the cleanup collects
+    the remote logs there.
+    """
+    set_signal(client, no_container=args.no_container,
+               log_timeout=args.interrupt_log_timeout)
+    lock = Lock()
+    threads = []
+    runs = []
+
+    def start_test(controller):
+        model = client.get_model(controller)
+        run = {'model': model, 'error': None}
+        thread = Thread(target=run_controller_test,
+                        args=(host, args, container, model, image, run,
+                              client))
+        thread.daemon = True
+        with lock:
+            runs.append(run)
+            threads.append(thread)
+        thread.start()
+
+    logging.info('Bootstrapping: {}'.format(args.controllers))
+    with client.bootstrap(on_bootstrapped=start_test) as bootstrapped:
+        logging.info('Bootstrapped: {}'.format(bootstrapped))
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        for run in runs:
+            merge_tree(run['test_results'], host.test_results)
+        copy_results(host, args)
+    for run in runs:
+        if run['error'] is not None:
+            raise run['error']
+
+
+def run_controller_test(host, args, container, model, image, run,
+                        client=None):
+    """Run cwr against a single model with its own results directory."""
+    name = model.replace(':', '-')
+    run['test_results'] = ensure_dir(
+        'results-{}'.format(name), parent=host.root)
+    host = copy(host)
+    host.test_results = run['test_results']
+    args = copy(args)
+    try:
+        if wait_for_models(client, args, [model]) != [model]:
+            return
+        run_plans(host, args, [model], container, image=image,
+                  container_name='{}-{}'.format(CONTAINER_NAME, name),
+                  client=client)
+    except Exception as e:
+        logging.error('Test failed on {}: {}'.format(model, e))
+        run['error'] = e
+
+
+def remove_container(name):
+    logging.info("Cleaning up the container: {}".format(name))
+    try:
+        run_command(docker_command('rm', ['-f', name]))
+    except subprocess.CalledProcessError:
+        logging.warn('Could not remove the container {}.'.format(name))
+
+
+class CleanupCoordinator:
+    """Tear the run down in a thread when a signal interrupts it.
+
+    The signal handler only sets an event, so it returns at once.  The
+    coordinator thread then removes the test containers and tears down the
+    controllers: logs are collected for at most log_timeout seconds, then
+    all the controllers are killed at the same time.  A second signal stops
+    waiting for the logs.  A cleanup already running is held to the same
+    limits.
+    """
+
+    def __init__(self, client, no_container,
+                 log_timeout=INTERRUPT_LOG_TIMEOUT):
+        self.client = client
+        self.no_container = no_container
+        self.log_timeout = log_timeout
+        self.interrupted = Event()
+        self.forced = Event()
+        self.done = Event()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def handle_signal(self, signal, frame):
+        if self.interrupted.is_set():
+            self.forced.set()
+        self.interrupted.set()
+
+    def _run(self):
+        self.interrupted.wait()
+        logging.info("Signal detected.")
+        try:
+            # Stop new bootstraps and tests before removing the containers.
+            self.client.interrupt(self.log_timeout, abort=self.forced)
+            if not self.no_container:
+                run_concurrently(
+                    remove_container,
+                    sorted(running_containers) or [CONTAINER_NAME], 0)
+            self.client.teardown(self.log_timeout, abort=self.forced)
+        except Exception:
+            logging.exception('Cleaning up after the signal failed.')
+        finally:
+            self.done.set()
+
+
+_coordinator = None
+
+
+def set_signal(client, no_container, log_timeout=INTERRUPT_LOG_TIMEOUT):
+    """Clean up client when SIGTERM or SIGINT is received."""
+    global _coordinator
+    if _coordinator is None or _coordinator.client is not client:
+        logging.info("Setting signal for controllers: {} container{}".format(
+            client, no_container))
+        _coordinator = CleanupCoordinator(client, no_container, log_timeout)
+        _coordinator.start()
+    signal.signal(signal.SIGTERM, _coordinator.handle_signal)
+    signal.signal(signal.SIGINT, _coordinator.handle_signal)
+    return _coordinator
+
+
+def make_pool(args):
+    if not args.controller_pool:
+        return None
+    return ControllerPool(os.path.join(args.juju_home, POOL_FILE),
+                          ttl=args.pool_ttl * 60 * 60,
+                          max_size=args.pool_size)
+
+
+def make_log_options(args):
+    def to_bytes(mb):
+        return None if mb is None else mb * 1024 * 1024
+    return LogOptions(compress=args.compress_logs,
+                      file_cap=to_bytes(args.log_file_cap),
+                      run_cap=to_bytes(args.log_run_cap),
+                      since_bootstrap=args.logs_since_bootstrap)
+
+
+def load_model_limits(args):
+    """Return the model limits of the routes, updated by --model-limits."""
+    limits = get_routing_table().get_max_concurrency()
+    if args.model_limits:
+        with open(args.model_limits) as f:
+            limits.update(yaml.safe_load(f) or {})
+    return limits or None
+
+
+def make_journal(args):
+    """Return the journal of the run, or None without a log dir.
+
+    Unless the run is resumed, the journal of an earlier run is replaced,
+    except for the controllers it left alive.
+    """
+    if not args.log_dir:
+        return None
+    # The journal is written as soon as a controller is bootstrapped, long
+    # before the results are copied into the log dir.
+    try:
+        os.makedirs(args.log_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    path = os.path.join(args.log_dir, JOURNAL_FILE)
+    journal = Journal(path, get_data_file(args.juju_home, path))
+    if not args.resume:
+        journal.reset()
+    return journal
+
+
+def store_benchmarks(args, host):
+    """Add the benchmark results of the run to the benchmark store."""
+    if not args.benchmark_store:
+        return
+    try:
+        ingest(args.benchmark_store, host.test_results)
+    except (IOError, OSError) as e:
+        logging.error('Could not store benchmark results: {}'.format(e))
+
+
+def write_report(args):
+    """Write the timing report of this run into the log dir.
+
+    It is written after a failed run too, so a write error is only logged
+    to let the failure of the run surface.
+    """
+    if not args.log_dir:
+        return
+    report = get_report()
+    report.info.update(controllers=args.controllers,
+                       test_plan=args.test_plan, test_id=args.test_id)
+    try:
+        try:
+            os.makedirs(args.log_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        path = report.write(args.log_dir)
+    except (IOError, OSError) as e:
+        logging.error('Could not write the run report: {}'.format(e))
+        return
+    logging.info('Run report written to {}'.format(path))
+
+
+def main(argv=None):
+    args = parse_args(argv)
     log_level = max(logging.WARN - args.verbose * 10, logging.DEBUG)
     configure_logging(log_level)
+    try:
+        run(args)
+    finally:
+        write_report(args)
+
+
+def run(args):
+    if args.routes:
+        load_routing_table(args.routes)
     with env(args) as (host, container):
         with temp_juju_home(host.tmp_juju_home, args.juju_path):
             client = make_client(args.juju_path, host, args.log_dir,
                                  args.bootstrap_constraints,
-                                 args.constraints, args.config)
-            if args.controllers_bootstrapped:
-                logging.info('Using already bootstrapped controller:{}'.format(
-                    args.controllers))
-                run_test(host, args, args.controllers, container, client)
-            else:
-                logging.info('Bootstrapping: {}'.format(args.controllers))
-                with client.bootstrap() as bootstrapped_controllers:
-                    logging.info('Bootstrapped: {}'.format(
-                        bootstrapped_controllers))
-                    if bootstrapped_controllers:
-                        run_test(host, args, bootstrapped_controllers,
-                                 container, client)
+                                 args.constraints, args.config,
+                                 args.bootstrap_concurrency,
+                                 args.destroy_concurrency, args.kill_timeout,
+                                 args.log_concurrency, make_pool(args),
+                                 load_model_limits(args),
+                                 make_log_options(args), make_journal(args),
+                                 RegionStats(args.region_stats),
+                                 args.bootstrap_retries,
+                                 args.bootstrap_backoff)
+            image = make_image_cache(args, container)
+            if not args.no_container:
+                # Pull the image while the controllers bootstrap.
+                image.start_pull()
+            try:
+                run_tests(host, args, container, client, image)
+            finally:
+                store_benchmarks(args, host)
+
+
+def run_tests(host, args, container, client, image):
+    if args.resume and not args.controllers_bootstrapped:
+        logging.info('Resuming with controllers: {}'.format(client.resume()))
+        controllers = [client.resumed.get(c, c) for c in host.controllers]
+        if tests_finished(client.journal, args, controllers):
+            logging.info('All tests passed, cleaning up.')
+            client.cleanup()
+            return
+    if args.controllers_bootstrapped:
+        logging.info('Using already bootstrapped controller:{}'.format(
+            args.controllers))
+        run_test(host, args, args.controllers, container, client,
+                 image=image)
+    elif args.pipeline:
+        run_test_pipelined(host, args, container, client, image=image)
+    else:
+        logging.info('Bootstrapping: {}'.format(args.controllers))
+        with client.bootstrap() as bootstrapped_controllers:
+            logging.info('Bootstrapped: {}'.format(
+                bootstrapped_controllers))
+            bootstrapped_controllers = wait_for_models(
+                client, args, bootstrapped_controllers)
+            if bootstrapped_controllers:
+                run_test(host, args, bootstrapped_controllers,
+                         container, client, image=image)
 
 
 if __name__ == '__main__':
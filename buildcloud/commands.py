@@ -0,0 +1,66 @@
+"""Build commands as argv lists for run_command.
+
+Arguments are kept as list items from start to end, so values with spaces
+(constraints, remote shell commands) reach the program unchanged and no
+command string has to be split again.
+"""
+
+
+def juju_command(juju, command, args=(), model=None, operator_flag='-m',
+                 flags=()):
+    """Return the argv of juju [flags] command [operator_flag model] args."""
+    argv = [juju]
+    argv.extend(flags)
+    argv.append(command)
+    if model:
+        argv.extend([operator_flag, model])
+    argv.extend(args)
+    return argv
+
+
+def option_args(options):
+    """Return the argv of (value, option) pairs, skipping unset values.
+
+    A value of True adds the option alone.
+    """
+    argv = []
+    for value, option in options:
+        if not value:
+            continue
+        argv.append(option)
+        if value is not True:
+            argv.append(str(value))
+    return argv
+
+
+def docker_command(command, args=()):
+    argv = ['sudo', 'docker', command]
+    argv.extend(args)
+    return argv
+
+
+def docker_run_args(name, image, user=None, env=(), volumes=(), workdir=None,
+                    entrypoint=None, remove=True, tty=True):
+    """Return the argv of docker run options ending with the image.
+
+    env is a list of (name, value) pairs and volumes a list of
+    (host_path, container_path) pairs.
+    """
+    argv = []
+    if remove:
+        argv.append('--rm')
+    if entrypoint:
+        argv.extend(['--entrypoint', entrypoint])
+    argv.extend(['--name', name])
+    if user:
+        argv.extend(['-u', user])
+    for key, value in env:
+        argv.extend(['-e', '{}={}'.format(key, value)])
+    if workdir:
+        argv.extend(['-w', workdir])
+    for host_path, container_path in volumes:
+        argv.extend(['-v', '{}:{}'.format(host_path, container_path)])
+    if tty:
+        argv.append('-t')
+    argv.append(image)
+    return argv
@@ -0,0 +1,104 @@
+"""Classify failed juju bootstraps by what retrying them can achieve."""
+
+import random
+import re
+
+
+__metaclass__ = type
+
+# The cloud API refused the request because too many were made.
+RATE_LIMIT = 'rate-limit'
+# The region has no quota or capacity left for the controller.
+CAPACITY = 'capacity'
+# The network or the cloud API failed in a way that may not happen again.
+TRANSIENT = 'transient'
+# Everything else, such as bad credentials, constraints or configuration.
+FATAL = 'fatal'
+
+# Substrings of juju bootstrap errors for each kind of failure, in lower
+# case.  The kinds are tried in this order, so that an AWS
+# RequestLimitExceeded is a rate limit and not a capacity failure.
+FAILURE_PATTERNS = [
+    (RATE_LIMIT, [
+        'requestlimitexceeded',
+        'ratelimitexceeded',
+        'rate limit',
+        'rate exceeded',
+        'throttl',
+        'too many requests',
+    ]),
+    (CAPACITY, [
+        'quota',
+        'limitexceeded',
+        'limit exceeded',
+        'insufficientinstancecapacity',
+        'insufficient capacity',
+        'resource_pool_exhausted',
+        'skunotavailable',
+        'allocationfailed',
+        'zonalallocationfailed',
+    ]),
+    (TRANSIENT, [
+        'connection reset',
+        'connection refused',
+        'no route to host',
+        'i/o timeout',
+        'timed out',
+        'tls handshake timeout',
+        'context deadline exceeded',
+        'temporary failure in name resolution',
+        'unexpected eof',
+        'service unavailable',
+        'internal server error',
+        'bad gateway',
+    ]),
+]
+
+# An ERROR line of juju, bare or prefixed by the time with --show-log.
+ERROR_LINE = re.compile(r'^(?:[\d:.-]+\s+){0,2}ERROR\b')
+
+RETRYABLE = (RATE_LIMIT, TRANSIENT)
+# Default seconds before the first retry of a bootstrap and the most any
+# retry waits.
+BACKOFF = 30
+MAX_BACKOFF = 300
+
+
+def get_error_lines(stderr):
+    """Return the last block of ERROR lines in stderr.
+
+    The progress that juju logs with --show-log is left out, since it
+    mentions refused connections and timeouts that bootstrap recovers from.
+    Lines logged after the errors, such as the cleanup of the failed
+    bootstrap, are skipped.  Without ERROR lines the last line is returned.
+    """
+    lines = [line for line in stderr.splitlines() if line.strip()]
+    errors = []
+    for line in reversed(lines):
+        if ERROR_LINE.match(line):
+            errors.append(line)
+        elif errors:
+            break
+    if not errors:
+        return lines[-1:]
+    return errors[::-1]
+
+
+def classify_failure(error):
+    """Return the kind of failure of a CalledProcessError from stderr."""
+    stderr = getattr(error, 'stderr', None) or ''
+    text = '\n'.join(get_error_lines(stderr)).lower()
+    for kind, patterns in FAILURE_PATTERNS:
+        if any(pattern in text for pattern in patterns):
+            return kind
+    return FATAL
+
+
+def get_backoff(attempt, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+    """Return the seconds to wait before retry number attempt + 1.
+
+    The delay doubles with every attempt and is jittered between half and
+    all of it, so that controllers throttled together do not retry together.
+    """
+    delay = min(backoff * 2 ** attempt, max_backoff)
+    return random.uniform(delay / 2.0, delay)
@@ -0,0 +1,132 @@
+import errno
+import json
+import logging
+import os
+import subprocess
+from threading import Thread
+from time import time
+import yaml
+
+from buildcloud.commands import docker_command
+from buildcloud.report import phase
+from buildcloud.utility import run_command
+
+
+__metaclass__ = type
+
+# Pull the image again when the last pull is older than this many seconds.
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+
+def get_default_cache_file():
+    return os.path.join(
+        os.environ.get('HOME', '/tmp'), '.cache', 'buildcloud', 'images.yaml')
+
+
+class ImageCache:
+    """Pull a docker image only when the local copy is missing or stale.
+
+    The time of the last pull is recorded in cache_file.  If digest is set
+    the image is pinned to that digest and is only pulled when the local
+    image does not have it.
+    """
+
+    def __init__(self, name, cache_file=None, max_age=DEFAULT_MAX_AGE,
+                 digest=None):
+        self.name = name
+        self.cache_file = cache_file or get_default_cache_file()
+        self.max_age = max_age
+        self.digest = digest
+        self._thread = None
+        self._error = None
+
+    @property
+    def image(self):
+        """The image reference to pull and run."""
+        if self.digest:
+            return '{}@{}'.format(self.name, self.digest)
+        return self.name
+
+    def local_digests(self):
+        """Return the repo digests of the local image, or None if missing."""
+        try:
+            output = run_command(
+                docker_command('image', ['inspect', '--format',
+                                         '{{json .RepoDigests}}',
+                                         self.image]),
+                verbose=False)
+        except subprocess.CalledProcessError:
+            return None
+        return json.loads(output) or []
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                return yaml.safe_load(f) or {}
+        except IOError:
+            return {}
+
+    def save_cache(self, cache):
+        try:
+            os.makedirs(os.path.dirname(self.cache_file))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_file = '{}.{}'.format(self.cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            yaml.safe_dump(cache, f, default_flow_style=False)
+        os.rename(tmp_file, self.cache_file)
+
+    def needs_pull(self):
+        digests = self.local_digests()
+        if digests is None:
+            logging.info('Image {} is not present.'.format(self.image))
+            return True
+        if self.digest:
+            return not any(d.endswith('@' + self.digest) for d in digests)
+        pulled = self.load_cache().get(self.name, {}).get('pulled')
+        if pulled is None or time() - pulled > self.max_age:
+            logging.info('Image {} is older than {} seconds.'.format(
+                self.image, self.max_age))
+            return True
+        return False
+
+    def pull(self):
+        with phase('docker-pull', image=self.image):
+            run_command(docker_command('pull', [self.image]),
+                        keep_output=False)
+        cache = self.load_cache()
+        cache[self.name] = {'pulled': time(), 'digest': self.digest}
+        self.save_cache(cache)
+
+    def ensure(self):
+        """Pull the image if needed and return the image reference."""
+        if self.needs_pull():
+            self.pull()
+        else:
+            logging.info('Using cached image {}'.format(self.image))
+        return self.image
+
+    def start_pull(self):
+        """Run ensure in a background thread."""
+        def pull():
+            try:
+                self.ensure()
+            except Exception as e:
+                self._error = e
+        self._thread = Thread(target=pull)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self):
+        """Wait for a background pull, or pull now if none was started.
+
+        Return the image reference.
+        """
+        if self._thread is None:
+            return self.ensure()
+        while self._thread.is_alive():
+            self._thread.join(1)
+        if self._error is not None:
+            raise self._error
+        return self.image
@@ -0,0 +1,180 @@
+import errno
+from hashlib import sha1
+import json
+import logging
+import os
+from threading import Lock
+from time import time
+
+
+__metaclass__ = type
+
+# The journal of a run, relative to the log dir.
+JOURNAL_FILE = 'cwr-journal.jsonl'
+# The client data of the controllers in a journal, relative to the juju
+# home.  It holds credentials, so it is kept out of the published log dir.
+JOURNAL_DATA_FILE = 'cwr-journal-{}.json'
+
+# The phase transitions recorded in the journal.
+BOOTSTRAPPED = 'controller-bootstrapped'
+TEST_STARTED = 'test-started'
+TEST_FINISHED = 'test-finished'
+LOGS_COLLECTED = 'logs-collected'
+KILLED = 'controller-killed'
+# The controller went back to the controller pool.
+RELEASED = 'controller-released'
+
+
+class Journal:
+    """An append-only record of the phases a run has completed.
+
+    Every entry is a JSON object on its own line, written and synced
+    before the run moves on, so the journal survives the process being
+    killed.  A run started with --resume reads it to reuse the
+    controllers that are still alive and to skip finished tests.  The
+    client data needed to reach the controllers is kept in the private file
+    data_path rather than in the journal.
+    """
+
+    def __init__(self, path, data_path):
+        self.path = path
+        self.data_path = data_path
+        self._lock = Lock()
+
+    def record(self, event, **details):
+        entry = dict(details, event=event, time=time())
+        line = json.dumps(entry, sort_keys=True)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                os.chmod(self.path, 0o600)
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self):
+        """Return the entries of the journal.
+
+        A line cut short by the process dying is ignored.
+        """
+        entries = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        logging.warn('Ignoring a broken journal entry.')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return entries
+
+    def reset(self):
+        """Start a new journal.
+
+        The bootstrap entries of controllers left alive by the previous run
+        are kept, with their client data, so that a later run with --resume
+        can still reuse or kill them.
+        """
+        live = self.get_live_controllers()
+        if live:
+            logging.warn(
+                'The previous run left controllers alive: {}.  Use --resume '
+                'to reuse or kill them.'.format(', '.join(sorted(live))))
+        with self._lock:
+            if live:
+                tmp_path = '{}.{}'.format(self.path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    os.chmod(tmp_path, 0o600)
+                    for controller in sorted(live):
+                        f.write(json.dumps(live[controller],
+                                           sort_keys=True) + '\n')
+                os.rename(tmp_path, self.path)
+            else:
+                try:
+                    os.remove(self.path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            data = self._load_data()
+            kept = dict((c, d) for c, d in data.items() if c in live)
+            if kept != data:
+                self._save_data(kept)
+
+    def _load_data(self):
+        try:
+            with open(self.data_path) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            logging.warn('Ignoring broken journal data.')
+        return {}
+
+    def _save_data(self, data):
+        tmp_path = '{}.{}'.format(self.data_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            os.chmod(tmp_path, 0o600)
+            json.dump(data, f, sort_keys=True)
+        os.rename(tmp_path, self.data_path)
+
+    def save_controller(self, controller, data):
+        """Keep the client data of controller from export_controller."""
+        with self._lock:
+            controllers = self._load_data()
+            controllers[controller] = data
+            self._save_data(controllers)
+
+    def load_controller(self, controller):
+        """Return the client data of controller, or None."""
+        return self._load_data().get(controller)
+
+    def get_live_controllers(self):
+        """Return the bootstrap entries of the controllers not yet killed.
+
+        The entries are keyed by controller name.
+        """
+        live = {}
+        for entry in self.load():
+            if entry['event'] == BOOTSTRAPPED:
+                live[entry['controller']] = entry
+            elif entry['event'] in (KILLED, RELEASED):
+                live.pop(entry['controller'], None)
+        return live
+
+    def logs_collected(self, controller):
+        return any(e['event'] == LOGS_COLLECTED and
+                   e['controller'] == controller for e in self.load())
+
+    def get_tested_controllers(self, test_plan):
+        """Return the set of controllers test_plan passed on."""
+        tested = set()
+        for entry in self.load():
+            if (entry['event'] == TEST_FINISHED and
+                    entry['test_plan'] == test_plan):
+                tested.update(entry['controllers'])
+        return tested
+
+    def test_finished(self, test_plan, controllers=None):
+        """Return True if test_plan passed.
+
+        If controllers is set, the test must have passed on exactly these
+        controllers.
+        """
+        if controllers is not None:
+            controllers = sorted(controllers)
+        for entry in self.load():
+            if entry['event'] != TEST_FINISHED:
+                continue
+            if entry['test_plan'] != test_plan:
+                continue
+            if controllers is None or entry['controllers'] == controllers:
+                return True
+        return False
+
+
+def get_data_file(juju_home, journal_path):
+    """Return the private data file in juju_home of the journal."""
+    digest = sha1(os.path.abspath(journal_path)).hexdigest()[:12]
+    return os.path.join(juju_home, JOURNAL_DATA_FILE.format(digest))
@@ -1,22 +1,165 @@
+from collections import namedtuple
 from contextlib import contextmanager
+from functools import partial
+import gzip
+import json
 import logging
 import os
+import shutil
 import subprocess
-import yaml
+import tarfile
+from threading import (
+    BoundedSemaphore,
+    Condition,
+    Event,
+    Lock,
+    Thread,
+)
+from time import (
+    sleep,
+    time,
+)
 
+from buildcloud.commands import (
+    juju_command,
+    option_args,
+)
+from buildcloud.failures import (
+    BACKOFF,
+    CAPACITY,
+    classify_failure,
+    get_backoff,
+    RETRYABLE,
+)
+from buildcloud.journal import (
+    BOOTSTRAPPED,
+    KILLED,
+    LOGS_COLLECTED,
+    RELEASED,
+)
+from buildcloud.pool import (
+    export_controller,
+    import_controller,
+)
+from buildcloud.report import phase
+from buildcloud.routes import (
+    get_clouds,
+    get_route,
+)
 from buildcloud.utility import (
     cloud_from_env,
+    CommandRunner,
+    generate_test_id,
     run_command,
+    run_concurrently,
+    temp_dir,
 )
 
 
 __metaclass__ = type
 
+REMOTE_LOGS = [
+    '/var/log/cloud-init*.log',
+    '/var/log/juju/*.log',
+    '/var/log/syslog',
+]
+REMOTE_LOG_ARCHIVE = '/tmp/cwr-logs.tar.gz'
+# Where capped copies of the remote logs are gathered before archiving.
+REMOTE_LOG_STAGING = '/tmp/cwr-logs'
+# Seconds to wait for a pooled controller to answer before discarding it.
+POOL_CHECK_TIMEOUT = 120
+# Seconds a parsed juju status is reused before juju is asked again.
+STATUS_TTL = 5
+STATUS_ARGS = ['--format', 'json']
+# Default seconds wait_for polls a model before giving up.
+WAIT_TIMEOUT = 600
+# Bounds of the delay between two status polls in wait_for.
+WAIT_MIN_INTERVAL = 1
+WAIT_MAX_INTERVAL = 30
+# Seconds between checks for the end of the log collection in teardown.
+TEARDOWN_POLL = 0.2
+# Default number of times a bootstrap that was throttled or failed on the
+# network is retried.
+BOOTSTRAP_RETRIES = 2
+
+
+# How remote logs are collected.  compress stores them gzipped in the log
+# dir, file_cap and run_cap are the maximum bytes kept per file and for the
+# whole run (the tail is kept) and since_bootstrap skips files that were not
+# modified since the bootstrap started.
+LogOptions = namedtuple(
+    'LogOptions', ['compress', 'file_cap', 'run_cap', 'since_bootstrap'])
+DEFAULT_LOG_OPTIONS = LogOptions(False, None, None, False)
+
+
+class Status:
+    """The parsed output of juju status --format json."""
+
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(json.loads(text) if text else {})
+
+    @property
+    def machines(self):
+        """A dict of machine id to machine details."""
+        return self.data.get('machines') or {}
+
+    @property
+    def applications(self):
+        return self.data.get('applications') or {}
+
+    @property
+    def units(self):
+        """A dict of unit name to unit details, including subordinates."""
+        units = {}
+        for application in self.applications.values():
+            for name, unit in (application.get('units') or {}).items():
+                units[name] = unit
+                units.update(unit.get('subordinates') or {})
+        return units
+
+    def machine_states(self):
+        """Return a dict of machine id to its juju agent state."""
+        return dict((machine_id, _current(machine, 'juju-status'))
+                    for machine_id, machine in self.machines.items())
+
+    def agent_states(self):
+        """Return a dict of unit name to its juju agent state."""
+        return dict((name, _current(unit, 'juju-status'))
+                    for name, unit in self.units.items())
+
+    def workload_states(self):
+        """Return a dict of unit name to its workload state."""
+        return dict((name, _current(unit, 'workload-status'))
+                    for name, unit in self.units.items())
+
+
+def _current(entity, key):
+    return (entity.get(key) or {}).get('current')
+
+
+def is_ready(status):
+    """Return True if every machine is started and every unit is idle."""
+    if any(state != 'started' for state in status.machine_states().values()):
+        return False
+    if any(state != 'idle' for state in status.agent_states().values()):
+        return False
+    return 'error' not in status.workload_states().values()
+
 
 class JujuClient:
 
     def __init__(self, juju_path, host, log_dir, operator_flag='-m',
-                 bootstrap_constraints=None, constraints=None, config=None):
+                 bootstrap_constraints=None, constraints=None, config=None,
+                 bootstrap_concurrency=1, destroy_concurrency=1,
+                 kill_timeout=None, log_concurrency=1, runner=None,
+                 pool=None, status_ttl=STATUS_TTL, model_limits=None,
+                 log_options=DEFAULT_LOG_OPTIONS, journal=None,
+                 region_stats=None, bootstrap_retries=BOOTSTRAP_RETRIES,
+                 bootstrap_backoff=BACKOFF):
         self.juju = juju_path
         self.host = host
         self.log_dir = log_dir
@@ -25,134 +168,858 @@ class JujuClient:
         self.bootstrap_constraints = bootstrap_constraints
         self.constraints = constraints
         self.config = config
+        self.bootstrap_concurrency = bootstrap_concurrency
+        self.bootstrap_retries = bootstrap_retries
+        self.bootstrap_backoff = bootstrap_backoff
+        self.destroy_concurrency = destroy_concurrency
+        self.kill_timeout = kill_timeout
+        self.log_concurrency = log_concurrency
+        self.log_options = log_options
+        # Bytes of logs that may still be written for this run.
+        self._log_budget = log_options.run_cap
+        self.bootstrap_started = None
+        self.runner = runner or CommandRunner()
+        self.pool = pool
+        self.journal = journal
+        # The controllers reused from the journal, keyed by the controller
+        # they stand in for.
+        self.resumed = {}
+        # Models that are not named after their controller.
+        self.models = {}
+        # The pool key of every controller bootstrapped or leased.
+        self.pool_keys = {}
+        self.status_ttl = status_ttl
+        # The maximum number of temporary models in use at once per cloud.
+        self.model_limits = model_limits or {}
+        self._model_slots = {}
+        # The last parsed status and the time it was fetched, per model.
+        self._status_cache = {}
+        self.region_stats = region_stats
+        # The number of bootstraps in progress per cloud region.
+        self._bootstrapping = {}
+        # Set once the cleanup or the teardown after a signal is done.
+        self._cleaned_up = None
+        # Set when a signal interrupts the run; see interrupt().
+        self._interrupted = Event()
+        self._abort = None
+        self._log_timeout = None
+        self._log_deadline = None
+        # The number of controllers being killed, and the condition the
+        # kills waiting for their turn wait on.
+        self._killing = 0
+        self._kill_turn = Condition()
+        self._lock = Lock()
+
+    def get_constraints(self, controller):
+        """Return the constraints of controller.
+
+        The default constraints of the controller's route are overridden by
+        the client's.
+        """
+        route = get_route(controller)
+        return merge_constraints(
+            route.constraints if route is not None else None,
+            self.constraints)
 
-    def get_args(self):
-        args = []
-        if self.constraints:
-            args.append('--constraints {}'.format(self.constraints))
-        if self.bootstrap_constraints:
-            args.append('--bootstrap-constraints {}'.format(
-                    self.bootstrap_constraints))
-        if self.config:
-            args.append('--config {}'.format(self.config))
-        args = ' {}'.format(' '.join(args)) if args else ''
-        return args
-
-    def _bootstrap(self):
+    def get_args(self, controller):
+        return option_args([
+            (self.get_constraints(controller), '--constraints'),
+            (self.bootstrap_constraints, '--bootstrap-constraints'),
+            (self.config, '--config'),
+        ])
+
+    def _bootstrap(self, on_bootstrapped=None):
+        """Bootstrap the host's controllers.
+
+        If on_bootstrapped is set, it is called with the name of each
+        controller as soon as that controller is ready.
+        """
+        clouds = []
+        order = []
         for i, controller in enumerate(self.host.controllers):
-            args = self.get_args()
-            cloud = cloud_from_env(controller)
-            if cloud is None:
+            route = get_route(controller)
+            if route is None:
                 raise ValueError('Unknown cloud: {}'.format(controller))
+            resumed = self.resumed.get(controller)
+            if resumed is not None:
+                order.append(resumed)
+                self.host.controllers[i] = self.get_model(resumed)
+                self._notify_bootstrapped(on_bootstrapped, resumed)
+                continue
             self.host.controllers[i] = self.get_model(controller)
+            clouds.append((controller, get_clouds(route)))
+            order.append(controller)
+        if self.pool is not None:
+            self._evict_pool()
+            # Leasing is done serially, before any bootstrap runs, so that
+            # nothing else writes to the juju client files at the same time.
+            to_bootstrap = []
+            for controller, candidates in clouds:
+                for cloud in candidates:
+                    leased = self._lease_controller(cloud)
+                    if leased is not None:
+                        break
+                if leased is None:
+                    to_bootstrap.append((controller, candidates))
+                    continue
+                self._record_bootstrapped(leased, controller, cloud)
+                i = order.index(controller)
+                order[i] = leased
+                self.host.controllers[i] = self.get_model(leased)
+                self._notify_bootstrapped(on_bootstrapped, leased)
+            clouds = to_bootstrap
+        results = run_concurrently(
+            partial(self._bootstrap_controller,
+                    on_bootstrapped=on_bootstrapped),
+            clouds, self.bootstrap_concurrency)
+        # Keep the bootstrapped list in the same order as the controllers
+        # regardless of which bootstrap finished first.
+        with self._lock:
+            self.bootstrapped.sort(
+                key=lambda x: order.index(x) if x in order else len(order))
+        for _, _, error in results:
+            if error is not None:
+                raise error
+
+    def get_pool_key(self, cloud):
+        return {
+            'cloud': cloud,
+            'constraints': self.constraints,
+            'bootstrap_constraints': self.bootstrap_constraints,
+            'config': self.config,
+        }
+
+    def _lease_controller(self, cloud):
+        """Take a usable controller for cloud from the pool.
+
+        A fresh model is added to the controller for this run.  Return the
+        controller name, or None if the pool has no usable controller.
+        """
+        key = self.get_pool_key(cloud)
+        while True:
+            entry = self.pool.lease(key)
+            if entry is None:
+                return None
+            controller = entry['controller']
+            import_controller(self.host.tmp_juju_home, controller,
+                              entry['data'])
             try:
-                run_command(
-                    '{} bootstrap --show-log {} {} --default-model {} '
-                    '--no-gui{}'.format(
-                            self.juju, cloud, controller, controller, args))
+                self._check_controller(controller)
+                model = self.add_model(controller).split(':', 1)[1]
+            except subprocess.CalledProcessError:
+                logging.warn('Pooled controller {} is not usable.'.format(
+                    controller))
+                self._kill_controller(controller)
+                continue
+            self.models[controller] = model
+            self.pool_keys[controller] = key
+            self.bootstrapped.append(controller)
+            return controller
+
+    def _check_controller(self, controller):
+        """Raise CalledProcessError if controller does not answer."""
+        run_command(juju_command(self.juju, 'models', ['-c', controller]),
+                    timeout=POOL_CHECK_TIMEOUT)
+
+    def resume(self):
+        """Reuse the controllers the journal lists as alive.
+
+        Controllers that no longer answer are killed.  The reused ones are
+        not bootstrapped again by bootstrap.  Return their names.
+        """
+        live = self.journal.get_live_controllers()
+        for controller, entry in sorted(live.items()):
+            data = self.journal.load_controller(controller)
+            if data is None:
+                logging.error('No client data to reach controller {}.'.format(
+                    controller))
+                continue
+            import_controller(self.host.tmp_juju_home, controller, data)
+            try:
+                self._check_controller(controller)
             except subprocess.CalledProcessError:
+                logging.warn('Controller {} is not usable.'.format(
+                    controller))
+                self._kill_controller(controller)
+                continue
+            logging.info('Reusing controller {}.'.format(controller))
+            if entry['model'] is not None:
+                self.models[controller] = entry['model']
+            self.pool_keys[controller] = entry['key']
+            self.bootstrapped.append(controller)
+            self.resumed[entry['requested']] = controller
+        return list(self.bootstrapped)
+
+    def _record(self, event, **details):
+        if self.journal is not None:
+            self.journal.record(event, **details)
+
+    def _record_bootstrapped(self, controller, requested, cloud):
+        if self.journal is None:
+            return
+        self.journal.save_controller(
+            controller,
+            export_controller(self.host.tmp_juju_home, controller))
+        self._record(
+            BOOTSTRAPPED, controller=controller, requested=requested,
+            cloud=cloud, model=self.models.get(controller),
+            key=self.pool_keys[controller])
+
+    def _release_controller(self, controller):
+        """Return controller to the pool.  Return True if it was pooled."""
+        key = self.pool_keys.get(controller)
+        if key is None:
+            return False
+        try:
+            self.destroy_model(self.get_model(controller))
+        except subprocess.CalledProcessError:
+            logging.warn('Could not destroy the model of {}.'.format(
+                controller))
+            return False
+        data = export_controller(self.host.tmp_juju_home, controller)
+        if not self.pool.release(controller, key, data):
+            return False
+        self._record(RELEASED, controller=controller)
+        return True
+
+    def add_model(self, controller, model=None):
+        """Add a model to controller and return its qualified name.
+
+        The model gets the client's config and constraints.  A unique name
+        is generated if model is not set.
+        """
+        if model is None:
+            model = 'cwr-{}'.format(generate_test_id()[:8])
+        self.run('add-model', ['-c', controller, model] +
+                 option_args([(self.config, '--config')]))
+        qualified = '{}:{}'.format(controller, model)
+        constraints = self.get_constraints(controller)
+        if constraints:
+            self.run('set-model-constraints', constraints.split(),
+                     model=qualified)
+        return qualified
+
+    def destroy_model(self, model):
+        self.run('destroy-model', ['-y', model])
+        self.invalidate_status(model)
+
+    def get_cloud(self, controller):
+        key = self.pool_keys.get(controller)
+        if key is not None:
+            return key['cloud']
+        return cloud_from_env(controller)
+
+    def _get_limit_name(self, cloud):
+        """Return the name the model limit of cloud is set for, or None.
+
+        A limit set for a cloud name applies to all its regions together.
+        """
+        if cloud is None:
+            return None
+        for name in (cloud, cloud.split('/')[0]):
+            if name in self.model_limits:
+                return name
+        return None
+
+    def get_model_limit(self, cloud):
+        """Return the model limit of cloud, or None if it has none."""
+        return self.model_limits.get(self._get_limit_name(cloud))
+
+    def _get_model_slot(self, name):
+        with self._lock:
+            if name not in self._model_slots:
+                self._model_slots[name] = BoundedSemaphore(
+                    self.model_limits[name])
+            return self._model_slots[name]
+
+    @contextmanager
+    def temp_models(self, controllers):
+        """Add a model to each controller for the duration of the block.
+
+        Yield the qualified model names.  If a cloud has a model limit, the
+        block waits until fewer than that many temporary models are in use
+        on it.
+        """
+        names = sorted(set(
+            name for name in (self._get_limit_name(self.get_cloud(c))
+                              for c in controllers)
+            if name is not None))
+        acquired = []
+        models = []
+        try:
+            # Slots are taken in a fixed order so that concurrent callers
+            # cannot deadlock.
+            for name in names:
+                slot = self._get_model_slot(name)
+                slot.acquire()
+                acquired.append(slot)
+            for controller in controllers:
+                models.append(self.add_model(controller))
+            yield models
+        finally:
+            for model in models:
+                try:
+                    self.destroy_model(model)
+                except subprocess.CalledProcessError:
+                    logging.warn('Could not destroy model {}.'.format(model))
+            for slot in reversed(acquired):
+                slot.release()
+
+    def _evict_pool(self):
+        for entry in self.pool.evict_expired():
+            controller = entry['controller']
+            logging.info('Killing expired pooled controller {}.'.format(
+                controller))
+            import_controller(self.host.tmp_juju_home, controller,
+                              entry['data'])
+            self._kill_controller(controller)
+
+    def _choose_cloud(self, clouds, tried):
+        """Return the best cloud region to bootstrap in next, or None.
+
+        The region is counted as in use until _bootstrap_in returns.
+        """
+        candidates = [cloud for cloud in clouds if cloud not in tried]
+        if not candidates:
+            return None
+        with self._lock:
+            if self.region_stats is not None:
+                cloud = self.region_stats.rank(
+                    candidates, self._bootstrapping)[0]
+            else:
+                cloud = min(candidates, key=lambda c: (
+                    self._bootstrapping.get(c, 0), candidates.index(c)))
+            self._bootstrapping[cloud] = self._bootstrapping.get(cloud, 0) + 1
+        return cloud
+
+    def _bootstrap_in(self, controller, cloud):
+        """Bootstrap controller in cloud.  Return the error if it failed."""
+        args = self.get_args(controller)
+        started = time()
+        try:
+            with phase('bootstrap-controller', controller=controller,
+                       cloud=cloud) as record:
+                try:
+                    run_command(
+                        juju_command(self.juju, 'bootstrap', [
+                            '--show-log', cloud, controller,
+                            '--default-model', controller, '--no-gui'] +
+                            args),
+                        keep_output=False)
+                except subprocess.CalledProcessError as e:
+                    record['status'] = 'failed'
+                    return e
+        finally:
+            with self._lock:
+                self._bootstrapping[cloud] -= 1
+        if self.region_stats is not None:
+            self.region_stats.record_bootstrap(cloud, time() - started)
+        return None
+
+    def _remove_failed_bootstrap(self, controller):
+        """Kill what a failed bootstrap of controller left behind.
+
+        Juju usually cleans up after a failed bootstrap, in which case there
+        is no controller to kill and the error is ignored.
+        """
+        try:
+            run_command(
+                juju_command(self.juju, 'kill-controller',
+                             [controller, '-y']),
+                timeout=self.kill_timeout, keep_output=False)
+        except subprocess.CalledProcessError:
+            return False
+        logging.info('Killed the partial controller {}.'.format(controller))
+        return True
+
+    def _bootstrap_controller(self, controller_clouds, on_bootstrapped=None):
+        """Bootstrap controller in one of its candidate cloud regions.
+
+        A bootstrap that fails for lack of quota or capacity is tried again
+        in the next best region.  One that was throttled or failed on the
+        network is retried up to bootstrap_retries times after a jittered
+        exponential backoff; the other controllers carry on meanwhile.  No
+        attempt is started once the run is interrupted.
+        """
+        controller, clouds = controller_clouds
+        tried = []
+        attempt = 0
+        while True:
+            if self._interrupted.is_set():
+                logging.warn('Not bootstrapping {} after the '
+                             'interruption.'.format(controller))
+                return False
+            cloud = self._choose_cloud(clouds, tried)
+            if cloud is None:
                 logging.error('Bootstrapping failed on {}'.format(
                         controller))
+                return False
+            error = self._bootstrap_in(controller, cloud)
+            if error is None:
+                break
+            kind = classify_failure(error)
+            if kind == CAPACITY:
+                logging.warn('No quota or capacity for {} in {}.'.format(
+                    controller, cloud))
+                tried.append(cloud)
+                if self.region_stats is not None:
+                    self.region_stats.record_capacity_failure(cloud)
+                if len(tried) < len(clouds):
+                    self._remove_failed_bootstrap(controller)
                 continue
+            if kind not in RETRYABLE or attempt >= self.bootstrap_retries:
+                logging.error('Bootstrapping failed on {}: {} error.'.format(
+                    controller, kind))
+                return False
+            self._remove_failed_bootstrap(controller)
+            delay = get_backoff(attempt, self.bootstrap_backoff)
+            attempt += 1
+            logging.warn(
+                'Retrying the bootstrap of {} in {:.0f} seconds after a {} '
+                'error.'.format(controller, delay, kind))
+            # An interruption ends the wait early.
+            self._interrupted.wait(delay)
+        with self._lock:
             self.bootstrapped.append(controller)
+            self.pool_keys[controller] = self.get_pool_key(cloud)
+        self._record_bootstrapped(controller, controller, cloud)
+        self._notify_bootstrapped(on_bootstrapped, controller)
+        return True
 
-    def _destroy(self):
-        killed = []
-        for controller in self.bootstrapped:
+    def _notify_bootstrapped(self, on_bootstrapped, controller):
+        """Call on_bootstrapped with controller unless interrupted."""
+        if on_bootstrapped is None:
+            return
+        if self._interrupted.is_set():
+            logging.info('Not using {} after the interruption.'.format(
+                controller))
+            return
+        on_bootstrapped(controller)
+
+    def _destroy(self, concurrency=None):
+        """Retire the bootstrapped controllers, concurrency at a time.
+
+        Once the run is interrupted, the controllers still waiting for their
+        turn are all retired at once.
+        """
+        if concurrency is None:
+            concurrency = self.destroy_concurrency
+        results = run_concurrently(
+            partial(self._retire_in_turn, concurrency=concurrency),
+            list(self.bootstrapped), 0)
+        killed = [controller for controller, ok, _ in results if ok]
+        failed = [controller for controller, ok, _ in results if not ok]
+        with self._lock:
+            self.bootstrapped = [
+                x for x in self.bootstrapped if x not in killed]
+        if failed:
+            logging.error('Failed to kill controllers: {}'.format(
+                ', '.join(failed)))
+        for _, _, error in results:
+            if error is not None:
+                raise error
+
+    def _retire_in_turn(self, controller, concurrency):
+        """Retire controller once fewer than concurrency are retiring."""
+        with self._kill_turn:
+            while (0 < concurrency <= self._killing and
+                   not self._interrupted.is_set()):
+                self._kill_turn.wait(TEARDOWN_POLL)
+            self._killing += 1
+        try:
+            return self._retire_controller(controller)
+        finally:
+            with self._kill_turn:
+                self._killing -= 1
+                self._kill_turn.notify()
+
+    def _retire_controller(self, controller):
+        """Return controller to the pool if there is one, else kill it."""
+        if self.pool is not None and self._release_controller(controller):
+            return True
+        return self._kill_controller(controller)
+
+    def _kill_controller(self, controller):
+        with phase('kill-controller', controller=controller) as record:
             try:
-                run_command('{} --debug kill-controller {} -y'.format(
-                    self.juju, controller))
-                killed.append(controller)
+                run_command(
+                    juju_command(self.juju, 'kill-controller',
+                                 [controller, '-y'], flags=['--debug']),
+                    timeout=self.kill_timeout, keep_output=False)
             except subprocess.CalledProcessError:
+                record['status'] = 'failed'
                 logging.error(
                     "Error destroy env failed: {}".format(controller))
-        self.bootstrapped = [x for x in self.bootstrapped if x not in killed]
+                return False
+        self._record(KILLED, controller=controller)
+        return True
 
     @contextmanager
-    def bootstrap(self):
-        run_command('{} --version'.format(self.juju))
+    def bootstrap(self, on_bootstrapped=None):
+        run_command([self.juju, '--version'])
         logging.info("JUJU_DATA is set to {}".format(self.host.tmp_juju_home))
+        self.bootstrap_started = time()
         try:
-            self._bootstrap()
-            yield [self.get_model(x) for x in self.bootstrapped]
+            with phase('bootstrap', controllers=list(self.host.controllers)):
+                self._bootstrap(on_bootstrapped=on_bootstrapped)
+            if self._interrupted.is_set():
+                # Nothing is tested on an interrupted run.
+                yield []
+            else:
+                yield [self.get_model(x) for x in self.bootstrapped]
         finally:
             self.cleanup()
 
     def get_model(self, controller):
-        return '{}:{}'.format(controller, controller)
+        return '{}:{}'.format(
+            controller, self.models.get(controller, controller))
 
     def get_controller_model(self, controller):
         return '{}:controller'.format(controller)
 
     def copy_remote_logs(self):
         logging.info("Gathering remote logs.")
-        logs = [
-            '/var/log/cloud-init*.log',
-            '/var/log/juju/*.log',
-            '/var/log/syslog',
-        ]
+        targets = []
+        collected = []
         for controller in self.bootstrapped:
+            if (self.journal is not None and
+                    self.journal.logs_collected(controller)):
+                logging.info('Logs of {} were already collected.'.format(
+                    controller))
+                continue
+            collected.append(controller)
             model = self.get_model(controller)
             controller_model = self.get_controller_model(controller)
-            status = self.get_status(model=model)
-            machines = yaml.safe_load(status).get('machines')
+            machines = self.get_status(model=model).machines
             if not machines:
                 logging.warn('No machines listed.')
                 continue
-            machines = yaml.safe_load(status)['machines'].keys()
-            self._copy_remote_logs(model, machines, logs)
-            self._copy_remote_logs(controller_model, [0], logs)
+            targets.extend((model, machine) for machine in machines)
+            targets.append((controller_model, 0))
+        if targets:
+            run_concurrently(
+                self._copy_remote_logs, targets, self.log_concurrency)
         else:
             logging.info('No machine logs to copy.')
+        for controller in collected:
+            self._record(LOGS_COLLECTED, controller=controller)
 
-    def _copy_remote_logs(self, model, machines, logs):
-        for machine in machines:
-            for log in logs:
-                args = '{} ls {}'.format(machine, log)
-                try:
-                    files = self.run('ssh', args, model)
-                except subprocess.CalledProcessError:
-                    logging.warn("Could not list remote files.")
-                    continue
-                files = files.strip().split()
-                for f in files:
-                    try:
-                        args = '{} sudo chmod  -Rf go+r {}'.format(machine, f)
-                        self.run('ssh', args, model=model)
-                        basename = '{}--{}'.format(
-                            model.replace(':', '-'), os.path.basename(f))
-                        dst_path = os.path.join(self.log_dir, basename)
-                        args = '-- -rC {}:{} {}'.format(machine, f, dst_path)
-                        self.run('scp', args, model=model)
-                    except subprocess.CalledProcessError:
-                        logging.warn(
-                            "Could not get logs for {} {}".format(model, f))
-
-    def run(self, command, args='', model=''):
-        m = '{} {}'.format(self.operator_flag, model) if model else model
-        return run_command('{} {} {} {}'.format(self.juju, command, m, args))
-
-    def get_status(self, model=''):
-        return self.run('status --format yaml', model=model)
+    def _copy_remote_logs(self, target):
+        """Copy the logs of a single machine into the log dir.
+
+        The logs are archived on the machine with a single ssh call and
+        fetched with a single scp call, instead of a round-trip per file.
+        """
+        model, machine = target
+        since = None
+        if self.log_options.since_bootstrap:
+            since = self.bootstrap_started
+        remote_command = make_log_command(self.log_options.file_cap, since)
+        with temp_dir() as tmp:
+            archive = os.path.join(tmp, 'logs.tar.gz')
+            try:
+                self.run('ssh', [str(machine), remote_command], model=model)
+                self.run('scp', [
+                    '--', '{}:{}'.format(machine, REMOTE_LOG_ARCHIVE),
+                    archive], model=model)
+                unpack_logs(archive, self.log_dir, model.replace(':', '-'),
+                            compress=self.log_options.compress,
+                            reserve=self._reserve_log_bytes)
+            except (subprocess.CalledProcessError, tarfile.TarError):
+                logging.warn("Could not get logs for {} machine {}".format(
+                    model, machine))
+                return False
+        return True
+
+    def _reserve_log_bytes(self, size):
+        """Return how many of size bytes may be written under the run cap."""
+        if self._log_budget is None:
+            return size
+        with self._lock:
+            allowed = min(size, self._log_budget)
+            self._log_budget -= allowed
+        return allowed
+
+    def run(self, command, args=(), model=''):
+        """Run the juju command with the list of args."""
+        return run_command(self._juju_command(command, args, model))
+
+    def run_async(self, command, args=(), model=''):
+        """Start a juju command on the runner and return its CommandFuture."""
+        return self.runner.submit(self._juju_command(command, args, model))
+
+    def _juju_command(self, command, args=(), model=''):
+        return juju_command(self.juju, command, args, model=model,
+                            operator_flag=self.operator_flag)
+
+    def get_status(self, model='', refresh=False):
+        """Return the Status of model.
+
+        A status fetched less than status_ttl seconds ago is reused unless
+        refresh is set.
+        """
+        now = time()
+        with self._lock:
+            cached = self._status_cache.get(model)
+        if (not refresh and cached is not None and
+                now - cached[0] < self.status_ttl):
+            return cached[1]
+        status = Status.from_text(
+            self.run('status', STATUS_ARGS, model=model))
+        with self._lock:
+            self._status_cache[model] = (now, status)
+        return status
+
+    def get_status_async(self, model=''):
+        """Start juju status and return its CommandFuture.
+
+        The result is the JSON text; parse it with Status.from_text.
+        """
+        return self.run_async('status', STATUS_ARGS, model=model)
+
+    def wait_for(self, models, predicate=is_ready, timeout=WAIT_TIMEOUT,
+                 interval=WAIT_MIN_INTERVAL, max_interval=WAIT_MAX_INTERVAL):
+        """Wait until predicate is true for the Status of every model.
+
+        The models are polled concurrently.  The delay between two polls of
+        a model starts at interval and doubles up to max_interval.  Return
+        the models that were not ready within timeout seconds.
+        """
+        wait = partial(self._wait_for_model, predicate=predicate,
+                       deadline=time() + timeout, interval=interval,
+                       max_interval=max_interval)
+        results = run_concurrently(wait, models, max_workers=None)
+        not_ready = []
+        for model, ready, exc in results:
+            if exc is not None:
+                raise exc
+            if not ready:
+                logging.warn('{} was not ready after {} seconds.'.format(
+                    model, timeout))
+                not_ready.append(model)
+        return not_ready
+
+    def _wait_for_model(self, model, predicate, deadline, interval,
+                        max_interval):
+        while True:
+            try:
+                if predicate(self.get_status(model=model, refresh=True)):
+                    return True
+            except subprocess.CalledProcessError:
+                # The controller may not answer yet.
+                logging.info('Could not get the status of {}.'.format(model))
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            sleep(min(interval, remaining))
+            interval = min(interval * 2, max_interval)
+
+    def invalidate_status(self, model=None):
+        """Forget the cached status of model, or of all models."""
+        with self._lock:
+            if model is None:
+                self._status_cache.clear()
+            else:
+                self._status_cache.pop(model, None)
+
+    def interrupt(self, log_timeout, abort=None):
+        """Wind the run down after a signal.
+
+        No bootstrap is started afterwards and no new controller is passed
+        to on_bootstrapped.  The cleanup, whether it is already running or
+        not, collects logs for at most log_timeout more seconds, and none
+        once abort is set, then kills all the controllers at once.
+        """
+        with self._lock:
+            if self._interrupted.is_set():
+                return
+            self._abort = abort
+            self._log_timeout = log_timeout
+            self._log_deadline = time() + log_timeout
+            self._interrupted.set()
+
+    def _start_cleanup(self):
+        """Return the event to set once cleaned up.
+
+        Return None if the cleanup or the teardown already started.
+        """
+        with self._lock:
+            if self._cleaned_up is not None:
+                return None
+            self._cleaned_up = Event()
+            return self._cleaned_up
+
+    def _wait_for_cleanup(self):
+        # Wait in short steps so signal handlers still run.
+        while not self._cleaned_up.is_set():
+            self._cleaned_up.wait(1)
 
     def cleanup(self):
+        """Collect the remote logs and kill the controllers.
+
+        If the cleanup or the teardown already started, wait for it to
+        finish instead, then kill the controllers bootstrapped after an
+        interruption.
+        """
+        done = self._start_cleanup()
+        if done is None:
+            logging.info('Waiting for the cleanup of the controllers.')
+            self._wait_for_cleanup()
+            if self._interrupted.is_set() and self.bootstrapped:
+                logging.warn('Killing the controllers left after the '
+                             'teardown: {}'.format(
+                                 ', '.join(self.bootstrapped)))
+                self._destroy(concurrency=0)
+            return
         try:
-            self.copy_remote_logs()
+            self._copy_logs()
+            with phase('destroy', controllers=list(self.bootstrapped)):
+                self._destroy()
+        finally:
+            done.set()
+
+    def _copy_logs(self):
+        """Collect the remote logs, within the limits of an interruption."""
+        logs = Thread(target=self._copy_logs_now)
+        logs.daemon = True
+        logs.start()
+        while logs.is_alive():
+            with self._lock:
+                abort = self._abort
+                deadline = self._log_deadline
+            if abort is not None and abort.is_set():
+                logging.warn('Killing the controllers without waiting for '
+                             'their logs.')
+                return
+            if deadline is None:
+                logs.join(TEARDOWN_POLL)
+                continue
+            remaining = deadline - time()
+            if remaining <= 0:
+                logging.warn('Gave up collecting logs after {} '
+                             'seconds.'.format(self._log_timeout))
+                return
+            logs.join(min(TEARDOWN_POLL, remaining))
+
+    def _copy_logs_now(self):
+        try:
+            with phase('copy-remote-logs'):
+                self.copy_remote_logs()
         except subprocess.CalledProcessError:
             logging.error('Getting logs failed.')
-        self._destroy()
+
+    def teardown(self, log_timeout, abort=None):
+        """Kill all the controllers of an interrupted run at once.
+
+        The remote logs are collected first, since killing a controller
+        destroys its machines, but for at most log_timeout seconds and only
+        until abort is set.  If a cleanup already started, it is held to the
+        same limits and waited for instead.  A cleanup started later waits
+        for the teardown, then kills the controllers bootstrapped meanwhile.
+        """
+        self.interrupt(log_timeout, abort)
+        done = self._start_cleanup()
+        if done is None:
+            logging.info('The controllers are already being cleaned up.')
+            self._wait_for_cleanup()
+            return
+        try:
+            with phase('teardown', controllers=list(self.bootstrapped)):
+                self._copy_logs()
+                self._destroy(concurrency=0)
+        finally:
+            done.set()
+
+
+def merge_constraints(defaults, constraints):
+    """Return the constraints with the defaults they do not set."""
+    if not defaults:
+        return constraints
+    keys = set(c.split('=', 1)[0] for c in (constraints or '').split())
+    merged = [c for c in defaults.split() if c.split('=', 1)[0] not in keys]
+    if constraints:
+        merged.append(constraints)
+    return ' '.join(merged)
+
+
+def make_log_command(file_cap=None, since=None):
+    """Return the shell command that archives the logs of a machine.
+
+    If file_cap is set only the last file_cap bytes of each log are kept.  If
+    since is set, logs not modified after that time are left out.  The
+    archive of an earlier run is removed first, so that a failed tar leaves
+    no archive to fetch rather than a stale one.
+    """
+    files = ' '.join(REMOTE_LOGS)
+    if since is not None:
+        files = ('$(sudo find {} -maxdepth 0 -type f -newermt @{} '
+                 '2>/dev/null)'.format(files, int(since)))
+    if file_cap is None:
+        return ('sudo rm -f {archive} ; '
+                'sudo tar -czf {archive} --ignore-failed-read {files} && '
+                'sudo chmod go+r {archive}'.format(
+                    archive=REMOTE_LOG_ARCHIVE, files=files))
+    return ('sudo rm -rf {stage} {archive} ; sudo mkdir -p {stage} ; '
+            'for f in {files} ; do [ -f $f ] && sudo tail -c {cap} $f | '
+            'sudo tee {stage}/${{f##*/}} > /dev/null ; done ; '
+            'sudo tar -czf {archive} -C {stage} . && '
+            'sudo chmod go+r {archive}'.format(
+                stage=REMOTE_LOG_STAGING, files=files, cap=file_cap,
+                archive=REMOTE_LOG_ARCHIVE))
+
+
+def unpack_logs(archive, log_dir, prefix, compress=False, reserve=None):
+    """Extract the files in archive into log_dir as prefix--basename.
+
+    If compress is set the files are written gzipped with a .gz suffix.
+    reserve is called with the size of each file and returns how many bytes
+    of it may be written; the tail of the file is kept.
+    """
+    with tarfile.open(archive, 'r:gz') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = '{}--{}'.format(prefix, os.path.basename(member.name))
+            size = member.size
+            if reserve is not None:
+                size = reserve(member.size)
+                if size == 0 and member.size:
+                    logging.warn('Log size cap reached, skipping {}.'.format(
+                        name))
+                    continue
+            src = tar.extractfile(member)
+            src.seek(member.size - size)
+            if compress:
+                dst = gzip.open(os.path.join(log_dir, name + '.gz'), 'wb')
+            else:
+                dst = open(os.path.join(log_dir, name), 'wb')
+            with dst:
+                shutil.copyfileobj(src, dst)
 
 
 def make_client(juju_path, host, log_dir, bootstrap_constraints,
-                constraints, config):
+                constraints, config, bootstrap_concurrency=1,
+                destroy_concurrency=1, kill_timeout=None, log_concurrency=1,
+                pool=None, model_limits=None, log_options=DEFAULT_LOG_OPTIONS,
+                journal=None, region_stats=None,
+                bootstrap_retries=BOOTSTRAP_RETRIES,
+                bootstrap_backoff=BACKOFF):
     if juju_path is None:
         juju_path = 'juju'
-    version = run_command('{} --version'.format(juju_path)).strip()
+    version = run_command([juju_path, '--version']).strip()
     if version.startswith('1.'):
         raise ValueError('Juju 1.x is not supported.')
     elif version.startswith('2.'):
         return JujuClient(juju_path, host, log_dir=log_dir,
                           bootstrap_constraints=bootstrap_constraints,
-                          constraints=constraints, config=config)
+                          constraints=constraints, config=config,
+                          bootstrap_concurrency=bootstrap_concurrency,
+                          destroy_concurrency=destroy_concurrency,
+                          kill_timeout=kill_timeout,
+                          log_concurrency=log_concurrency, pool=pool,
+                          model_limits=model_limits, log_options=log_options,
+                          journal=journal, region_stats=region_stats,
+                          bootstrap_retries=bootstrap_retries,
+                          bootstrap_backoff=bootstrap_backoff)
     else:
         raise ValueError('Unknown juju version')
@@ -0,0 +1,154 @@
+from collections import namedtuple
+import errno
+import json
+import logging
+import os
+
+import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+__metaclass__ = type
+
+# Extensions of the test plan files found in a test plan directory.
+TEST_PLAN_EXTENSIONS = ('.yaml', '.yml')
+REQUIRED_KEYS = ['bundle', 'bundle_name']
+# The types allowed for optional keys.
+OPTIONAL_KEYS = {
+    'test_label': (basestring, list),
+    'benchmark': dict,
+    'bundle_file': basestring,
+}
+# Bump when the cached data would be different for the same file.
+INDEX_VERSION = 1
+
+Plan = namedtuple('Plan', ['path', 'data'])
+
+
+class InvalidPlan(ValueError):
+    """A test plan that cannot be used."""
+
+
+def get_default_index_file():
+    return os.path.join(
+        os.environ.get('HOME', '/tmp'), '.cache', 'buildcloud', 'plans.json')
+
+
+def get_plan_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def validate_plan(path, data):
+    if not isinstance(data, dict):
+        raise InvalidPlan('{}: not a mapping'.format(path))
+    missing = [key for key in REQUIRED_KEYS if not data.get(key)]
+    if missing:
+        raise InvalidPlan('{}: missing {}'.format(path, ', '.join(missing)))
+    for key, types in OPTIONAL_KEYS.items():
+        if data.get(key) is not None and not isinstance(data[key], types):
+            raise InvalidPlan('{}: invalid {}'.format(path, key))
+
+
+def load_plan(path):
+    """Parse and validate the test plan at path."""
+    with open(path) as f:
+        data = yaml.load(f, Loader=SafeLoader)
+    validate_plan(path, data)
+    return data
+
+
+def get_test_labels(plan):
+    """Return the test labels of plan as a list."""
+    labels = plan.data.get('test_label') or []
+    if isinstance(labels, basestring):
+        labels = [labels]
+    return labels
+
+
+def select_plans(plans, label=None, benchmark=False):
+    """Return the plans with the test label and, if set, a benchmark."""
+    if label is not None:
+        plans = [p for p in plans if label in get_test_labels(p)]
+    if benchmark:
+        plans = [p for p in plans if p.data.get('benchmark')]
+    return plans
+
+
+class PlanIndex:
+    """The parsed test plans of a directory.
+
+    Plans are parsed once and kept in index_file, keyed by their path, so
+    later runs only parse the plans whose mtime or size changed.  No index
+    is kept if index_file is None.
+    """
+
+    def __init__(self, plan_dir, index_file=None):
+        self.plan_dir = plan_dir
+        self.index_file = index_file
+
+    def list_plans(self, names=None):
+        """Return the paths of the plans, restricted to names if set.
+
+        A name may be given with or without its extension.
+        """
+        paths = sorted(
+            os.path.join(self.plan_dir, name)
+            for name in os.listdir(self.plan_dir)
+            if name.endswith(TEST_PLAN_EXTENSIONS))
+        if not names:
+            return paths
+        by_name = dict((get_plan_name(p), p) for p in paths)
+        names = [get_plan_name(n) for n in names]
+        missing = [n for n in names if n not in by_name]
+        if missing:
+            raise ValueError('Unknown test plans: {}'.format(
+                ', '.join(missing)))
+        return [by_name[n] for n in names]
+
+    def load_index(self):
+        if self.index_file is None:
+            return {}
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if index.get('version') != INDEX_VERSION:
+            return {}
+        return index.get('plans', {})
+
+    def save_index(self, entries):
+        try:
+            os.makedirs(os.path.dirname(self.index_file))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_file = '{}.{}'.format(self.index_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'plans': entries}, f)
+        os.rename(tmp_file, self.index_file)
+
+    def load(self, names=None):
+        """Return the valid Plans, raising InvalidPlan for a bad one."""
+        entries = self.load_index()
+        changed = False
+        plans = []
+        for path in self.list_plans(names):
+            # The index is keyed by the absolute path, but the plans keep the
+            # path they were listed with, which may be sent to other hosts.
+            index_path = os.path.abspath(path)
+            stat = os.stat(path)
+            key = [stat.st_mtime, stat.st_size]
+            entry = entries.get(index_path)
+            if entry is None or entry['key'] != key:
+                logging.debug('Parsing test plan {}'.format(path))
+                entry = {'key': key, 'data': load_plan(path)}
+                entries[index_path] = entry
+                changed = True
+            plans.append(Plan(path, entry['data']))
+        if changed and self.index_file is not None:
+            self.save_index(entries)
+        return plans
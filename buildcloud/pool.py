@@ -0,0 +1,134 @@
+from contextlib import contextmanager
+import errno
+import fcntl
+import logging
+import os
+from time import time
+import yaml
+
+
+__metaclass__ = type
+
+# Idle controllers older than this many seconds are killed.
+DEFAULT_TTL = 4 * 60 * 60
+# Maximum number of idle controllers kept per cloud.
+DEFAULT_MAX_SIZE = 2
+# The juju client files that hold per-controller data.
+CONTROLLER_FILES = ['controllers.yaml', 'accounts.yaml',
+                    'bootstrap-config.yaml']
+
+
+class ControllerPool:
+    """A registry of idle controllers that later runs can lease.
+
+    The registry is a YAML file, normally kept under the juju home so that it
+    outlives the temporary JUJU_DATA of a run.  Each entry records the
+    controller name, the key it was bootstrapped with (cloud, constraints and
+    config), when it was released and the juju client data needed to use it
+    from another JUJU_DATA.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+
+    @contextmanager
+    def _registry(self):
+        """Lock the registry and yield its entries, saving them on exit."""
+        with open('{}.lock'.format(self.path), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path) as f:
+                        entries = yaml.safe_load(f) or []
+                except IOError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    entries = []
+                yield entries
+                tmp_path = '{}.{}'.format(self.path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    os.chmod(tmp_path, 0o600)
+                    yaml.safe_dump(entries, f, default_flow_style=False)
+                os.rename(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _expired(self, entry, now):
+        return now - entry['released'] > self.ttl
+
+    def lease(self, key):
+        """Remove and return the newest idle entry for key, or None."""
+        now = time()
+        with self._registry() as entries:
+            matches = [e for e in entries
+                       if e['key'] == key and not self._expired(e, now)]
+            if not matches:
+                return None
+            entry = max(matches, key=lambda e: e['released'])
+            entries.remove(entry)
+        logging.info('Leased controller {} from the pool.'.format(
+            entry['controller']))
+        return entry
+
+    def release(self, controller, key, data):
+        """Add an idle controller to the pool.
+
+        Return False if the pool is full for the controller's cloud or
+        already has a controller with that name.
+        """
+        with self._registry() as entries:
+            same_cloud = [e for e in entries
+                          if e['key']['cloud'] == key['cloud']]
+            if len(same_cloud) >= self.max_size:
+                return False
+            if any(e['controller'] == controller for e in entries):
+                return False
+            entries.append({'controller': controller, 'key': key,
+                            'released': time(), 'data': data})
+        logging.info('Returned controller {} to the pool.'.format(controller))
+        return True
+
+    def evict_expired(self):
+        """Remove and return the entries that outlived the TTL."""
+        now = time()
+        with self._registry() as entries:
+            expired = [e for e in entries if self._expired(e, now)]
+            for entry in expired:
+                entries.remove(entry)
+        return expired
+
+
+def export_controller(juju_home, controller):
+    """Return the client data of controller found in juju_home."""
+    data = {}
+    for name in CONTROLLER_FILES:
+        try:
+            with open(os.path.join(juju_home, name)) as f:
+                content = yaml.safe_load(f) or {}
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        details = content.get('controllers', {}).get(controller)
+        if details is not None:
+            data[name] = details
+    return data
+
+
+def import_controller(juju_home, controller, data):
+    """Register controller in juju_home using data from export_controller."""
+    for name, details in data.items():
+        path = os.path.join(juju_home, name)
+        try:
+            with open(path) as f:
+                content = yaml.safe_load(f) or {}
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            content = {}
+        content.setdefault('controllers', {})[controller] = details
+        with open(path, 'w') as f:
+            os.chmod(path, 0o600)
+            yaml.safe_dump(content, f, default_flow_style=False)
@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import os
+from time import time
+
+
+__metaclass__ = type
+
+# Weight of the newest bootstrap time in a region's running average.
+BOOTSTRAP_TIME_WEIGHT = 0.3
+# Seconds a region is tried last after a quota or capacity failure.
+CAPACITY_COOLDOWN = 30 * 60
+
+
+def get_default_stats_file():
+    return os.path.join(
+        os.environ.get('HOME', '/tmp'), '.cache', 'buildcloud',
+        'regions.json')
+
+
+class RegionStats:
+    """The bootstrap history of every cloud region, kept across runs.
+
+    The file holds, per region, a running average of the bootstrap time and
+    the time of the last quota or capacity failure.
+    """
+
+    def __init__(self, path, cooldown=CAPACITY_COOLDOWN):
+        self.path = path
+        self.cooldown = cooldown
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            pass
+        return {}
+
+    @contextmanager
+    def _update(self):
+        """Lock the stats and yield them, saving them on exit."""
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        with open('{}.lock'.format(self.path), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                stats = self.load()
+                yield stats
+                tmp_path = '{}.{}'.format(self.path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(stats, f, indent=2, sort_keys=True)
+                os.rename(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def record_bootstrap(self, cloud, duration):
+        with self._update() as stats:
+            entry = stats.setdefault(cloud, {})
+            average = entry.get('bootstrap_time')
+            if average is None:
+                average = duration
+            else:
+                average += BOOTSTRAP_TIME_WEIGHT * (duration - average)
+            entry['bootstrap_time'] = average
+            entry['bootstraps'] = entry.get('bootstraps', 0) + 1
+
+    def record_capacity_failure(self, cloud):
+        with self._update() as stats:
+            stats.setdefault(cloud, {})['capacity_failure'] = time()
+
+    def rank(self, clouds, in_use=None):
+        """Return clouds with the best region to bootstrap in first.
+
+        Regions that recently ran out of quota or capacity come last, then
+        the regions with the most bootstraps in progress (in_use maps a
+        cloud to that count).  The remaining ties go to the fastest
+        region.  The first, preferred, region is tried even without a
+        recorded bootstrap, but the other regions without one come after
+        those with one, so a run only moves to a region it has no history
+        of when the others cannot be used.  The original order breaks ties.
+        """
+        stats = self.load()
+        in_use = in_use or {}
+        now = time()
+
+        def key(cloud):
+            entry = stats.get(cloud, {})
+            failed = now - entry.get('capacity_failure', 0) < self.cooldown
+            bootstrap_time = entry.get('bootstrap_time')
+            unknown = bootstrap_time is None and cloud != clouds[0]
+            return (failed, in_use.get(cloud, 0), unknown,
+                    bootstrap_time or 0, clouds.index(cloud))
+
+        return sorted(clouds, key=key)
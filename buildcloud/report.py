@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+import json
+import os
+from threading import Lock
+from time import time
+
+
+__metaclass__ = type
+
+REPORT_FILE = 'run-report.json'
+
+
+class RunReport:
+    """Record the wall time of run phases and commands."""
+
+    def __init__(self):
+        self.started = time()
+        self.info = {}
+        self.phases = []
+        self.commands = []
+        self._lock = Lock()
+
+    @contextmanager
+    def phase(self, name, **details):
+        """Time the enclosed block as a phase called name.
+
+        The yielded dict is stored in the report, so callers can add details
+        to it or override its status.
+        """
+        record = dict(details, name=name, started=time(), status='ok')
+        try:
+            yield record
+        except BaseException:
+            record['status'] = 'error'
+            raise
+        finally:
+            record['duration'] = time() - record['started']
+            with self._lock:
+                self.phases.append(record)
+
+    def record_command(self, command, started, returncode, output_size,
+                       error_size):
+        record = {
+            'command': command if isinstance(command, str) else ' '.join(
+                command),
+            'started': started,
+            'duration': time() - started,
+            'returncode': returncode,
+            'output_size': output_size,
+            'error_size': error_size,
+        }
+        with self._lock:
+            self.commands.append(record)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'info': dict(self.info),
+                'started': self.started,
+                'duration': time() - self.started,
+                'phases': sorted(self.phases, key=lambda p: p['started']),
+                'commands': list(self.commands),
+            }
+
+    def write(self, directory):
+        """Write the report as JSON into directory and return its path."""
+        path = os.path.join(directory, REPORT_FILE)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        return path
+
+
+_report = RunReport()
+
+
+def get_report():
+    """Return the report of the current run."""
+    return _report
+
+
+def reset_report():
+    """Start a new report and return it."""
+    global _report
+    _report = RunReport()
+    return _report
+
+
+def phase(name, **details):
+    """Time a phase of the current run.  See RunReport.phase."""
+    return _report.phase(name, **details)
@@ -0,0 +1,133 @@
+from collections import namedtuple
+import os
+import re
+
+import yaml
+
+
+__metaclass__ = type
+
+ROUTES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'routes.yaml')
+# The types allowed for optional route keys.
+OPTIONAL_KEYS = {
+    'job': basestring,
+    'constraints': basestring,
+    'max_concurrency': int,
+    'regions': list,
+}
+
+Route = namedtuple(
+    'Route', ['pattern', 'cloud', 'job', 'constraints', 'max_concurrency',
+              'regions'])
+
+
+class InvalidRoutes(ValueError):
+    """A routing table that cannot be used."""
+
+
+def make_route(index, data):
+    if not isinstance(data, dict):
+        raise InvalidRoutes('route {}: not a mapping'.format(index))
+    for key in ('pattern', 'cloud'):
+        if not isinstance(data.get(key), basestring):
+            raise InvalidRoutes('route {}: missing {}'.format(index, key))
+    for key, types in OPTIONAL_KEYS.items():
+        if data.get(key) is not None and not isinstance(data[key], types):
+            raise InvalidRoutes('route {}: invalid {}'.format(index, key))
+    try:
+        pattern = re.compile(data['pattern'])
+    except re.error as e:
+        raise InvalidRoutes('route {}: invalid pattern: {}'.format(index, e))
+    if pattern.groupindex:
+        raise InvalidRoutes(
+            'route {}: named groups are not allowed'.format(index))
+    return Route(data['pattern'], data['cloud'], data.get('job'),
+                 data.get('constraints'), data.get('max_concurrency'),
+                 data.get('regions'))
+
+
+def get_clouds(route):
+    """Return the cloud/region names a controller of route may use.
+
+    Without regions, only the route's cloud is used.
+    """
+    if not route.regions:
+        return [route.cloud]
+    name = route.cloud.split('/')[0]
+    return ['{}/{}'.format(name, region) for region in route.regions]
+
+
+class RoutingTable:
+    """Find the route of a controller name.
+
+    All the patterns are compiled into a single regex whose alternatives
+    keep the order of the routes, so one match finds the first route that
+    applies.  Routes are memoized per name.
+    """
+
+    def __init__(self, routes):
+        self.routes = routes
+        self._regex = None
+        if routes:
+            # The lazy prefix lets an earlier alternative match anywhere in
+            # the name before a later one is tried.
+            self._regex = re.compile('|'.join(
+                '(?P<r{}>.*?(?:{}))'.format(i, route.pattern)
+                for i, route in enumerate(routes)))
+        self._cache = {}
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            data = yaml.safe_load(f) or {}
+        if not isinstance(data.get('routes'), list):
+            raise InvalidRoutes('{}: missing routes'.format(path))
+        return cls([make_route(i, route)
+                    for i, route in enumerate(data['routes'])])
+
+    def get_route(self, name):
+        """Return the Route of the controller name, or None."""
+        name = name.lower()
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        route = None
+        match = self._regex and self._regex.match(name)
+        if match:
+            route = self.routes[int(match.lastgroup[1:])]
+        self._cache[name] = route
+        return route
+
+    def get_max_concurrency(self):
+        """Return the max concurrency of the clouds that have one.
+
+        The limits are keyed by cloud name without the region, so that they
+        cover every region a route's controllers are bootstrapped in.
+        """
+        return dict((route.cloud.split('/')[0], route.max_concurrency)
+                    for route in self.routes
+                    if route.max_concurrency is not None)
+
+
+_table = None
+
+
+def get_routing_table():
+    """Return the routing table, loading ROUTES_FILE the first time."""
+    global _table
+    if _table is None:
+        _table = RoutingTable.from_file(ROUTES_FILE)
+    return _table
+
+
+def load_routing_table(path):
+    """Replace the routing table with the routes in path and return it."""
+    global _table
+    _table = RoutingTable.from_file(path)
+    return _table
+
+
+def get_route(name):
+    return get_routing_table().get_route(name)
@@ -1,19 +1,46 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+
 from argparse import ArgumentParser
 from collections import namedtuple
+from functools import partial
 import logging
 import os
+import re
+from threading import local
+from time import sleep
 from urllib2 import HTTPError
-import yaml
-
-from jenkins import Jenkins
-
-from utility import generate_test_id
 
+from jenkins import (
+    Jenkins,
+    JenkinsException,
+)
+
+from plan_index import (
+    get_default_index_file,
+    get_test_labels,
+    load_plan,
+    Plan,
+    PlanIndex,
+    select_plans,
+)
+from routes import (
+    get_route,
+    load_routing_table,
+)
+from utility import (
+    generate_test_id,
+    run_concurrently,
+)
+
+
+JENKINS_URL = 'http://juju-ci.vapour.ws:8080'
 
 Credentials = namedtuple('Credentials', ['user', 'password'])
 
+Job = namedtuple('Job', ['name', 'parameters'])
+
 
 def parse_args(argv=None):
     parser = ArgumentParser()
@@ -32,6 +59,25 @@ def parse_args(argv=None):
         help='List of test plan files.  Instead of scheduling all the tests, '
              'this can be use to restrict the test plan files. If this is '
              'not set, all the test will be scheduled.')
+    parser.add_argument(
+        '--label', help='Only schedule the test plans with this test label.')
+    parser.add_argument(
+        '--benchmark', action='store_true',
+        help='Only schedule the test plans that have a benchmark.')
+    parser.add_argument(
+        '--plan-index', default=get_default_index_file(),
+        help='File that caches the parsed test plans.')
+    parser.add_argument(
+        '--routes',
+        help='YAML file routing controller names to clouds and Jenkins jobs.')
+    parser.add_argument(
+        '--jenkins-url', default=JENKINS_URL, help='Jenkins server URL.')
+    parser.add_argument(
+        '--concurrency', type=int, default=4,
+        help='Number of jobs to submit to Jenkins at the same time.')
+    parser.add_argument(
+        '--retries', type=int, default=3,
+        help='Number of times to retry a job after a transient HTTP error.')
     args = parser.parse_args(argv)
     if not args.cwr_test_token:
         parser.error("Please set the cwr-test Jenkins job token by "
@@ -39,9 +85,9 @@ def parse_args(argv=None):
     return args
 
 
-def make_parameters(test_plan, controller, test_id):
-    with open(test_plan, 'r') as f:
-        plan = yaml.load(f)
+def make_parameters(test_plan, controller, test_id, plan=None):
+    if plan is None:
+        plan = load_test_plan(test_plan)
     parameters = {
         'test_plan': test_plan,
         'controllers': controller,
@@ -59,17 +105,14 @@ def make_parameters(test_plan, controller, test_id):
 
 
 def get_test_plans(args):
-    test_plans = args.test_plans or os.listdir(args.test_plan_dir)
-    for test_plan in test_plans:
-        if not test_plan.endswith('.yaml'):
-            continue
-        test_plan = os.path.join(args.test_plan_dir, test_plan)
-        yield test_plan
+    """Return the selected Plans of the test plan directory."""
+    index = PlanIndex(args.test_plan_dir, args.plan_index)
+    plans = index.load(args.test_plans)
+    return select_plans(plans, label=args.label, benchmark=args.benchmark)
 
 
 def load_test_plan(test_plan):
-    with open(test_plan) as f:
-        return yaml.safe_load(f)
+    return load_plan(test_plan)
 
 
 def get_credentials(args):
@@ -80,42 +123,110 @@ def get_credentials(args):
 
 
 def get_job_name(controller):
-    controller = controller.lower()
-    if 'aws' in controller:
-        return 'cwr-aws'
-    if 'gce' in controller:
-        return 'cwr-gce'
-    if 'joyent' in controller:
-        return 'cwr-joyent'
-    if 'azure' in controller:
-        return 'cwr-azure'
-    if 'power8' in controller or 'borbein-maas' in controller:
-        return 'cwr-maas-power8'
-    if 'ob-maas' in controller or 'maas-ob' in controller:
-        return 'cwr-maas-ob'
-    raise Exception('Unknown Jenkins job name requested')
+    route = get_route(controller)
+    if route is None or route.job is None:
+        raise Exception('Unknown Jenkins job name requested')
+    return route.job
+
+
+def make_jobs(test_plans, controllers):
+    """Return the Jobs to build for the Plans in test_plans."""
+    jobs = []
+    for plan in test_plans:
+        if isinstance(plan, basestring):
+            plan = Plan(plan, load_test_plan(plan))
+        test_id = generate_test_id()
+        for controller in get_test_labels(plan) or controllers:
+            job_name = get_job_name(controller)
+            parameters = make_parameters(
+                plan.path, controller, test_id, plan=plan.data)
+            jobs.append(Job(job_name, parameters))
+    return jobs
+
+
+class JenkinsPool:
+    """Give each thread its own Jenkins client.
+
+    A client keeps its HTTP connection alive between requests, so every
+    worker reuses one connection for all the jobs it submits.
+    """
+
+    def __init__(self, url, credentials):
+        self.url = url
+        self.credentials = credentials
+        self._local = local()
+
+    def get(self):
+        jenkins = getattr(self._local, 'jenkins', None)
+        if jenkins is None:
+            jenkins = Jenkins(self.url, *self.credentials)
+            self._local.jenkins = jenkins
+        return jenkins
+
+
+def get_http_status(error):
+    status = getattr(error, 'code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code',
+                         None)
+    if status is None and isinstance(error, JenkinsException):
+        match = re.search(r'\[(\d{3})\]', str(error))
+        if match:
+            status = int(match.group(1))
+    return status
+
+
+def is_transient(error):
+    """Return True if retrying the request that raised error may succeed."""
+    status = get_http_status(error)
+    if status is None:
+        # Connection errors have no status.
+        return not isinstance(error, JenkinsException)
+    return status >= 500 or status == 429
+
+
+def build_job(pool, job, token, retries=0, backoff=1):
+    """Submit job, retrying transient errors.  Return True on success."""
+    for attempt in range(retries + 1):
+        try:
+            pool.get().build_job(job.name, job.parameters, token=token)
+            return True
+        except (HTTPError, IOError, JenkinsException) as e:
+            if attempt == retries or not is_transient(e):
+                logging.error('Can not build {}: {}'.format(job.name, e))
+                return False
+            delay = backoff * 2 ** attempt
+            logging.warning('Retrying {} in {} seconds: {}'.format(
+                job.name, delay, e))
+            sleep(delay)
 
 
 def build_jobs(credentials, test_plans, args):
-    jenkins = Jenkins('http://juju-ci.vapour.ws:8080', *credentials)
-    for test_plan in test_plans:
-        test_id = generate_test_id()
-        test_plan_content = load_test_plan(test_plan)
-        test_label = test_plan_content.get('test_label')
-        if test_label and isinstance(test_label, str):
-            test_label = [test_label]
-        for controller in test_label or args.controllers:
-            job_name = get_job_name(controller)
-            parameter = make_parameters(test_plan, controller, test_id)
-            try:
-                jenkins.build_job(
-                    job_name, parameter, token=args.cwr_test_token)
-            except HTTPError:
-                logging.error('Can not build {}'.format(job_name))
+    jobs = make_jobs(test_plans, args.controllers)
+    pool = JenkinsPool(args.jenkins_url, credentials)
+    results = run_concurrently(
+        partial(build_job, pool, token=args.cwr_test_token,
+                retries=args.retries),
+        jobs, args.concurrency)
+    failed = []
+    for job, built, error in results:
+        if error is not None:
+            logging.error('Can not build {}: {}'.format(job.name, error))
+        if not built:
+            failed.append(job)
+    print('Scheduled {} of {} jobs.'.format(len(jobs) - len(failed),
+                                            len(jobs)))
+    for job in failed:
+        print('Failed: {} {} {}'.format(
+            job.name, job.parameters['controllers'],
+            job.parameters['test_plan']))
+    return failed
 
 
 def main():
     args = parse_args()
+    if args.routes:
+        load_routing_table(args.routes)
     credentials = get_credentials(args)
     test_plans = get_test_plans(args)
     build_jobs(credentials, test_plans, args)
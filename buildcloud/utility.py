@@ -1,19 +1,46 @@
 from __future__ import print_function
 
+from collections import deque
 from contextlib import contextmanager
 import errno
+from fnmatch import fnmatch
 import logging
 import os
+from Queue import (
+    Empty,
+    Queue,
+)
 from shutil import (
-    copytree,
+    copy2,
     rmtree,
 )
 import subprocess
+import sys
+from threading import (
+    BoundedSemaphore,
+    Event,
+    Lock,
+    Thread,
+    Timer,
+)
 from time import time
-from tempfile import mkdtemp
+from tempfile import (
+    mkdtemp,
+    SpooledTemporaryFile,
+)
 import uuid
 import yaml
 
+# Implicit relative imports, like schedule_cwr_jobs, so that the modules it
+# uses still import when it is run as a script.
+from report import get_report
+from routes import get_route
+
+# Command output larger than this is spooled to a temporary file.
+OUTPUT_SPOOL_SIZE = 1024 * 1024
+# Number of stderr lines kept for the CalledProcessError of a failed command.
+STDERR_TAIL_LINES = 1000
+
 
 @contextmanager
 def temp_dir(parent=None):
@@ -24,7 +51,7 @@ def temp_dir(parent=None):
         try:
             rmtree(directory)
         except OSError:
-            run_command('sudo rm -rf {}'.format(directory))
+            run_command(['sudo', 'rm', '-rf', directory])
 
 
 def configure_logging(log_level):
@@ -43,29 +70,303 @@ def ensure_dir(path, parent=None):
             raise
 
 
-def run_command(command, verbose=True):
-    """Execute a command and maybe print the output."""
-    if isinstance(command, str):
-        command = command.split()
+def run_command(command, verbose=True, timeout=None, keep_output=True):
+    """Execute the argv list command and maybe print the output.
+
+    stdout is logged as it is produced.  It is returned as a string unless
+    keep_output is False, in which case it is discarded and None is
+    returned; large outputs are spooled to a temporary file while the
+    command runs.  stderr is read concurrently and written through to
+    sys.stderr; its tail is attached to the CalledProcessError raised when
+    the command fails.
+
+    If timeout is set, the command is killed after that many seconds and a
+    CalledProcessError is raised.
+    """
+    command, proc = _start_command(command, verbose)
+    return _communicate(proc, command, timeout, keep_output)
+
+
+def run_command_async(command, verbose=True, timeout=None, keep_output=True):
+    """Start a command in the background and return a CommandFuture.
+
+    The arguments are the same as for run_command.
+    """
+    return CommandFuture(command, verbose=verbose, timeout=timeout,
+                         keep_output=keep_output)
+
+
+def _start_command(command, verbose=True):
     if verbose:
         logging.info('Executing: {}'.format(command))
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
-    output = ''
-    while proc.poll() is None:
+    proc = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return command, proc
+
+
+def _communicate(proc, command, timeout=None, keep_output=True):
+    started = time()
+    timer = None
+    if timeout is not None:
+        timer = Timer(timeout, _kill_process, [proc, command, timeout])
+        timer.daemon = True
+        timer.start()
+    error_lines = deque(maxlen=STDERR_TAIL_LINES)
+    error_size = []
+
+    def echo_error(line):
+        # Pass stderr through, as if it were inherited, and keep its tail.
+        sys.stderr.write(line)
+        error_lines.append(line)
+
+    error_reader = Thread(
+        target=lambda: error_size.append(
+            _read_stream(proc.stderr, echo_error, log=False)))
+    error_reader.daemon = True
+    error_reader.start()
+    output = None
+    output_size = None
+    if keep_output:
+        output = SpooledTemporaryFile(max_size=OUTPUT_SPOOL_SIZE)
+    try:
+        output_size = _read_stream(
+            proc.stdout, output.write if output else None)
+        proc.wait()
+        while error_reader.is_alive():
+            error_reader.join(1)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        get_report().record_command(
+            command, started, proc.returncode, output_size,
+            error_size[0] if error_size else None)
+    if proc.returncode != 0:
+        if output is not None:
+            output.close()
+        error = ''.join(error_lines)
+        logging.error('Command failed with exit status {}: {}'.format(
+            proc.returncode, command))
+        e = subprocess.CalledProcessError(proc.returncode, command, error)
+        e.stderr = error
+        raise e
+    if output is None:
+        return None
+    output.seek(0)
+    try:
+        return output.read()
+    finally:
+        output.close()
+
+
+class CommandCancelled(Exception):
+    """Raised by CommandFuture.result when the command was cancelled."""
+
+
+class CommandTimeout(Exception):
+    """Raised when a CommandFuture does not finish in time."""
+
+
+class CommandFuture:
+    """The pending result of a command running in a background thread."""
+
+    def __init__(self, command, verbose=True, timeout=None, keep_output=True,
+                 semaphore=None):
+        self.command = command
+        self._proc = None
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+        self._lock = Lock()
+        self._done = Event()
+        thread = Thread(target=self._run,
+                        args=(verbose, timeout, keep_output, semaphore))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, verbose, timeout, keep_output, semaphore):
+        try:
+            if semaphore is not None:
+                semaphore.acquire()
+            try:
+                with self._lock:
+                    if self._cancelled:
+                        raise CommandCancelled(self.command)
+                    command, self._proc = _start_command(
+                        self.command, verbose)
+                self._result = _communicate(
+                    self._proc, command, timeout, keep_output)
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+        except subprocess.CalledProcessError as e:
+            if self._cancelled:
+                e = CommandCancelled(self.command)
+            self._exception = e
+        except Exception as e:
+            self._exception = e
+        finally:
+            self._done.set()
+
+    def cancel(self):
+        """Cancel the command, killing it if it is already running."""
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._cancelled = True
+            if self._proc is not None:
+                try:
+                    self._proc.kill()
+                except OSError:
+                    # The process exited before it could be killed.
+                    pass
+        return True
+
+    def cancelled(self):
+        return self._cancelled and self._done.is_set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the command to finish.  Return True if it finished."""
+        deadline = None if timeout is None else time() + timeout
+        while not self._done.is_set():
+            remaining = 1 if deadline is None else min(1, deadline - time())
+            if remaining <= 0:
+                break
+            # Wait in short steps so signal handlers still run.
+            self._done.wait(remaining)
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise CommandTimeout(self.command)
+        return self._exception
+
+    def result(self, timeout=None):
+        """Return the command output or raise the command's exception."""
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+
+class CommandRunner:
+    """Run many commands in the background, max_workers at a time."""
+
+    def __init__(self, max_workers=4):
+        self._semaphore = BoundedSemaphore(max_workers)
+        self._futures = []
+        self._lock = Lock()
+
+    def submit(self, command, verbose=True, timeout=None, keep_output=True):
+        """Queue a command and return its CommandFuture."""
+        future = CommandFuture(
+            command, verbose=verbose, timeout=timeout,
+            keep_output=keep_output, semaphore=self._semaphore)
+        with self._lock:
+            self._futures = [f for f in self._futures if not f.done()]
+            self._futures.append(future)
+        return future
+
+    def run_all(self, commands, timeout=None, return_exceptions=False):
+        """Run commands and return their outputs in the same order.
+
+        The first failure is raised once every command has finished, unless
+        return_exceptions is True, in which case exceptions are returned in
+        place of the outputs.
+        """
+        futures = [self.submit(c, timeout=timeout) for c in commands]
+        results = []
+        for future in futures:
+            exception = future.exception()
+            results.append(future._result if exception is None else exception)
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def cancel_all(self):
+        """Cancel every command that has not finished."""
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+
+def _read_stream(stream, sink=None, log=True):
+    """Pass every line of stream to sink, until EOF.
+
+    The lines are also logged at INFO level if log is set.  Return the number
+    of bytes read.
+    """
+    log_lines = log and logging.getLogger().isEnabledFor(logging.INFO)
+    size = 0
+    while True:
         try:
-            for status in proc.stdout:
-                logging.info(status.rstrip())
-                output += status
+            for line in iter(stream.readline, ''):
+                size += len(line)
+                if log_lines:
+                    logging.info(line.rstrip())
+                if sink is not None:
+                    sink(line)
+            return size
         except IOError:
             # SIGTERM/SIGINT generates io error
             pass
-    if proc.returncode != 0 and proc.returncode is not None:
-        output, error = proc.communicate()
-        logging.info("ERROR: run_command failed: {}".format(error))
-        e = subprocess.CalledProcessError(proc.returncode, command, error)
-        e.stderr = error
-        raise e
-    return output
+
+
+def _kill_process(proc, command, timeout):
+    logging.error('Command timed out after {} seconds: {}'.format(
+        timeout, command))
+    try:
+        proc.kill()
+    except OSError:
+        # The process exited before it could be killed.
+        pass
+
+
+def run_concurrently(func, items, max_workers=1):
+    """Call func with each item using up to max_workers threads.
+
+    Return a list of (item, result, exception) tuples in the order of items.
+    Exceptions raised by func are captured rather than propagated so that one
+    failing item does not stop the others.  A max_workers of None or less than
+    1 uses one thread per item.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[index] = (item, func(item), None)
+            except Exception as e:
+                results[index] = (item, None, e)
+
+    if max_workers is None or max_workers < 1:
+        max_workers = len(items)
+    if max_workers == 1 or len(items) <= 1:
+        worker()
+        return results
+    threads = [Thread(target=worker) for _ in range(min(max_workers,
+                                                        len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Join with a timeout so signal handlers still run in the main thread.
+        while thread.is_alive():
+            thread.join(1)
+    return results
 
 
 def get_juju_home():
@@ -75,10 +376,115 @@ def get_juju_home():
     return home
 
 
-def copytree_force(src, dst, ignore=None):
-    if os.path.exists(dst):
-        rmtree(dst)
-    copytree(src, dst, ignore=ignore)
+def copytree_force(src, dst, ignore=None, keep=None):
+    """Make dst a copy of src, like copytree over a removed dst.
+
+    Only files whose size or modification time differ are copied, and
+    anything in dst that is not in src (or is ignored) is removed, unless
+    keep, called like ignore with dst and the names to remove, returns it.
+    """
+    names = os.listdir(src)
+    ignored = ignore(src, names) if ignore else set()
+    names = [n for n in names if n not in ignored]
+    if os.path.lexists(dst) and not os.path.isdir(dst):
+        os.remove(dst)
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+    for name in names:
+        src_path = os.path.join(src, name)
+        dst_path = os.path.join(dst, name)
+        if os.path.isdir(src_path):
+            copytree_force(src_path, dst_path, ignore=ignore, keep=keep)
+            continue
+        if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+            rmtree(dst_path)
+        if not _same_file_stat(src_path, dst_path):
+            copy2(src_path, dst_path)
+    extra = set(os.listdir(dst)) - set(names)
+    if keep:
+        extra -= set(keep(dst, list(extra)))
+    for name in extra:
+        path = os.path.join(dst, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            rmtree(path)
+        else:
+            os.remove(path)
+
+
+def merge_tree(src, dst):
+    """Copy the files in src into dst, replacing files that exist."""
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+    for name in os.listdir(src):
+        src_path = os.path.join(src, name)
+        dst_path = os.path.join(dst, name)
+        if os.path.isdir(src_path):
+            merge_tree(src_path, dst_path)
+        else:
+            copy2(src_path, dst_path)
+
+
+def _same_file_stat(src, dst):
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    src_stat = os.stat(src)
+    return (src_stat.st_size == dst_stat.st_size and
+            int(src_stat.st_mtime) == int(dst_stat.st_mtime))
+
+
+def link_tree(src, dst, mutable=(), exclude=(), include=None):
+    """Recreate src at dst, hard linking files instead of copying them.
+
+    Paths matching a pattern in mutable are copied so that writes to them
+    do not change src, paths matching exclude are skipped and, if include is
+    set, only paths matching it are taken.  Patterns are matched with
+    fnmatch against both the path relative to src and its basename.  Files
+    that cannot be linked, e.g. across file systems, are copied.
+    """
+    def matches(rel_path, patterns):
+        basename = os.path.basename(rel_path)
+        return any(fnmatch(rel_path, p) or fnmatch(basename, p)
+                   for p in patterns)
+
+    os.makedirs(dst)
+    for root, dirs, files in os.walk(src, followlinks=True):
+        rel_root = os.path.relpath(root, src)
+        rel_root = '' if rel_root == '.' else rel_root
+        copy_all = bool(rel_root) and matches(rel_root, mutable)
+        for name in list(dirs):
+            rel_path = os.path.join(rel_root, name)
+            if matches(rel_path, exclude):
+                dirs.remove(name)
+                continue
+            os.mkdir(os.path.join(dst, rel_path))
+        for name in files:
+            rel_path = os.path.join(rel_root, name)
+            if matches(rel_path, exclude):
+                continue
+            if include is not None and not matches(rel_path, include):
+                continue
+            src_path = os.path.join(src, rel_path)
+            dst_path = os.path.join(dst, rel_path)
+            if (copy_all or matches(rel_path, mutable) or
+                    os.path.islink(src_path)):
+                copy2(src_path, dst_path)
+                continue
+            try:
+                os.link(src_path, dst_path)
+            except OSError:
+                copy2(src_path, dst_path)
+
+
+def load_patterns(path):
+    """Return the patterns listed in a manifest file, one per line.
+
+    Blank lines and lines starting with # are ignored.
+    """
+    with open(path) as f:
+        lines = (line.strip() for line in f)
+        return [line for line in lines if line and not line.startswith('#')]
 
 
 def generate_controller_names(controllers):
@@ -102,38 +508,14 @@ def rename_env(from_env, to_env, env_path):
     return new_env
 
 
-def juju_run(command, args='', e=''):
-    e = '-e {}'.format(e) if e else e
-    return run_command('juju {} {} {}'.format(command, e, args))
-
-
-def juju_status(e=''):
-    return juju_run('status', e=e)
-
-
 def generate_test_id():
     return uuid.uuid4().hex
 
 
 def cloud_from_env(env):
-    env = env.lower()
-    if 'aws' in env:
-        if 'china' in env:
-            return 'aws-china'
-        return 'aws/sa-east-1'
-    if 'azure' in env:
-        return 'azure/northeurope'
-    if 'gce' in env or 'google' in env:
-        return 'google/europe-west1'
-    if 'joyent' in env:
-        return 'joyent/us-sw-1'
-    if 'power8' in env or 'borbein-maas' in env:
-        return 'borbein-maas'
-    if 'ob-maas' in env or 'maas-ob' in env:
-        return 'ob-maas'
-    if 'prodstack' in env:
-        return 'prodstack45'
-    return None
+    """Return the cloud of the controller env, or None if it has no route."""
+    route = get_route(env)
+    return None if route is None else route.cloud
 
 
 def get_temp_controller_name(controller_name):
@@ -0,0 +1,129 @@
+import json
+import os
+from StringIO import StringIO
+
+from mock import patch
+
+from buildcloud.benchmarks import (
+    BenchmarkResult,
+    BenchmarkStore,
+    collect_results,
+    compare,
+    main,
+    parse_report,
+)
+from buildcloud.utility import temp_dir
+from tests import TestCase
+
+
+def make_report(test_id, value, cloud='aws', direction='desc'):
+    return {
+        'test_id': test_id,
+        'date': '2017-01-0{}T00:00:00'.format(test_id),
+        'bundle': {'name': 'hadoop-kafka'},
+        'results': [{
+            'provider_name': cloud,
+            'duration': 60.0,
+            'benchmarks': [{
+                'name': 'terasort',
+                'units': 'secs',
+                'direction': direction,
+                'data': [{'test_id': '0', 'provider_name': cloud,
+                          'value': 1},
+                         {'test_id': test_id, 'provider_name': cloud,
+                          'value': value}],
+            }],
+        }],
+    }
+
+
+def make_result(test_id, value, direction='desc'):
+    return BenchmarkResult(
+        date=None, test_id=test_id, cloud='aws', bundle='hadoop-kafka',
+        benchmark='terasort', value=value, units='secs', direction=direction,
+        duration=None)
+
+
+class TestBenchmarks(TestCase):
+
+    def test_parse_report(self):
+        results = parse_report(make_report('1', '12.5'))
+        self.assertEqual(results, [BenchmarkResult(
+            date='2017-01-01T00:00:00', test_id='1', cloud='aws',
+            bundle='hadoop-kafka', benchmark='terasort', value=12.5,
+            units='secs', direction='desc', duration=60.0)])
+
+    def test_parse_report_value(self):
+        report = make_report('1', None)
+        report['results'][0]['benchmarks'].append(
+            {'name': 'svdplusplus', 'value': 3})
+        results = parse_report(report)
+        self.assertEqual([(r.benchmark, r.value) for r in results],
+                         [('svdplusplus', 3.0)])
+        self.assertEqual(parse_report({'test_id': '1'}), [])
+
+    def test_collect_results(self):
+        with temp_dir() as results_dir:
+            run_dir = os.path.join(results_dir, 'hadoop-kafka', '1')
+            os.makedirs(run_dir)
+            with open(os.path.join(run_dir, 'report.json'), 'w') as f:
+                json.dump(make_report('1', 10), f)
+            with open(os.path.join(results_dir, 'index.json'), 'w') as f:
+                f.write('[]')
+            with open(os.path.join(results_dir, 'broken.json'), 'w') as f:
+                f.write('{')
+            results = collect_results(results_dir)
+        self.assertEqual([(r.test_id, r.value) for r in results],
+                         [('1', 10.0)])
+
+    def test_store(self):
+        with temp_dir() as tmp:
+            store = BenchmarkStore(os.path.join(tmp, 'benchmarks.csv'))
+            self.assertEqual(store.load(), [])
+            added = store.add([make_result('1', 10), make_result('2', 11)])
+            self.assertEqual(len(added), 2)
+            self.assertEqual(store.add([make_result('2', 11)]), [])
+            loaded = store.load()
+        self.assertEqual([(r.test_id, r.value) for r in loaded],
+                         [('1', 10.0), ('2', 11.0)])
+        self.assertIsNotNone(loaded[0].date)
+        self.assertIsNone(loaded[0].duration)
+
+    def test_compare(self):
+        results = [make_result(str(i), 10) for i in range(5)]
+        results.append(make_result('5', 12))
+        comparisons = compare(results, '5', window=3)
+        self.assertEqual(len(comparisons), 1)
+        self.assertEqual(comparisons[0].baseline, 10)
+        self.assertAlmostEqual(comparisons[0].change, 0.2)
+        self.assertTrue(comparisons[0].regression)
+        comparisons = compare(results, '5', threshold=0.5)
+        self.assertFalse(comparisons[0].regression)
+
+    def test_compare_direction(self):
+        results = [make_result('1', 10, 'asc'), make_result('2', 8, 'asc')]
+        self.assertTrue(compare(results, '2')[0].regression)
+        results = [make_result('1', 10, 'asc'), make_result('2', 12, 'asc')]
+        self.assertFalse(compare(results, '2')[0].regression)
+        comparison = compare(results, '1')[0]
+        self.assertIsNone(comparison.baseline)
+        self.assertFalse(comparison.regression)
+
+    def test_main(self):
+        with temp_dir() as tmp:
+            store = os.path.join(tmp, 'benchmarks.csv')
+            for test_id, value in [('1', 10), ('2', 10), ('3', 20)]:
+                run_dir = os.path.join(tmp, test_id)
+                os.mkdir(run_dir)
+                with open(os.path.join(run_dir, 'report.json'), 'w') as f:
+                    json.dump(make_report(test_id, value), f)
+                self.assertEqual(main(['ingest', store, run_dir]), 0)
+            with patch('sys.stdout', new_callable=StringIO) as out:
+                self.assertEqual(main(['compare', store, '2']), 0)
+                self.assertEqual(main(['compare', store, '3']), 1)
+                self.assertEqual(main(['compare', store, '4']), 1)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'aws hadoop-kafka terasort 2: 10 secs '
+                                   'baseline 10 (+0.0%)')
+        self.assertTrue(lines[1].endswith('(+100.0%) REGRESSION'))
+        self.assertEqual(lines[2], 'No benchmark results for 4.')
@@ -1,4 +1,7 @@
+from contextlib import contextmanager
 import os
+import signal
+from subprocess import CalledProcessError
 from argparse import Namespace
 from unittest import TestCase
 
@@ -10,13 +13,38 @@ from mock import (
 )
 
 from buildcloud.build_cloud import (
+    CleanupCoordinator,
     CONTAINER_NAME,
+    env,
     get_cwr_options,
+    get_test_plans,
+    load_model_limits,
+    make_journal,
+    make_log_options,
+    make_plan_run,
     run_test,
+    run_tests,
+    run_test_pipelined,
+    set_signal,
     run_test_with_container,
     run_test_without_container,
     parse_args,
+    run_plans,
+    store_benchmarks,
+    tests_finished,
+    wait_for_models,
+    write_report,
 )
+from buildcloud.journal import JOURNAL_FILE
+from buildcloud.juju import LogOptions
+from buildcloud.plan_index import get_default_index_file
+from buildcloud.regions import get_default_stats_file
+from buildcloud.report import reset_report
+from buildcloud.routes import (
+    Route,
+    RoutingTable,
+)
+from buildcloud.utility import temp_dir
 from tests.common_test import (
     setup_test_logging,
 )
@@ -38,20 +66,49 @@ class TestCloudBuild(TestCase):
         build_number = os.environ.get('BUILD_NUMBER', '')
         os.environ['BUILD_NUMBER'] = "1234"
         args = parse_args(['cwr-model', 'test-plan'])
-        expected = Namespace(bootstrap_constraints=None,
+        expected = Namespace(bootstrap_concurrency=1,
+                             bootstrap_constraints=None,
                              bucket=None,
                              bundle_file='',
                              config='test-mode=true',
                              constraints='mem=3G',
                              controllers=['cwr-model'],
+                             controller_pool=False,
                              controllers_bootstrapped=False,
                              cwr_path=None,
+                             destroy_concurrency=1,
+                             image_cache=None,
+                             image_digest=None,
+                             image_max_age=24,
                              juju_home='/tmp/home/cloud-city',
+                             juju_home_exclude=None,
+                             juju_home_include=None,
                              juju_path='juju',
+                             kill_timeout=None,
+                             log_concurrency=8,
                              log_dir=None,
                              no_container=False,
+                             benchmark_store=None,
+                             pipeline=False,
+                             wait_timeout=None,
+                             test_plans=None,
+                             plan_concurrency=1,
+                             plan_index=get_default_index_file(),
+                             model_limits=None,
+                             compress_logs=False,
+                             log_file_cap=None,
+                             log_run_cap=None,
+                             logs_since_bootstrap=False,
+                             pool_size=2,
+                             pool_ttl=4,
                              results_dir=None,
                              results_per_bundle=None,
+                             region_stats=get_default_stats_file(),
+                             bootstrap_retries=2,
+                             bootstrap_backoff=30,
+                             interrupt_log_timeout=120,
+                             resume=False,
+                             routes=None,
                              s3_creds=None,
                              test_id='1234',
                              test_plan='test-plan',
@@ -60,6 +117,78 @@ class TestCloudBuild(TestCase):
         self.assertEqual(args, expected)
         os.environ['BUILD_NUMBER'] = build_number
 
+    def test_env(self):
+        with temp_dir() as juju_home:
+            for name in ['staging-juju-rsa', 'credentials.yaml',
+                         'cwr-pool.yaml', 'old.log']:
+                with open(os.path.join(juju_home, name), 'w') as f:
+                    f.write(name)
+            exclude = os.path.join(juju_home, 'exclude')
+            with open(exclude, 'w') as f:
+                f.write('*.log\n')
+            args = parse_args(['cwr-aws', 'test-plan', '--juju-home',
+                               juju_home, '--juju-home-exclude', exclude])
+            with env(args) as (host, container):
+                names = sorted(os.listdir(host.tmp_juju_home))
+                rsa_linked = (
+                    os.stat(os.path.join(juju_home,
+                                         'staging-juju-rsa')).st_ino ==
+                    os.stat(os.path.join(host.tmp_juju_home,
+                                         'staging-juju-rsa')).st_ino)
+                yaml_linked = (
+                    os.stat(os.path.join(juju_home,
+                                         'credentials.yaml')).st_ino ==
+                    os.stat(os.path.join(host.tmp_juju_home,
+                                         'credentials.yaml')).st_ino)
+                self.assertTrue(os.path.isfile(
+                    os.path.join(host.ssh_path, 'id_rsa')))
+        self.assertEqual(names, ['credentials.yaml', 'exclude',
+                                 'staging-juju-rsa'])
+        self.assertTrue(rsa_linked)
+        self.assertFalse(yaml_linked)
+        self.assertEqual(host.controllers, ['cwr-aws'])
+
+    def test_write_report(self):
+        self.addCleanup(reset_report)
+        report = reset_report()
+        with temp_dir() as log_dir:
+            args = parse_args(['cwr-aws', 'test-plan', '--test-id', '3',
+                               '--log-dir', log_dir])
+            write_report(args)
+            self.assertEqual(os.listdir(log_dir), ['run-report.json'])
+        self.assertEqual(report.info, {'controllers': ['cwr-aws'],
+                                       'test_plan': 'test-plan',
+                                       'test_id': '3'})
+
+    def test_write_report_creates_log_dir(self):
+        self.addCleanup(reset_report)
+        reset_report()
+        with temp_dir() as parent:
+            log_dir = os.path.join(parent, 'logs')
+            write_report(parse_args(['cwr-aws', 'test-plan', '--log-dir',
+                                     log_dir]))
+            self.assertEqual(os.listdir(log_dir), ['run-report.json'])
+
+    def test_write_report_error(self):
+        self.addCleanup(reset_report)
+        reset_report()
+        with temp_dir() as parent:
+            log_dir = os.path.join(parent, 'logs')
+            with open(log_dir, 'w'):
+                pass
+            with patch('logging.error', autospec=True) as le_mock:
+                write_report(parse_args(['cwr-aws', 'test-plan',
+                                         '--log-dir', log_dir]))
+        self.assertIn('Could not write the run report',
+                      le_mock.call_args[0][0])
+
+    def test_write_report_no_log_dir(self):
+        args = parse_args(['cwr-aws', 'test-plan'])
+        with patch('buildcloud.build_cloud.get_report',
+                   autospec=True) as gr_mock:
+            write_report(args)
+        self.assertFalse(gr_mock.called)
+
     def get_args(self):
         return Namespace(env='juju-env')
 
@@ -68,7 +197,7 @@ class TestCloudBuild(TestCase):
         host = Mock(test_results='/foo')
         container = Mock(home='/home')
         options = get_cwr_options(args, host)
-        expected = '--results-dir /foo --s3-private'
+        expected = ['--results-dir', '/foo', '--s3-private']
         self.assertEqual(options, expected)
 
         args = parse_args(['controller', 'test-plan',
@@ -76,8 +205,8 @@ class TestCloudBuild(TestCase):
                            '--bucket', 'bar',
                            '--s3-creds', '/bar/baz.cfg'])
         options = get_cwr_options(args, host, container=container)
-        expected = ("--results-dir foo/dir --bucket bar --s3-creds "
-                    "/home/baz.cfg --s3-private")
+        expected = ['--results-dir', 'foo/dir', '--bucket', 'bar',
+                    '--s3-creds', '/home/baz.cfg', '--s3-private']
         self.assertEqual(options, expected)
 
     def test_run_test_without_container(self):
@@ -87,8 +216,9 @@ class TestCloudBuild(TestCase):
             host = Mock(test_results='/test_results')
             run_test_without_container(host, args, ['cntr1', 'cntr2'])
         rc_mock.assert_called_once_with(
-            'cwr -F -l DEBUG -v cntr1 cntr2 test-plan --test-id 2 '
-            '--results-dir /test_results --s3-private')
+            ['cwr', '-F', '-l', 'DEBUG', '-v', 'cntr1', 'cntr2', 'test-plan',
+             '--test-id', '2', '--results-dir', '/test_results',
+             '--s3-private'], keep_output=False)
 
     def test_run_test_without_container_non_default(self):
         args = parse_args(['controller', 'test-plan',
@@ -104,9 +234,10 @@ class TestCloudBuild(TestCase):
             host = Mock(test_results='/test_results')
             run_test_without_container(host, args, ['cntr1', 'cntr2'])
         rc_mock.assert_called_once_with(
-            'python cwr/run.py -F -l DEBUG -v cntr1 cntr2 test-plan '
-            '--test-id 2 --bundle foo --results-dir foo/dir '
-            '--bucket my-bucket --s3-creds /baz/creds --s3-private')
+            ['python', 'cwr/run.py', '-F', '-l', 'DEBUG', '-v', 'cntr1',
+             'cntr2', 'test-plan', '--test-id', '2', '--bundle', 'foo',
+             '--results-dir', 'foo/dir', '--bucket', 'my-bucket',
+             '--s3-creds', '/baz/creds', '--s3-private'], keep_output=False)
 
     def test_run_test_with_container(self):
         args = parse_args(['controller', '/test/test-plan', '--test-id', '2',
@@ -130,9 +261,12 @@ class TestCloudBuild(TestCase):
                              )
             name = PropertyMock(return_value='cwrbox')
             type(container).name = name
-            run_test_with_container(host, container, args, ['cntr1', 'cntr2'])
+            image = Mock(spec=['wait'])
+            image.wait.return_value = 'cwrbox@sha256:1234'
+            run_test_with_container(host, container, args, ['cntr1', 'cntr2'],
+                                    image=image)
+        image.wait.assert_called_once_with()
         calls = [
-            call('sudo docker pull cwrbox'),
             call([
                 'sudo', 'docker', 'run', '--rm',
                 '--entrypoint', 'bash',
@@ -152,7 +286,7 @@ class TestCloudBuild(TestCase):
                 '-v', '/test:/container/plans',
                 '-v', '/host/s3-creds:/home/s3-creds',
                 '-v', '/host/ssh/path:/container/ssh/home',
-                '-t', 'cwrbox',
+                '-t', 'cwrbox@sha256:1234',
                 '-c',
                 'sudo juju --version && sudo -HE env PATH=$PATH '
                 'PYTHONPATH=$PYTHONPATH python2 '
@@ -160,37 +294,452 @@ class TestCloudBuild(TestCase):
                 'DEBUG -v cntr1 cntr2 /container/plans/test-plan --test-id 2 '
                 '--results-dir /host/results --s3-creds /home/s3-creds '
                 '--s3-private',
-                ]
+                ], keep_output=False
             )
         ]
         self.assertEqual(rc_mock.call_args_list, calls)
 
+    def test_run_test_with_container_default_image(self):
+        args = parse_args(['controller', '/test/test-plan', '--test-id', '2',
+                           '--image-max-age', '2', '--image-digest', 'sha'])
+        host = Mock(test_results='/host/results', tmp='/host/tmp')
+        container = Mock(home='/home', test_plans='/container/plans',
+                         juju_home='/container/.juju')
+        type(container).name = PropertyMock(return_value='cwrbox')
+        with patch('buildcloud.build_cloud.run_command', autospec=True):
+            with patch('buildcloud.build_cloud.ImageCache',
+                       autospec=True) as ic_mock:
+                ic_mock.return_value.wait.return_value = 'cwrbox@sha'
+                run_test_with_container(host, container, args, ['cntr1'])
+        ic_mock.assert_called_once_with(
+            'cwrbox', cache_file=None, max_age=7200, digest='sha')
+        ic_mock.return_value.wait.assert_called_once_with()
+
     def test_run_test_no_continer(self):
         args = parse_args(['controller', '/test/test-plan', '--test-id', '2',
                            '--no-container'])
+        client = Mock(journal=None)
         with patch('buildcloud.build_cloud.set_signal', autospec=True
                    ) as ss_mock:
             with patch('buildcloud.build_cloud.run_test_without_container',
                        autospec=True) as rtwc_mock:
                 with patch('buildcloud.build_cloud.run_test_with_container',
                            autospec=True) as rtoc_mock:
-                    run_test('host', args, 'bootstrapped', 'container',
-                             'client')
-        ss_mock.assert_called_once_with('client', no_container=True)
-        rtwc_mock.assert_called_once_with('host', args, 'bootstrapped')
+                    run_test('host', args, ['bootstrapped'], 'container',
+                             client)
+        ss_mock.assert_called_once_with(client, no_container=True,
+                                        log_timeout=120)
+        rtwc_mock.assert_called_once_with('host', args, ['bootstrapped'])
         self.assertFalse(rtoc_mock.called)
 
     def test_run_test(self):
         args = parse_args(['controller', '/test/test-plan', '--test-id', '2'])
+        client = Mock(journal=None)
         with patch('buildcloud.build_cloud.set_signal', autospec=True
                    ) as ss_mock:
             with patch('buildcloud.build_cloud.run_test_without_container',
                        autospec=True) as rtwc_mock:
                 with patch('buildcloud.build_cloud.run_test_with_container',
                            autospec=True) as rtoc_mock:
-                    run_test('host', args, 'bootstrapped', 'container',
-                             'client')
-        ss_mock.assert_called_once_with('client', no_container=False)
+                    run_test('host', args, ['bootstrapped'], 'container',
+                             client)
+        ss_mock.assert_called_once_with(client, no_container=False,
+                                        log_timeout=120)
         rtoc_mock.assert_called_once_with(
-            'host', 'container', args, 'bootstrapped')
+            'host', 'container', args, ['bootstrapped'], image=None)
         self.assertFalse(rtwc_mock.called)
+
+    def test_get_test_plans(self):
+        with temp_dir() as plans:
+            for name in ['b.yaml', 'a.yml', 'README']:
+                write_plan(os.path.join(plans, name))
+            index = ['--plan-index', os.path.join(plans, 'index.json')]
+            args = parse_args(['gce', plans] + index)
+            self.assertEqual(get_test_plans(args), [
+                os.path.join(plans, 'a.yml'), os.path.join(plans, 'b.yaml')])
+            args = parse_args(['gce', plans, '--test-plans', 'b.yaml', 'a'] +
+                              index)
+            self.assertEqual(get_test_plans(args), [
+                os.path.join(plans, 'b.yaml'), os.path.join(plans, 'a.yml')])
+            args = parse_args(['gce', plans, '--test-plans', 'c'] + index)
+            with self.assertRaisesRegexp(ValueError,
+                                         'Unknown test plans: c'):
+                get_test_plans(args)
+        args = parse_args(['gce', '/test/test-plan.yaml'])
+        self.assertEqual(get_test_plans(args), ['/test/test-plan.yaml'])
+
+    def test_make_plan_run(self):
+        with temp_dir() as root:
+            host = Mock(test_results=root)
+            args = parse_args(['gce', root, '--test-id', '7',
+                               '--results-dir', '/results'])
+            plan_host, plan_args = make_plan_run(
+                host, args, os.path.join(root, 'jenkins.yaml'))
+            self.assertEqual(plan_host.test_results,
+                             os.path.join(root, 'jenkins'))
+            self.assertTrue(os.path.isdir(plan_host.test_results))
+            self.assertEqual(plan_args.test_id, '7-jenkins')
+            self.assertEqual(plan_args.results_dir, '/results/jenkins')
+            self.assertEqual(plan_args.test_plan,
+                             os.path.join(root, 'jenkins.yaml'))
+            self.assertEqual(host.test_results, root)
+            self.assertEqual(args.test_id, '7')
+        args = parse_args(['gce', '/test/test-plan.yaml'])
+        self.assertEqual(make_plan_run(host, args, args.test_plan),
+                         (host, args))
+
+    def test_run_test_batch(self):
+        with temp_dir() as root:
+            plans = os.path.join(root, 'plans')
+            os.mkdir(plans)
+            for name in ['a.yaml', 'b.yaml', 'c.yaml']:
+                write_plan(os.path.join(plans, name))
+            results = os.path.join(root, 'results')
+            os.mkdir(results)
+            host = Mock(test_results=results)
+            args = parse_args(['gce', plans, '--test-id', '2',
+                               '--log-dir', os.path.join(root, 'logs'),
+                               '--plan-index', os.path.join(root, 'index')])
+            with patch('buildcloud.build_cloud.set_signal', autospec=True):
+                with patch('buildcloud.build_cloud.run_test_with_container',
+                           autospec=True,
+                           side_effect=[None, CalledProcessError(1, 'cwr'),
+                                        None]) as rtwc_mock:
+                    with self.assertRaises(CalledProcessError):
+                        run_test(host, args, ['gce:gce'], 'container',
+                                 Mock(journal=None), image='image')
+            self.assertEqual(sorted(os.listdir(os.path.join(root, 'logs'))),
+                             ['a', 'b', 'c'])
+        self.assertEqual(
+            [(c[0][0].test_results, c[0][2].test_id)
+             for c in rtwc_mock.call_args_list],
+            [(os.path.join(results, n), '2-' + n) for n in 'abc'])
+        self.assertEqual(rtwc_mock.call_args[1], {
+            'image': 'image', 'container_name': CONTAINER_NAME,
+            'copy_logs': False})
+
+    def test_run_plans_concurrent(self):
+        with temp_dir() as root:
+            plans = os.path.join(root, 'plans')
+            os.mkdir(plans)
+            for name in ['a.yaml', 'b.yaml']:
+                write_plan(os.path.join(plans, name))
+            results = os.path.join(root, 'results')
+            os.mkdir(results)
+            host = Mock(test_results=results)
+            args = parse_args(['gce', plans, '--test-id', '2',
+                               '--plan-concurrency', '2', '--no-container',
+                               '--plan-index', os.path.join(root, 'index')])
+            client = Mock(spec=['temp_models', 'journal'], journal=None)
+            models = iter(['gce:cwr-1', 'gce:cwr-2'])
+
+            @contextmanager
+            def temp_models(controllers):
+                self.assertEqual(controllers, ['gce'])
+                yield [next(models)]
+            client.temp_models.side_effect = temp_models
+            with patch('buildcloud.build_cloud.run_test_without_container',
+                       autospec=True) as rtwc_mock:
+                run_plans(host, args, ['gce:gce'], None, client=client)
+        self.assertEqual(
+            sorted(c[0][1].test_id for c in rtwc_mock.call_args_list),
+            ['2-a', '2-b'])
+        self.assertEqual(
+            sorted(c[0][2][0] for c in rtwc_mock.call_args_list),
+            ['gce:cwr-1', 'gce:cwr-2'])
+        self.assertEqual(client.temp_models.call_count, 2)
+
+    def test_store_benchmarks(self):
+        host = Mock(test_results='/results')
+        args = parse_args(['gce', '/test/test-plan'])
+        with patch('buildcloud.build_cloud.ingest', autospec=True) as i_mock:
+            store_benchmarks(args, host)
+            self.assertFalse(i_mock.called)
+            args.benchmark_store = '/store.csv'
+            store_benchmarks(args, host)
+        i_mock.assert_called_once_with('/store.csv', '/results')
+
+    def test_run_test_journaled(self):
+        with temp_dir() as log_dir:
+            args = parse_args(['gce', '/test/test-plan', '--no-container',
+                               '--log-dir', log_dir])
+            journal = make_journal(args)
+            client = Mock(journal=journal)
+            with patch('buildcloud.build_cloud.set_signal', autospec=True):
+                with patch('buildcloud.build_cloud.run_test_without_container',
+                           autospec=True, side_effect=[CalledProcessError(
+                               1, 'cwr'), None, None]) as rtwc_mock:
+                    with self.assertRaises(CalledProcessError):
+                        run_test('host', args, ['gce:gce'], None, client)
+                    self.assertFalse(tests_finished(journal, args, ['gce']))
+                    run_test('host', args, ['gce:gce'], None, client)
+                    run_test('host', args, ['gce:gce'], None, client)
+                    self.assertTrue(tests_finished(journal, args, ['gce']))
+                    self.assertFalse(
+                        tests_finished(journal, args, ['gce', 'aws']))
+                    run_test('host', args, ['gce:cwr-1', 'aws:aws'], None,
+                             client)
+            events = [e['event'] for e in journal.load()]
+        self.assertEqual(rtwc_mock.call_count, 3)
+        self.assertEqual(events, ['test-started', 'test-started',
+                                  'test-finished', 'test-started',
+                                  'test-finished'])
+
+    def test_run_test_journaled_container(self):
+        with temp_dir() as root:
+            log_dir = os.path.join(root, 'logs')
+            results = os.path.join(root, 'results')
+            os.mkdir(log_dir)
+            os.mkdir(results)
+            with open(os.path.join(results, 'report.json'), 'w') as f:
+                f.write('{}')
+            args = parse_args(['gce', '/test/test-plan', '--log-dir',
+                               log_dir])
+            journal = make_journal(args)
+            journal.record('controller-bootstrapped', controller='gce')
+            host = Mock(test_results=results, tmp='/host/tmp')
+            container = Mock(home='/home', test_plans='/container/plans',
+                             juju_home='/container/.juju')
+            image = Mock(spec=['wait'])
+            image.wait.return_value = 'cwrbox@sha256:1234'
+            with patch('buildcloud.build_cloud.set_signal', autospec=True):
+                with patch('buildcloud.build_cloud.run_command',
+                           autospec=True):
+                    run_test(host, args, ['gce:gce'], container,
+                             Mock(journal=journal), image=image)
+            events = [e['event'] for e in journal.load()]
+            self.assertEqual(sorted(os.listdir(log_dir)),
+                             ['cwr-journal.jsonl', 'report.json'])
+        self.assertEqual(events, ['controller-bootstrapped', 'test-started',
+                                  'test-finished'])
+
+    def test_parse_args_resume(self):
+        with patch('sys.stderr'):
+            with self.assertRaises(SystemExit):
+                parse_args(['gce', '/test/test-plan', '--resume'])
+
+    def test_make_journal(self):
+        args = parse_args(['gce', '/test/test-plan'])
+        self.assertIsNone(make_journal(args))
+        with temp_dir() as log_dir:
+            args = parse_args(['gce', '/test/test-plan', '--log-dir', log_dir])
+            make_journal(args).record('controller-bootstrapped',
+                                      controller='gce')
+            make_journal(args).record('test-started',
+                                      test_plan='/test/test-plan',
+                                      controllers=['gce'])
+            args.resume = True
+            self.assertEqual(len(make_journal(args).load()), 2)
+            args.resume = False
+            self.assertEqual(
+                [e['event'] for e in make_journal(args).load()],
+                ['controller-bootstrapped'])
+
+    def test_make_journal_creates_log_dir(self):
+        with temp_dir() as parent:
+            log_dir = os.path.join(parent, 'logs', '42')
+            args = parse_args(['gce', '/test/test-plan', '--log-dir', log_dir])
+            make_journal(args).record('controller-bootstrapped',
+                                      controller='gce')
+            self.assertTrue(
+                os.path.isfile(os.path.join(log_dir, JOURNAL_FILE)))
+
+    def test_run_tests_resume_finished(self):
+        with temp_dir() as log_dir:
+            args = parse_args(['gce', '/test/test-plan', '--log-dir', log_dir,
+                               '--resume'])
+            journal = make_journal(args)
+            journal.record('test-finished', test_plan='/test/test-plan',
+                           controllers=['cwr-gce'])
+            client = Mock(spec=['resume', 'cleanup', 'bootstrap', 'journal',
+                                'resumed'],
+                          journal=journal, resumed={'gce': 'cwr-gce'})
+            run_tests(Mock(controllers=['gce']), args, None, client, None)
+        client.resume.assert_called_once_with()
+        client.cleanup.assert_called_once_with()
+        self.assertFalse(client.bootstrap.called)
+
+    def test_run_tests_resume_pipeline_unfinished(self):
+        with temp_dir() as log_dir:
+            args = parse_args(['aws', 'gce', '/test/test-plan', '--log-dir',
+                               log_dir, '--resume', '--pipeline'])
+            journal = make_journal(args)
+            journal.record('test-finished', test_plan='/test/test-plan',
+                           controllers=['cwr-aws'])
+            client = Mock(spec=['resume', 'cleanup', 'bootstrap', 'journal',
+                                'resumed'],
+                          journal=journal, resumed={'aws': 'cwr-aws'})
+            with patch('buildcloud.build_cloud.run_test_pipelined',
+                       autospec=True) as rtp_mock:
+                run_tests(Mock(controllers=['aws', 'gce']), args, None,
+                          client, None)
+            journal.record('test-finished', test_plan='/test/test-plan',
+                           controllers=['gce'])
+            self.assertTrue(tests_finished(journal, args, ['cwr-aws', 'gce']))
+        self.assertEqual(rtp_mock.call_count, 1)
+        self.assertFalse(client.cleanup.called)
+
+    def test_load_model_limits(self):
+        table = RoutingTable([
+            Route('aws', 'aws/sa-east-1', None, None, 2,
+                  ['sa-east-1', 'us-east-1']),
+            Route('gce', 'google', None, None, 4, None),
+            Route('lxd', 'localhost', None, None, None, None)])
+        with temp_dir() as tmp:
+            path = os.path.join(tmp, 'limits.yaml')
+            with open(path, 'w') as f:
+                f.write('google: 1\nazure: 3\n')
+            args = parse_args(['gce', '/test/test-plan'])
+            with patch('buildcloud.build_cloud.get_routing_table',
+                       autospec=True, return_value=table):
+                self.assertEqual(load_model_limits(args),
+                                 {'aws': 2, 'google': 4})
+                args.model_limits = path
+                self.assertEqual(load_model_limits(args),
+                                 {'aws': 2, 'google': 1, 'azure': 3})
+                table.routes = []
+                args.model_limits = None
+                self.assertIsNone(load_model_limits(args))
+
+    def test_make_log_options(self):
+        args = parse_args(['gce', '/test/test-plan', '--compress-logs',
+                           '--log-file-cap', '2', '--logs-since-bootstrap'])
+        self.assertEqual(make_log_options(args), LogOptions(
+            compress=True, file_cap=2097152, run_cap=None,
+            since_bootstrap=True))
+
+    def test_wait_for_models(self):
+        client = Mock(spec=['wait_for'])
+        client.wait_for.return_value = ['b']
+        args = parse_args(['gce', '/test/test-plan', '--wait-timeout', '60'])
+        self.assertEqual(wait_for_models(client, args, ['a', 'b']), ['a'])
+        client.wait_for.assert_called_once_with(['a', 'b'], timeout=60)
+        args.wait_timeout = None
+        self.assertEqual(wait_for_models(client, args, ['a', 'b']),
+                         ['a', 'b'])
+        self.assertEqual(client.wait_for.call_count, 1)
+
+    def test_run_test_pipelined(self):
+        client = Mock(spec=['bootstrap', 'get_model', 'journal'],
+                      journal=None)
+        client.get_model.side_effect = lambda c: '{0}:{0}'.format(c)
+
+        @contextmanager
+        def bootstrap(on_bootstrapped):
+            on_bootstrapped('aws')
+            on_bootstrapped('gce')
+            yield ['aws:aws', 'gce:gce']
+            # The cleanup collects the remote logs into the log dir.
+            with open(os.path.join(log_dir, 'aws--syslog'), 'w') as f:
+                f.write('log')
+        client.bootstrap.side_effect = bootstrap
+
+        def fake_run(host, container, args, controllers, image,
+                     container_name, copy_logs):
+            with open(os.path.join(host.test_results, 'result.json'),
+                      'w') as f:
+                f.write(controllers[0])
+            with open(os.path.join(host.test_results,
+                                   controllers[0] + '.html'), 'w') as f:
+                f.write(container_name)
+
+        with temp_dir() as root:
+            results = os.path.join(root, 'results')
+            os.mkdir(results)
+            log_dir = os.path.join(root, 'logs')
+            os.mkdir(log_dir)
+            args = parse_args(['gce', 'aws', '/test/test-plan', '--test-id',
+                               '2', '--pipeline', '--log-dir', log_dir])
+            host = Mock(root=root, test_results=results)
+            with patch('buildcloud.build_cloud.set_signal', autospec=True):
+                with patch('buildcloud.build_cloud.run_test_with_container',
+                           autospec=True, side_effect=fake_run) as rtwc_mock:
+                    run_test_pipelined(host, args, 'container', client,
+                                       image='image')
+            self.assertEqual(
+                sorted(os.listdir(results)),
+                ['aws:aws.html', 'gce:gce.html', 'result.json'])
+            self.assertEqual(
+                sorted(os.listdir(log_dir)),
+                ['aws--syslog', 'aws:aws.html', 'gce:gce.html',
+                 'result.json'])
+            with open(os.path.join(results, 'gce:gce.html')) as f:
+                self.assertEqual(f.read(), CONTAINER_NAME + '-gce-gce')
+        self.assertEqual(
+            sorted(c[0][3] for c in rtwc_mock.call_args_list),
+            [['aws:aws'], ['gce:gce']])
+
+    def test_run_test_pipelined_error(self):
+        args = parse_args(['gce', '/test/test-plan', '--test-id', '2',
+                           '--pipeline', '--no-container'])
+        client = Mock(spec=['bootstrap', 'get_model', 'journal'],
+                      journal=None)
+        client.get_model.return_value = 'gce:gce'
+
+        @contextmanager
+        def bootstrap(on_bootstrapped):
+            on_bootstrapped('gce')
+            yield ['gce:gce']
+        client.bootstrap.side_effect = bootstrap
+
+        with temp_dir() as root:
+            host = Mock(root=root, test_results=os.path.join(root, 'r'))
+            with patch('buildcloud.build_cloud.set_signal', autospec=True):
+                with patch('buildcloud.build_cloud.run_test_without_container',
+                           autospec=True,
+                           side_effect=ValueError('cwr failed')):
+                    with self.assertRaisesRegexp(ValueError, 'cwr failed'):
+                        run_test_pipelined(host, args, None, client)
+
+    def test_cleanup_coordinator(self):
+        client = Mock()
+        coordinator = CleanupCoordinator(client, False, log_timeout=10)
+        with patch('buildcloud.build_cloud.run_command',
+                   autospec=True) as rc_mock:
+            coordinator.start()
+            coordinator.handle_signal(signal.SIGTERM, None)
+            self.assertTrue(coordinator.done.wait(5))
+        rc_mock.assert_called_once_with(
+            ['sudo', 'docker', 'rm', '-f', CONTAINER_NAME])
+        client.interrupt.assert_called_once_with(
+            10, abort=coordinator.forced)
+        client.teardown.assert_called_once_with(10, abort=coordinator.forced)
+        self.assertFalse(coordinator.forced.is_set())
+        coordinator.handle_signal(signal.SIGINT, None)
+        self.assertTrue(coordinator.forced.is_set())
+
+    def test_cleanup_coordinator_no_container(self):
+        client = Mock()
+        client.teardown.side_effect = ValueError('no juju')
+        coordinator = CleanupCoordinator(client, True)
+        with patch('buildcloud.build_cloud.run_command',
+                   autospec=True) as rc_mock:
+            with patch('logging.exception', autospec=True) as le_mock:
+                coordinator.start()
+                coordinator.handle_signal(signal.SIGTERM, None)
+                self.assertTrue(coordinator.done.wait(5))
+        self.assertFalse(rc_mock.called)
+        client.interrupt.assert_called_once_with(
+            120, abort=coordinator.forced)
+        client.teardown.assert_called_once_with(120, abort=coordinator.forced)
+        le_mock.assert_called_once_with(
+            'Cleaning up after the signal failed.')
+
+    def test_set_signal(self):
+        client = Mock()
+        with patch('buildcloud.build_cloud.signal.signal',
+                   autospec=True) as signal_mock:
+            coordinator = set_signal(client, no_container=True)
+            self.assertIs(set_signal(client, no_container=True), coordinator)
+            self.assertIsNot(set_signal(Mock(), no_container=True),
+                             coordinator)
+        self.assertEqual(signal_mock.call_args_list[:2], [
+            call(signal.SIGTERM, coordinator.handle_signal),
+            call(signal.SIGINT, coordinator.handle_signal)])
+        self.assertFalse(client.teardown.called)
+
+
+def write_plan(path):
+    with open(path, 'w') as f:
+        f.write('bundle: cs:{0}\nbundle_name: {0}\n'.format(
+            os.path.basename(path)))
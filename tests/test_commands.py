@@ -0,0 +1,40 @@
+from buildcloud.commands import (
+    docker_command,
+    docker_run_args,
+    juju_command,
+    option_args,
+)
+from tests import TestCase
+
+
+class TestCommands(TestCase):
+
+    def test_juju_command(self):
+        self.assertEqual(juju_command('juju', 'status'), ['juju', 'status'])
+        self.assertEqual(
+            juju_command('/bin/juju', 'scp', ['0:/tmp/a b', '/tmp/c'],
+                         model='foo', operator_flag='-e', flags=['--debug']),
+            ['/bin/juju', '--debug', 'scp', '-e', 'foo', '0:/tmp/a b',
+             '/tmp/c'])
+
+    def test_option_args(self):
+        self.assertEqual(
+            option_args([('mem=2G cores=4', '--constraints'),
+                         (None, '--config'), (True, '--s3-private'),
+                         (False, '--debug'), (3, '--retries')]),
+            ['--constraints', 'mem=2G cores=4', '--s3-private',
+             '--retries', '3'])
+
+    def test_docker_command(self):
+        self.assertEqual(docker_command('stop', ['cwr']),
+                         ['sudo', 'docker', 'stop', 'cwr'])
+
+    def test_docker_run_args(self):
+        self.assertEqual(docker_run_args('cwr', 'cwrbox'),
+                         ['--rm', '--name', 'cwr', '-t', 'cwrbox'])
+        self.assertEqual(
+            docker_run_args('cwr', 'cwrbox', user='joe', env=[('A', 'b c')],
+                            volumes=[('/a', '/b')], workdir='/home',
+                            entrypoint='bash', remove=False, tty=False),
+            ['--entrypoint', 'bash', '--name', 'cwr', '-u', 'joe',
+             '-e', 'A=b c', '-w', '/home', '-v', '/a:/b', 'cwrbox'])
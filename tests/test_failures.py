@@ -0,0 +1,83 @@
+from subprocess import CalledProcessError
+
+from mock import patch
+
+from buildcloud.failures import (
+    CAPACITY,
+    classify_failure,
+    FATAL,
+    get_backoff,
+    get_error_lines,
+    RATE_LIMIT,
+    TRANSIENT,
+)
+from tests import TestCase
+
+
+# The tail of a juju bootstrap --show-log that failed on a bad constraint.
+SHOW_LOG = """\
+10:31:02 INFO  juju.cmd supercommand.go:63 running juju [2.0.2 gc go1.6.2]
+10:31:05 INFO  cmd bootstrap.go:482 Bootstrapping model "controller"
+10:31:40 DEBUG juju.utils.ssh ssh.go:249 dial tcp 10.0.0.1:22: connect: \
+connection refused
+10:32:10 DEBUG juju.api apiclient.go:500 error dialing \
+"wss://10.0.0.1:17070/": i/o timeout
+10:32:40 ERROR cmd supercommand.go:458 failed to bootstrap model: cannot \
+deploy controller: invalid constraint value: arch=sparc
+10:32:40 DEBUG cmd supercommand.go:459 (error details: [{bootstrap.go:506: }])
+10:32:41 INFO  juju.provider.common destroy.go:20 destroying model "controller"
+"""
+
+
+def make_error(stderr):
+    error = CalledProcessError(1, 'juju')
+    error.stderr = stderr
+    return error
+
+
+class TestFailures(TestCase):
+
+    def test_classify_failure(self):
+        self.assertEqual(classify_failure(make_error(
+            'ERROR RequestLimitExceeded: Request limit exceeded.')),
+            RATE_LIMIT)
+        self.assertEqual(classify_failure(make_error(
+            'ERROR googleapi: Error 403: Rate Limit Exceeded')), RATE_LIMIT)
+        self.assertEqual(classify_failure(make_error(
+            'ERROR InstanceLimitExceeded: Your quota allows for 0 more')),
+            CAPACITY)
+        self.assertEqual(classify_failure(make_error(
+            'InsufficientInstanceCapacity: no m3.medium capacity')), CAPACITY)
+        self.assertEqual(classify_failure(make_error(
+            'ERROR Get https://10.0.0.1:17070/: net/http: TLS handshake '
+            'timeout')), TRANSIENT)
+        self.assertEqual(classify_failure(make_error(
+            'ERROR cannot find network interfaces')), FATAL)
+        self.assertEqual(classify_failure(CalledProcessError(1, 'juju')),
+                         FATAL)
+
+    def test_classify_failure_show_log(self):
+        self.assertEqual(classify_failure(make_error(SHOW_LOG)), FATAL)
+        timeout = SHOW_LOG.replace(
+            'cannot deploy controller: invalid constraint value: arch=sparc',
+            'waited for 10m0s without being able to connect: timed out')
+        self.assertEqual(classify_failure(make_error(timeout)), TRANSIENT)
+
+    def test_get_error_lines(self):
+        self.assertEqual(get_error_lines(SHOW_LOG), [
+            '10:32:40 ERROR cmd supercommand.go:458 failed to bootstrap '
+            'model: cannot deploy controller: invalid constraint value: '
+            'arch=sparc'])
+        self.assertEqual(
+            get_error_lines('ERROR one\nINFO retrying\nERROR two\n'
+                            'ERROR three\n\n'),
+            ['ERROR two', 'ERROR three'])
+        self.assertEqual(get_error_lines('foo\nbar\n'), ['bar'])
+        self.assertEqual(get_error_lines(''), [])
+
+    def test_get_backoff(self):
+        with patch('buildcloud.failures.random.uniform', autospec=True,
+                   side_effect=lambda a, b: (a, b)):
+            self.assertEqual(get_backoff(0, 10), (5, 10))
+            self.assertEqual(get_backoff(2, 10), (20, 40))
+            self.assertEqual(get_backoff(5, 10, max_backoff=100), (50, 100))
@@ -0,0 +1,120 @@
+import os
+import subprocess
+from time import time
+
+from mock import (
+    call,
+    patch,
+)
+import yaml
+
+from buildcloud.image_cache import ImageCache
+from buildcloud.utility import temp_dir
+from tests import TestCase
+
+
+INSPECT = ['sudo', 'docker', 'image', 'inspect', '--format',
+           '{{json .RepoDigests}}']
+
+
+class TestImageCache(TestCase):
+
+    def write_cache(self, cache_file, pulled, digest=None):
+        with open(cache_file, 'w') as f:
+            yaml.safe_dump({'cwrbox': {'pulled': pulled, 'digest': digest}},
+                           f)
+
+    def test_image(self):
+        self.assertEqual(ImageCache('cwrbox').image, 'cwrbox')
+        self.assertEqual(ImageCache('cwrbox', digest='sha256:12').image,
+                         'cwrbox@sha256:12')
+
+    def test_ensure_missing_image(self):
+        with temp_dir() as d:
+            cache_file = os.path.join(d, 'cache', 'images.yaml')
+            cache = ImageCache('cwrbox', cache_file=cache_file)
+            with patch('buildcloud.image_cache.run_command', autospec=True,
+                       side_effect=[subprocess.CalledProcessError(1, ''),
+                                    None]) as rc_mock:
+                self.assertEqual(cache.ensure(), 'cwrbox')
+            with open(cache_file) as f:
+                saved = yaml.safe_load(f)
+        self.assertEqual(rc_mock.call_args_list, [
+            call(INSPECT + ['cwrbox'], verbose=False),
+            call(['sudo', 'docker', 'pull', 'cwrbox'], keep_output=False)])
+        self.assertLessEqual(saved['cwrbox']['pulled'], time())
+        self.assertIsNone(saved['cwrbox']['digest'])
+
+    def test_ensure_fresh_image(self):
+        with temp_dir() as d:
+            cache_file = os.path.join(d, 'images.yaml')
+            self.write_cache(cache_file, time() - 10)
+            cache = ImageCache('cwrbox', cache_file=cache_file, max_age=60)
+            with patch('buildcloud.image_cache.run_command', autospec=True,
+                       return_value='["cwrbox@sha256:12"]\n') as rc_mock:
+                self.assertEqual(cache.ensure(), 'cwrbox')
+        rc_mock.assert_called_once_with(INSPECT + ['cwrbox'], verbose=False)
+
+    def test_ensure_stale_image(self):
+        with temp_dir() as d:
+            cache_file = os.path.join(d, 'images.yaml')
+            self.write_cache(cache_file, time() - 120)
+            cache = ImageCache('cwrbox', cache_file=cache_file, max_age=60)
+            with patch('buildcloud.image_cache.run_command', autospec=True,
+                       return_value='["cwrbox@sha256:12"]\n') as rc_mock:
+                cache.ensure()
+        self.assertEqual(rc_mock.call_args_list, [
+            call(INSPECT + ['cwrbox'], verbose=False),
+            call(['sudo', 'docker', 'pull', 'cwrbox'], keep_output=False)])
+
+    def test_ensure_pinned_digest_present(self):
+        with temp_dir() as d:
+            cache_file = os.path.join(d, 'images.yaml')
+            self.write_cache(cache_file, 0)
+            cache = ImageCache('cwrbox', cache_file=cache_file, max_age=60,
+                               digest='sha256:12')
+            with patch('buildcloud.image_cache.run_command', autospec=True,
+                       return_value='["cwrbox@sha256:12"]\n') as rc_mock:
+                self.assertEqual(cache.ensure(), 'cwrbox@sha256:12')
+        rc_mock.assert_called_once_with(
+            INSPECT + ['cwrbox@sha256:12'], verbose=False)
+
+    def test_ensure_pinned_digest_changed(self):
+        with temp_dir() as d:
+            cache_file = os.path.join(d, 'images.yaml')
+            self.write_cache(cache_file, time(), digest='sha256:12')
+            cache = ImageCache('cwrbox', cache_file=cache_file,
+                               digest='sha256:34')
+            with patch('buildcloud.image_cache.run_command', autospec=True,
+                       return_value='["cwrbox@sha256:12"]\n') as rc_mock:
+                cache.ensure()
+            with open(cache_file) as f:
+                saved = yaml.safe_load(f)
+        self.assertEqual(
+            rc_mock.call_args_list[-1],
+            call(['sudo', 'docker', 'pull', 'cwrbox@sha256:34'],
+                 keep_output=False))
+        self.assertEqual(saved['cwrbox']['digest'], 'sha256:34')
+
+    def test_start_pull_and_wait(self):
+        with temp_dir() as d:
+            cache = ImageCache('cwrbox', cache_file=os.path.join(d, 'c'))
+            with patch.object(cache, 'ensure', autospec=True) as e_mock:
+                cache.start_pull()
+                self.assertEqual(cache.wait(), 'cwrbox')
+        e_mock.assert_called_once_with()
+
+    def test_wait_raises_pull_error(self):
+        cache = ImageCache('cwrbox')
+        with patch.object(cache, 'ensure', autospec=True,
+                          side_effect=subprocess.CalledProcessError(1, '')):
+            cache.start_pull()
+            with self.assertRaises(subprocess.CalledProcessError):
+                cache.wait()
+
+    def test_wait_without_start_pull(self):
+        cache = ImageCache('cwrbox')
+        with patch.object(cache, 'ensure', autospec=True,
+                          return_value='cwrbox') as e_mock:
+            self.assertEqual(cache.wait(), 'cwrbox')
+        e_mock.assert_called_once_with()
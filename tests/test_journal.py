@@ -0,0 +1,107 @@
+import os
+
+from buildcloud.journal import (
+    BOOTSTRAPPED,
+    get_data_file,
+    Journal,
+    KILLED,
+    LOGS_COLLECTED,
+    RELEASED,
+    TEST_FINISHED,
+)
+from buildcloud.utility import temp_dir
+from tests import TestCase
+
+
+class TestJournal(TestCase):
+
+    def test_record_and_load(self):
+        with temp_dir() as tmp:
+            journal = Journal(os.path.join(tmp, 'journal'),
+                              os.path.join(tmp, 'data.json'))
+            self.assertEqual(journal.load(), [])
+            journal.record(BOOTSTRAPPED, controller='gce')
+            with open(journal.path, 'a') as f:
+                f.write('{"event": "controller-ki')
+            entries = journal.load()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['event'], BOOTSTRAPPED)
+        self.assertEqual(entries[0]['controller'], 'gce')
+        self.assertIn('time', entries[0])
+        self.assertIn('broken journal entry', self.log_stream.getvalue())
+
+    def test_get_live_controllers(self):
+        with temp_dir() as tmp:
+            journal = Journal(os.path.join(tmp, 'journal'),
+                              os.path.join(tmp, 'data.json'))
+            for controller in ['gce', 'aws', 'azure']:
+                journal.record(BOOTSTRAPPED, controller=controller)
+            journal.record(KILLED, controller='gce')
+            journal.record(RELEASED, controller='aws')
+            live = journal.get_live_controllers()
+        self.assertEqual(live.keys(), ['azure'])
+
+    def test_reset(self):
+        with temp_dir() as tmp:
+            journal = Journal(os.path.join(tmp, 'journal'),
+                              os.path.join(tmp, 'data.json'))
+            journal.reset()
+            journal.record(BOOTSTRAPPED, controller='gce')
+            journal.record(BOOTSTRAPPED, controller='aws')
+            journal.record(KILLED, controller='aws')
+            journal.record(TEST_FINISHED, test_plan='a.yaml',
+                           controllers=['gce'])
+            journal.save_controller('gce', {'controllers.yaml': {}})
+            journal.save_controller('aws', {'controllers.yaml': {}})
+            journal.reset()
+            entries = journal.load()
+            self.assertEqual(journal.load_controller('gce'),
+                             {'controllers.yaml': {}})
+            self.assertIsNone(journal.load_controller('aws'))
+            journal.record(KILLED, controller='gce')
+            journal.reset()
+            self.assertEqual(journal.load(), [])
+            self.assertIsNone(journal.load_controller('gce'))
+        self.assertEqual([(e['event'], e['controller']) for e in entries],
+                         [(BOOTSTRAPPED, 'gce')])
+        self.assertIn('left controllers alive: gce',
+                      self.log_stream.getvalue())
+
+    def test_test_finished(self):
+        with temp_dir() as tmp:
+            journal = Journal(os.path.join(tmp, 'journal'),
+                              os.path.join(tmp, 'data.json'))
+            journal.record(TEST_FINISHED, test_plan='a.yaml',
+                           controllers=['aws', 'gce'])
+            journal.record(LOGS_COLLECTED, controller='gce')
+            self.assertTrue(journal.test_finished('a.yaml'))
+            self.assertTrue(journal.test_finished('a.yaml', ['gce', 'aws']))
+            self.assertFalse(journal.test_finished('a.yaml', ['gce']))
+            self.assertFalse(journal.test_finished('b.yaml'))
+            self.assertEqual(journal.get_tested_controllers('a.yaml'),
+                             set(['aws', 'gce']))
+            self.assertEqual(journal.get_tested_controllers('b.yaml'), set())
+            self.assertTrue(journal.logs_collected('gce'))
+            self.assertFalse(journal.logs_collected('aws'))
+
+    def test_save_controller(self):
+        with temp_dir() as tmp:
+            journal = Journal(os.path.join(tmp, 'journal'),
+                              os.path.join(tmp, 'data.json'))
+            self.assertIsNone(journal.load_controller('gce'))
+            journal.save_controller('gce', {'accounts.yaml': {'p': 'x'}})
+            journal.save_controller('aws', {})
+            journal.record(BOOTSTRAPPED, controller='gce')
+            self.assertEqual(journal.load_controller('gce'),
+                             {'accounts.yaml': {'p': 'x'}})
+            self.assertEqual(journal.load_controller('aws'), {})
+            self.assertEqual(os.stat(journal.data_path).st_mode & 0o777,
+                             0o600)
+            with open(journal.path) as f:
+                self.assertNotIn('accounts.yaml', f.read())
+
+    def test_get_data_file(self):
+        path = get_data_file('/juju', '/logs/cwr-journal.jsonl')
+        self.assertRegexpMatches(
+            path, r'^/juju/cwr-journal-[0-9a-f]{12}\.json$')
+        self.assertNotEqual(path, get_data_file('/juju', '/other/journal'))
@@ -1,14 +1,44 @@
+from copy import deepcopy
+import gzip
+import json
+import os
 import subprocess
+import tarfile
+from threading import (
+    Event,
+    Thread,
+)
+from time import sleep
 
 from mock import (
     call,
+    Mock,
     patch,
 )
+import yaml
 
 from buildcloud.juju import (
+    is_ready,
     JujuClient,
+    LogOptions,
     make_client,
+    make_log_command,
+    merge_constraints,
+    Status,
+    unpack_logs,
     )
+from buildcloud.journal import (
+    BOOTSTRAPPED,
+    Journal,
+)
+from buildcloud.pool import ControllerPool
+from buildcloud.regions import RegionStats
+from buildcloud.report import reset_report
+from buildcloud.routes import Route
+from buildcloud.utility import (
+    run_concurrently,
+    temp_dir,
+)
 from tests import TestCase
 
 
@@ -37,10 +67,14 @@ class TestJujuClient(TestCase):
         with patch('buildcloud.juju.run_command', autospec=True) as jrc_mock:
             jc._bootstrap()
         calls = ([
-            call('/foo/bar bootstrap --show-log google/europe-west1 gce '
-                 '--default-model gce --no-gui --constraints mem=3G'),
-            call('/foo/bar bootstrap --show-log azure/northeurope azure '
-                 '--default-model azure --no-gui --constraints mem=3G')
+            call(['/foo/bar', 'bootstrap', '--show-log', 'google/europe-west1',
+                  'gce', '--default-model', 'gce', '--no-gui', '--constraints',
+                  'mem=3G'],
+                 keep_output=False),
+            call(['/foo/bar', 'bootstrap', '--show-log', 'azure/northeurope',
+                  'azure', '--default-model', 'azure', '--no-gui',
+                  '--constraints', 'mem=3G'],
+                 keep_output=False)
         ])
         self.assertEqual(jrc_mock.call_args_list, calls)
         self.assertEqual(jc.bootstrapped, ['gce', 'azure'])
@@ -56,16 +90,126 @@ class TestJujuClient(TestCase):
                    ) as jrc_mock:
             jc._bootstrap()
         calls = ([
-            call('/foo/bar bootstrap --show-log google/europe-west1 gce '
-                 '--default-model gce --no-gui '
-                 '--constraints mem=3G --config test-mode=true'),
-            call('/foo/bar bootstrap --show-log azure/northeurope azure '
-                 '--default-model azure --no-gui '
-                 '--constraints mem=3G --config test-mode=true')
+            call(['/foo/bar', 'bootstrap', '--show-log', 'google/europe-west1',
+                  'gce', '--default-model', 'gce', '--no-gui', '--constraints',
+                  'mem=3G', '--config', 'test-mode=true'],
+                 keep_output=False),
+            call(['/foo/bar', 'bootstrap', '--show-log', 'azure/northeurope',
+                  'azure', '--default-model', 'azure', '--no-gui',
+                  '--constraints', 'mem=3G', '--config', 'test-mode=true'],
+                 keep_output=False)
         ])
         self.assertEqual(jrc_mock.call_args_list, calls)
         self.assertEqual(jc.bootstrapped, ['gce'])
 
+    def test__bootstrap_capacity_fallback(self):
+        fake_host = FakeHost()
+        fake_host.controllers = ['gce']
+        error = subprocess.CalledProcessError(1, 'juju')
+        error.stderr = 'ERROR ZONE_RESOURCE_POOL_EXHAUSTED in europe-west1'
+        with temp_dir() as tmp:
+            stats = RegionStats(os.path.join(tmp, 'regions.json'))
+            jc = JujuClient('/foo/bar', fake_host, None, region_stats=stats)
+            with patch('buildcloud.juju.run_command', autospec=True,
+                       side_effect=[error, None, None]) as jrc_mock:
+                jc._bootstrap()
+            recorded = stats.load()
+        self.assertEqual(
+            [c[0][0][1:4] for c in jrc_mock.call_args_list], [
+                ['bootstrap', '--show-log', 'google/europe-west1'],
+                ['kill-controller', 'gce', '-y'],
+                ['bootstrap', '--show-log', 'google/us-central1']])
+        self.assertEqual(jc.bootstrapped, ['gce'])
+        self.assertEqual(jc.get_cloud('gce'), 'google/us-central1')
+        self.assertIn('capacity_failure', recorded['google/europe-west1'])
+        self.assertEqual(recorded['google/us-central1']['bootstraps'], 1)
+        self.assertEqual(jc._bootstrapping, {'google/europe-west1': 0,
+                                             'google/us-central1': 0})
+
+    def test__bootstrap_capacity_no_region_left(self):
+        fake_host = FakeHost()
+        fake_host.controllers = ['joyent']
+        error = subprocess.CalledProcessError(1, 'juju')
+        error.stderr = 'ERROR quota exceeded'
+        jc = JujuClient('/foo/bar', fake_host, None)
+        with patch('buildcloud.juju.run_command', autospec=True,
+                   side_effect=[error]) as jrc_mock:
+            jc._bootstrap()
+        self.assertEqual(jrc_mock.call_count, 1)
+        self.assertEqual(jc.bootstrapped, [])
+        self.assertIn('Bootstrapping failed on joyent',
+                      self.log_stream.getvalue())
+
+    def test__bootstrap_retry(self):
+        fake_host = FakeHost()
+        fake_host.controllers = ['joyent']
+        throttled = subprocess.CalledProcessError(1, 'juju')
+        throttled.stderr = 'ERROR RequestLimitExceeded: Request limit exceeded'
+        timeout = subprocess.CalledProcessError(1, 'juju')
+        timeout.stderr = 'ERROR dial tcp 10.0.0.1:443: i/o timeout'
+        unknown = subprocess.CalledProcessError(1, 'juju')
+        jc = JujuClient('/foo/bar', fake_host, None, bootstrap_backoff=10)
+        with patch('buildcloud.juju.run_command', autospec=True,
+                   side_effect=[throttled, unknown, timeout, unknown,
+                                None]) as jrc_mock:
+            with patch.object(jc._interrupted, 'wait',
+                              autospec=True) as sleep_mock:
+                jc._bootstrap()
+        self.assertEqual(
+            [c[0][0][1] for c in jrc_mock.call_args_list],
+            ['bootstrap', 'kill-controller', 'bootstrap', 'kill-controller',
+             'bootstrap'])
+        self.assertEqual(jc.bootstrapped, ['joyent'])
+        delays = [c[0][0] for c in sleep_mock.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertTrue(5 <= delays[0] <= 10)
+        self.assertTrue(10 <= delays[1] <= 20)
+        self.assertIn('after a rate-limit error', self.log_stream.getvalue())
+        self.assertIn('after a transient error', self.log_stream.getvalue())
+
+    def test__bootstrap_retries_exhausted(self):
+        fake_host = FakeHost()
+        fake_host.controllers = ['joyent']
+        error = subprocess.CalledProcessError(1, 'juju')
+        error.stderr = 'ERROR connection reset by peer'
+        jc = JujuClient('/foo/bar', fake_host, None, bootstrap_retries=1)
+        with patch('buildcloud.juju.run_command', autospec=True,
+                   side_effect=[error, None, error]) as jrc_mock:
+            with patch.object(jc._interrupted, 'wait',
+                              autospec=True) as sleep_mock:
+                jc._bootstrap()
+        self.assertEqual(jrc_mock.call_count, 3)
+        self.assertEqual(sleep_mock.call_count, 1)
+        self.assertEqual(jc.bootstrapped, [])
+        self.assertIn('Bootstrapping failed on joyent: transient error.',
+                      self.log_stream.getvalue())
+
+    def test__bootstrap_fatal_not_retried(self):
+        fake_host = FakeHost()
+        fake_host.controllers = ['joyent']
+        error = subprocess.CalledProcessError(1, 'juju')
+        error.stderr = 'ERROR invalid constraint value: mem=lots'
+        jc = JujuClient('/foo/bar', fake_host, None)
+        with patch('buildcloud.juju.run_command', autospec=True,
+                   side_effect=[error]) as jrc_mock:
+            with patch.object(jc._interrupted, 'wait',
+                              autospec=True) as sleep_mock:
+                jc._bootstrap()
+        self.assertEqual(jrc_mock.call_count, 1)
+        self.assertEqual(sleep_mock.call_count, 0)
+        self.assertIn('Bootstrapping failed on joyent: fatal error.',
+                      self.log_stream.getvalue())
+
+    def test__choose_cloud(self):
+        jc = JujuClient('/foo/bar', FakeHost(), None)
+        clouds = ['aws/a', 'aws/b']
+        self.assertEqual(jc._choose_cloud(clouds, []), 'aws/a')
+        self.assertEqual(jc._choose_cloud(clouds, []), 'aws/b')
+        self.assertEqual(jc._choose_cloud(clouds, []), 'aws/a')
+        self.assertEqual(jc._choose_cloud(clouds, ['aws/a']), 'aws/b')
+        self.assertIsNone(jc._choose_cloud(clouds, clouds))
+        self.assertEqual(jc._bootstrapping, {'aws/a': 2, 'aws/b': 2})
+
     def test__bootstrap_bootstrap_constraints(self):
         fake_host = FakeHost()
         jc = JujuClient('/foo/bar', fake_host, None,
@@ -73,12 +217,14 @@ class TestJujuClient(TestCase):
         with patch('buildcloud.juju.run_command', autospec=True) as jrc_mock:
             jc._bootstrap()
         calls = ([
-            call('/foo/bar bootstrap --show-log google/europe-west1 gce '
-                 '--default-model gce --no-gui --bootstrap-constraints '
-                 'tags=ob --config foo=bar'),
-            call('/foo/bar bootstrap --show-log azure/northeurope azure '
-                 '--default-model azure --no-gui --bootstrap-constraints '
-                 'tags=ob --config foo=bar')
+            call(['/foo/bar', 'bootstrap', '--show-log', 'google/europe-west1',
+                  'gce', '--default-model', 'gce', '--no-gui',
+                  '--bootstrap-constraints', 'tags=ob', '--config', 'foo=bar'],
+                 keep_output=False),
+            call(['/foo/bar', 'bootstrap', '--show-log', 'azure/northeurope',
+                  'azure', '--default-model', 'azure', '--no-gui',
+                  '--bootstrap-constraints', 'tags=ob', '--config', 'foo=bar'],
+                 keep_output=False)
         ])
         self.assertEqual(jrc_mock.call_args_list, calls)
         self.assertEqual(jc.bootstrapped, ['gce', 'azure'])
@@ -93,12 +239,14 @@ class TestJujuClient(TestCase):
         with patch('buildcloud.juju.run_command', autospec=True) as jrc_mock:
             jc._bootstrap()
         calls = ([
-            call('/foo/bar bootstrap --show-log google/europe-west1 gce '
-                 '--default-model gce --no-gui '
-                 '--constraints mem=2G --bootstrap-constraints tags=ob'),
-            call('/foo/bar bootstrap --show-log azure/northeurope azure '
-                 '--default-model azure --no-gui --constraints mem=2G '
-                 '--bootstrap-constraints tags=ob')
+            call(['/foo/bar', 'bootstrap', '--show-log', 'google/europe-west1',
+                  'gce', '--default-model', 'gce', '--no-gui', '--constraints',
+                  'mem=2G', '--bootstrap-constraints', 'tags=ob'],
+                 keep_output=False),
+            call(['/foo/bar', 'bootstrap', '--show-log', 'azure/northeurope',
+                  'azure', '--default-model', 'azure', '--no-gui',
+                  '--constraints', 'mem=2G', '--bootstrap-constraints',
+                  'tags=ob'], keep_output=False)
         ])
         self.assertEqual(jrc_mock.call_args_list, calls)
         self.assertEqual(jc.bootstrapped, ['gce', 'azure'])
@@ -111,15 +259,84 @@ class TestJujuClient(TestCase):
         with patch('buildcloud.juju.run_command', autospec=True) as jrc_mock:
             jc._bootstrap()
         calls = ([
-            call('/foo/bar bootstrap --show-log google/europe-west1 gce '
-                 '--default-model gce --no-gui'),
-            call('/foo/bar bootstrap --show-log azure/northeurope azure '
-                 '--default-model azure --no-gui')])
+            call(['/foo/bar', 'bootstrap', '--show-log', 'google/europe-west1',
+                  'gce', '--default-model', 'gce', '--no-gui'],
+                 keep_output=False),
+            call(['/foo/bar', 'bootstrap', '--show-log', 'azure/northeurope',
+                  'azure', '--default-model', 'azure', '--no-gui'],
+                 keep_output=False)])
         self.assertEqual(jrc_mock.call_args_list, calls)
         self.assertEqual(jc.bootstrapped, ['gce', 'azure'])
         self.assertEqual(jc.host.controllers,
                          ['gce:gce', 'azure:azure'])
 
+    def test__bootstrap_concurrent(self):
+        fake_host = FakeHost()
+        jc = JujuClient('/foo/bar', fake_host, None, bootstrap_concurrency=2)
+        azure_started = Event()
+
+        def fake_run_command(command, keep_output):
+            # gce only finishes once azure has started, which can only
+            # happen if both bootstraps run at the same time.
+            if 'gce' in command:
+                self.assertTrue(azure_started.wait(5))
+            else:
+                azure_started.set()
+                raise subprocess.CalledProcessError(1, command)
+
+        with patch('buildcloud.juju.run_command', autospec=True,
+                   side_effect=fake_run_command) as jrc_mock:
+            jc._bootstrap()
+        calls = ([
+            call(['/foo/bar', 'bootstrap', '--show-log', 'google/europe-west1',
+                  'gce', '--default-model', 'gce', '--no-gui'],
+                 keep_output=False),
+            call(['/foo/bar', 'bootstrap', '--show-log', 'azure/northeurope',
+                  'azure', '--default-model', 'azure', '--no-gui'],
+                 keep_output=False)])
+        self.assertItemsEqual(jrc_mock.call_args_list, calls)
+        self.assertEqual(jc.bootstrapped, ['gce'])
+        self.assertEqual(jc.host.controllers, ['gce:gce', 'azure:azure'])
+
+    def test__bootstrap_concurrent_keeps_order(self):
+        fake_host = FakeHost()
+        jc = JujuClient('/foo/bar', fake_host, None, bootstrap_concurrency=0)
+        azure_done = Event()
+
+        def fake_run_command(command, keep_output):
+            if 'gce' in command:
+                self.assertTrue(azure_done.wait(5))
+            else:
+                azure_done.set()
+
+        with patch('buildcloud.juju.run_command', autospec=True,
+                   side_effect=fake_run_command):
+            jc._bootstrap()
+        self.assertEqual(jc.bootstrapped, ['gce', 'azure'])
+
+    def test__bootstrap_records_phases(self):
+        self.addCleanup(reset_report)
+        report = reset_report()
+        jc = JujuClient('/foo/bar', FakeHost(), None)
+        with patch('buildcloud.juju.run_command', autospec=True,
+                   side_effect=[None, subprocess.CalledProcessError(1, '')]):
+            jc._bootstrap()
+        phases = [(p['name'], p['controller'], p['cloud'], p['status'])
+                  for p in report.phases]
+        self.assertEqual(phases, [
+            ('bootstrap-controller', 'gce', 'google/europe-west1', 'ok'),
+            ('bootstrap-controller', 'azure', 'azure/northeurope', 'failed'),
+        ])
+
+    def test__bootstrap_unknown_cloud(self):
+        fake_host = FakeHost()
+        fake_host.controllers = ['gce', 'foo']
+        jc = JujuClient('/foo/bar', fake_host, None)
+        with patch('buildcloud.juju.run_command', autospec=True) as jrc_mock:
+            with self.assertRaisesRegexp(ValueError, 'Unknown cloud: foo'):
+                jc._bootstrap()
+        self.assertFalse(jrc_mock.called)
+
     def test_bootstrap(self):
         fake_host = FakeHost()
         jc = JujuClient('/foo/bar/juju', fake_host, None, config='foo=bar')
@@ -130,16 +347,32 @@ class TestJujuClient(TestCase):
                     with jc.bootstrap() as bootstrapped:
                         pass
         calls = ([
-            call('/foo/bar/juju --version'),
-            call('/foo/bar/juju bootstrap --show-log google/europe-west1 gce '
-                 '--default-model gce --no-gui --config foo=bar'),
-            call('/foo/bar/juju bootstrap --show-log azure/northeurope azure '
-                 '--default-model azure --no-gui --config foo=bar')])
+            call(['/foo/bar/juju', '--version']),
+            call(['/foo/bar/juju', 'bootstrap', '--show-log',
+                  'google/europe-west1', 'gce', '--default-model', 'gce',
+                  '--no-gui', '--config', 'foo=bar'],
+                 keep_output=False),
+            call(['/foo/bar/juju', 'bootstrap', '--show-log',
+                  'azure/northeurope', 'azure', '--default-model', 'azure',
+                  '--no-gui', '--config', 'foo=bar'],
+                 keep_output=False)])
         self.assertEqual(jrc_mock.call_args_list, calls)
         crl_mock.assert_called_once_with()
         d_mock.assert_called_once_with()
         self.assertEqual(bootstrapped, ['gce:gce', 'azure:azure'])
 
+    def test_bootstrap_on_bootstrapped(self):
+        fake_host = FakeHost()
+        jc = JujuClient('/foo/bar/juju', fake_host, None)
+        ready = []
+        with patch('buildcloud.juju.run_command', autospec=True,
+                   side_effect=[None, subprocess.CalledProcessError('', ''),
+                                None]):
+            with patch.object(jc, 'cleanup', autospec=True):
+                with jc.bootstrap(on_bootstrapped=ready.append):
+                    pass
+        self.assertEqual(ready, ['azure'])
+
     def test_bootstrap_with_cloud_fail(self):
         fake_host = FakeHost()
         jc = JujuClient('/foo/bar/juju', fake_host, None)
@@ -153,11 +386,13 @@ class TestJujuClient(TestCase):
                     with jc.bootstrap() as bootstrapped:
                         pass
         calls = ([
-            call('/foo/bar/juju --version'),
-            call('/foo/bar/juju bootstrap --show-log google/europe-west1 gce '
-                 '--default-model gce --no-gui'),
-            call('/foo/bar/juju bootstrap --show-log azure/northeurope azure '
-                 '--default-model azure --no-gui')])
+            call(['/foo/bar/juju', '--version']),
+            call(['/foo/bar/juju', 'bootstrap', '--show-log',
+                  'google/europe-west1', 'gce', '--default-model', 'gce',
+                  '--no-gui'], keep_output=False),
+            call(['/foo/bar/juju', 'bootstrap', '--show-log',
+                  'azure/northeurope', 'azure', '--default-model', 'azure',
+                  '--no-gui'], keep_output=False)])
         self.assertEqual(jrc_mock.call_args_list, calls)
         crl_mock.assert_called_once_with()
         d_mock.assert_called_once_with()
@@ -165,98 +400,113 @@ class TestJujuClient(TestCase):
 
     def test_copy_remote_logs(self):
         fake_host = FakeHost()
-        jc = JujuClient('/foo/bar', fake_host, '/tmp/log')
-        jc.bootstrapped = ['cwr-gce', 'cwr-azure']
-        with patch.object(jc, 'run', autospec=True,
-                          side_effect=['file1', None, None,
-                                       'file2', None, None,
-                                       'file3', None, None,
-                                       'file4', None, None,
-                                       'file5', None, None,
-                                       'file6', None, None,
-                                       'file7', None, None,
-                                       'file8', None, None,
-                                       'file9', None, None,
-                                       'file10', None, None,
-                                       'file12', None, None,
-                                       'file13', None, None,
-                                       ]
-                          ) as r_mock:
-            with patch.object(jc, 'get_status', autospec=True,
-                              return_value=None) as gs_mock:
-                with patch('buildcloud.juju.yaml.safe_load', autospec=True,
-                           return_value={'machines': {'0': ''}}):
+        with temp_dir() as log_dir:
+            jc = JujuClient('/foo/bar', fake_host, log_dir)
+            jc.bootstrapped = ['cwr-gce', 'cwr-azure']
+            fake_run = FakeRemoteLogs(['syslog', 'juju/machine-0.log'])
+            with patch.object(jc, 'run', autospec=True,
+                              side_effect=fake_run) as r_mock:
+                status = Status({'machines': {'0': {}}})
+                with patch.object(jc, 'get_status', autospec=True,
+                                  return_value=status) as gs_mock:
                     jc.copy_remote_logs()
+            files = sorted(os.listdir(log_dir))
+            with open(os.path.join(log_dir, 'cwr-gce-cwr-gce--syslog')) as f:
+                content = f.read()
         gs_calls = [call(model='cwr-gce:cwr-gce'),
                     call(model='cwr-azure:cwr-azure')]
         self.assertEqual(gs_mock.call_args_list, gs_calls)
-        r_calls = [
-            call('ssh', '0 ls /var/log/cloud-init*.log', 'cwr-gce:cwr-gce'),
-            call('ssh', '0 sudo chmod  -Rf go+r file1',
-                 model='cwr-gce:cwr-gce'),
-            call('scp', '-- -rC 0:file1 /tmp/log/cwr-gce-cwr-gce--file1',
-                 model='cwr-gce:cwr-gce'),
-            call('ssh', '0 ls /var/log/juju/*.log', 'cwr-gce:cwr-gce'),
-            call('ssh', '0 sudo chmod  -Rf go+r file2',
-                 model='cwr-gce:cwr-gce'),
-            call('scp', '-- -rC 0:file2 /tmp/log/cwr-gce-cwr-gce--file2',
-                 model='cwr-gce:cwr-gce'),
-            call('ssh', '0 ls /var/log/syslog', 'cwr-gce:cwr-gce'),
-            call('ssh', '0 sudo chmod  -Rf go+r file3',
-                 model='cwr-gce:cwr-gce'),
-            call('scp', '-- -rC 0:file3 /tmp/log/cwr-gce-cwr-gce--file3',
-                 model='cwr-gce:cwr-gce'),
-            call('ssh', '0 ls /var/log/cloud-init*.log', 'cwr-gce:controller'),
-            call('ssh', '0 sudo chmod  -Rf go+r file4',
-                 model='cwr-gce:controller'),
-            call('scp', '-- -rC 0:file4 /tmp/log/cwr-gce-controller--file4',
-                 model='cwr-gce:controller'),
-            call('ssh', '0 ls /var/log/juju/*.log', 'cwr-gce:controller'),
-            call('ssh', '0 sudo chmod  -Rf go+r file5',
-                 model='cwr-gce:controller'),
-            call('scp', '-- -rC 0:file5 /tmp/log/cwr-gce-controller--file5',
-                 model='cwr-gce:controller'),
-            call('ssh', '0 ls /var/log/syslog', 'cwr-gce:controller'),
-            call('ssh', '0 sudo chmod  -Rf go+r file6',
-                 model='cwr-gce:controller'),
-            call('scp', '-- -rC 0:file6 /tmp/log/cwr-gce-controller--file6',
-                 model='cwr-gce:controller'),
-            call('ssh', '0 ls /var/log/cloud-init*.log',
-                 'cwr-azure:cwr-azure'),
-            call('ssh', '0 sudo chmod  -Rf go+r file7',
-                 model='cwr-azure:cwr-azure'),
-            call('scp', '-- -rC 0:file7 /tmp/log/cwr-azure-cwr-azure--file7',
-                 model='cwr-azure:cwr-azure'),
-            call('ssh', '0 ls /var/log/juju/*.log', 'cwr-azure:cwr-azure'),
-            call('ssh', '0 sudo chmod  -Rf go+r file8',
-                 model='cwr-azure:cwr-azure'),
-            call('scp', '-- -rC 0:file8 /tmp/log/cwr-azure-cwr-azure--file8',
-                 model='cwr-azure:cwr-azure'),
-            call('ssh', '0 ls /var/log/syslog', 'cwr-azure:cwr-azure'),
-            call('ssh', '0 sudo chmod  -Rf go+r file9',
-                 model='cwr-azure:cwr-azure'),
-            call('scp', '-- -rC 0:file9 /tmp/log/cwr-azure-cwr-azure--file9',
-                 model='cwr-azure:cwr-azure'),
-            call('ssh', '0 ls /var/log/cloud-init*.log',
-                 'cwr-azure:controller'),
-            call('ssh', '0 sudo chmod  -Rf go+r file10',
-                 model='cwr-azure:controller'),
-            call('scp',
-                 '-- -rC 0:file10 /tmp/log/cwr-azure-controller--file10',
-                 model='cwr-azure:controller'),
-            call('ssh', '0 ls /var/log/juju/*.log', 'cwr-azure:controller'),
-            call('ssh', '0 sudo chmod  -Rf go+r file12',
-                 model='cwr-azure:controller'),
-            call('scp',
-                 '-- -rC 0:file12 /tmp/log/cwr-azure-controller--file12',
-                 model='cwr-azure:controller'),
-            call('ssh', '0 ls /var/log/syslog', 'cwr-azure:controller'),
-            call('ssh', '0 sudo chmod  -Rf go+r file13',
-                 model='cwr-azure:controller'),
-            call('scp',
-                 '-- -rC 0:file13 /tmp/log/cwr-azure-controller--file13',
-                 model='cwr-azure:controller')]
-        self.assertEqual(r_mock.call_args_list, r_calls)
+        ssh_args = ['0', 'sudo rm -f /tmp/cwr-logs.tar.gz ; '
+                    'sudo tar -czf /tmp/cwr-logs.tar.gz '
+                    '--ignore-failed-read /var/log/cloud-init*.log '
+                    '/var/log/juju/*.log /var/log/syslog && '
+                    'sudo chmod go+r /tmp/cwr-logs.tar.gz']
+        models = ['cwr-gce:cwr-gce', 'cwr-gce:controller',
+                  'cwr-azure:cwr-azure', 'cwr-azure:controller']
+        self.assertEqual(
+            [c for c in r_mock.call_args_list if c[0][0] == 'ssh'],
+            [call('ssh', ssh_args, model=m) for m in models])
+        self.assertEqual(len(r_mock.call_args_list), 8)
+        self.assertEqual(files, [
+            'cwr-azure-controller--machine-0.log',
+            'cwr-azure-controller--syslog',
+            'cwr-azure-cwr-azure--machine-0.log',
+            'cwr-azure-cwr-azure--syslog',
+            'cwr-gce-controller--machine-0.log',
+            'cwr-gce-controller--syslog',
+            'cwr-gce-cwr-gce--machine-0.log',
+            'cwr-gce-cwr-gce--syslog',
+        ])
+        self.assertEqual(content, 'syslog content')
+
+    def test_copy_remote_logs_concurrent(self):
+        fake_host = FakeHost()
+        with temp_dir() as log_dir:
+            jc = JujuClient('/foo/bar', fake_host, log_dir,
+                            log_concurrency=4)
+            jc.bootstrapped = ['cwr-gce']
+            fake_run = FakeRemoteLogs(['syslog'])
+            with patch.object(jc, 'run', autospec=True,
+                              side_effect=fake_run) as r_mock:
+                status = Status({'machines': {'0': {}, '1': {}}})
+                with patch.object(jc, 'get_status', autospec=True,
+                                  return_value=status):
+                    jc.copy_remote_logs()
+            files = sorted(os.listdir(log_dir))
+        self.assertEqual(len(r_mock.call_args_list), 6)
+        self.assertEqual(files, ['cwr-gce-controller--syslog',
+                                 'cwr-gce-cwr-gce--syslog'])
+
+    def test_copy_remote_logs_failure(self):
+        fake_host = FakeHost()
+        with temp_dir() as log_dir:
+            jc = JujuClient('/foo/bar', fake_host, log_dir)
+            jc.bootstrapped = ['cwr-gce']
+            with patch.object(jc, 'run', autospec=True,
+                              side_effect=subprocess.CalledProcessError(
+                                  1, 'ssh')) as r_mock:
+                status = Status({'machines': {'0': {}}})
+                with patch.object(jc, 'get_status', autospec=True,
+                                  return_value=status):
+                    jc.copy_remote_logs()
+            self.assertEqual(os.listdir(log_dir), [])
+        self.assertEqual(len(r_mock.call_args_list), 2)
+        self.assertIn('Could not get logs for cwr-gce:cwr-gce machine 0',
+                      self.log_stream.getvalue())
+
+    def test_copy_remote_logs_no_machines(self):
+        fake_host = FakeHost()
+        jc = JujuClient('/foo/bar', fake_host, '/tmp/log')
+        jc.bootstrapped = ['cwr-gce']
+        with patch.object(jc, 'run', autospec=True) as r_mock:
+            with patch.object(jc, 'get_status', autospec=True,
+                              return_value=Status({'machines': {}})):
+                jc.copy_remote_logs()
+        self.assertFalse(r_mock.called)
+        self.assertIn('No machines listed.', self.log_stream.getvalue())
+
+    def test_copy_remote_logs_options(self):
+        with temp_dir() as log_dir:
+            jc = JujuClient('/foo/bar', FakeHost(), log_dir,
+                            log_options=LogOptions(True, 100, 30, True))
+            jc.bootstrapped = ['cwr-gce']
+            jc.bootstrap_started = 1500000000.5
+            fake_run = FakeRemoteLogs(['syslog', 'juju/machine-0.log'])
+            status = Status({'machines': {'0': {}}})
+            with patch.object(jc, 'run', autospec=True,
+                              side_effect=fake_run) as r_mock:
+                with patch.object(jc, 'get_status', autospec=True,
+                                  return_value=status):
+                    jc.copy_remote_logs()
+            files = sorted(os.listdir(log_dir))
+        ssh_args = r_mock.call_args_list[0][0][1]
+        self.assertEqual(ssh_args,
+                         ['0', make_log_command(100, 1500000000.5)])
+        # The 30 byte run cap is used up by the logs of the first machine,
+        # so the logs of the controller machine are skipped.
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all(f.endswith('.gz') for f in files))
+        self.assertIn('Log size cap reached', self.log_stream.getvalue())
 
     def test__destroy(self):
         fake_host = FakeHost()
@@ -265,8 +515,12 @@ class TestJujuClient(TestCase):
         with patch('buildcloud.juju.run_command', autospec=True) as jrc_mock:
             jc._destroy()
         calls = ([
-            call('/foo/bar/juju --debug kill-controller cwr-gce -y'),
-            call('/foo/bar/juju --debug kill-controller cwr-azure -y')])
+            call(['/foo/bar/juju', '--debug', 'kill-controller', 'cwr-gce',
+                  '-y'],
+                 timeout=None, keep_output=False),
+            call(['/foo/bar/juju', '--debug', 'kill-controller', 'cwr-azure',
+                  '-y'],
+                 timeout=None, keep_output=False)])
         self.assertEqual(jrc_mock.call_args_list, calls)
 
     def test__destroy_exception(self):
@@ -278,9 +532,386 @@ class TestJujuClient(TestCase):
                    ) as jrc_mock:
             jc._destroy()
         calls = ([
-            call('/foo/bar/juju --debug kill-controller cwr-gce -y'),
-            call('/foo/bar/juju --debug kill-controller cwr-azure -y')])
+            call(['/foo/bar/juju', '--debug', 'kill-controller', 'cwr-gce',
+                  '-y'],
+                 timeout=None, keep_output=False),
+            call(['/foo/bar/juju', '--debug', 'kill-controller', 'cwr-azure',
+                  '-y'],
+                 timeout=None, keep_output=False)])
         self.assertEqual(jrc_mock.call_args_list, calls)
+        self.assertEqual(jc.bootstrapped, ['cwr-azure'])
+        self.assertIn('Failed to kill controllers: cwr-azure',
+                      self.log_stream.getvalue())
+
+    def test_teardown(self):
+        jc = JujuClient('/foo/bar/juju', FakeHost(), None)
+        jc.bootstrapped = ['cwr-gce', 'cwr-azure']
+        both_killing = Event()
+        killing = []
+
+        def fake_run_command(command, timeout, keep_output):
+            killing.append(command[3])
+            if len(killing) == 2:
+                both_killing.set()
+            self.assertTrue(both_killing.wait(5))
+
+        with patch.object(jc, 'copy_remote_logs', autospec=True) as crl_mock:
+            with patch('buildcloud.juju.run_command', autospec=True,
+                       side_effect=fake_run_command):
+                jc.teardown(60)
+            crl_mock.assert_called_once_with()
+            self.assertEqual(sorted(killing), ['cwr-azure', 'cwr-gce'])
+            self.assertEqual(jc.bootstrapped, [])
+            jc.cleanup()
+            jc.teardown(60)
+        self.assertEqual(crl_mock.call_count, 1)
+
+    def test_teardown_during_cleanup(self):
+        jc = JujuClient('/foo/bar/juju', FakeHost(), None)
+        jc.bootstrapped = ['cwr-gce', 'cwr-azure']
+        copying = Event()
+        release = Event()
+        self.addCleanup(release.set)
+
+        def copy_remote_logs():
+            copying.set()
+            release.wait(5)
+
+        with patch.object(jc, 'copy_remote_logs', autospec=True,
+                          side_effect=copy_remote_logs) as crl_mock:
+            with patch('buildcloud.juju.run_command',
+                       autospec=True) as jrc_mock:
+                results = []
+                cleanup = Thread(
+                    target=lambda: results.append(jc.cleanup()))
+                cleanup.start()
+                self.assertTrue(copying.wait(5))
+                # The running cleanup stops waiting for the logs.
+                jc.teardown(0.1)
+                self.assertFalse(release.is_set())
+                self.assertEqual(jrc_mock.call_count, 2)
+                cleanup.join(5)
+                jc.cleanup()
+        self.assertEqual(results, [None])
+        self.assertEqual(crl_mock.call_count, 1)
+        self.assertEqual(jrc_mock.call_count, 2)
+        self.assertEqual(jc.bootstrapped, [])
+        self.assertIn('Gave up collecting logs after 0.1 seconds.',
+                      self.log_stream.getvalue())
+
+    def test_interrupt_during_destroy(self):
+        jc = JujuClient('/foo/bar/juju', FakeHost(), None,
+                        destroy_concurrency=1)
+        jc.bootstrapped = ['cwr-gce', 'cwr-azure', 'cwr-aws']
+        started = []
+        all_started = Event()
+
+        def fake_run_command(command, timeout, keep_output):
+            started.append(command[3])
+            if len(started) == 1:
+                jc.interrupt(60)
+            if len(started) == 3:
+                all_started.set()
+            # The kills only finish once they all run at the same time.
+            self.assertTrue(all_started.wait(5))
+
+        with patch('buildcloud.juju.run_command', autospec=True,
+                   side_effect=fake_run_command):
+            jc._destroy()
+        self.assertEqual(sorted(started), ['cwr-aws', 'cwr-azure', 'cwr-gce'])
+        self.assertEqual(jc.bootstrapped, [])
+
+    def test_teardown_during_bootstrap(self):
+        fake_host = FakeHost()
+        fake_host.controllers = ['cwr-aws', 'cwr-gce']
+        jc = JujuClient('/foo/bar/juju', fake_host, None,
+                        bootstrap_concurrency=0)
+        aws_done = Event()
+        gce_started = Event()
+        torn_down = Event()
+        on_bootstrapped = []
+
+        def fake_run_command(command, timeout=None, keep_output=True):
+            if command[1] != 'bootstrap':
+                return
+            if 'cwr-aws' in command:
+                aws_done.set()
+            else:
+                # cwr-gce is still bootstrapping during the teardown.
+                gce_started.set()
+                self.assertTrue(torn_down.wait(5))
+
+        def teardown():
+            self.assertTrue(aws_done.wait(5))
+            self.assertTrue(gce_started.wait(5))
+            # Let the aws bootstrap record itself.
+            while 'cwr-aws' not in jc.bootstrapped:
+                sleep(0.01)
+            jc.teardown(60)
+            torn_down.set()
+
+        with patch.object(jc, 'copy_remote_logs', autospec=True):
+            with patch('buildcloud.juju.run_command', autospec=True,
+                       side_effect=fake_run_command) as jrc_mock:
+                thread = Thread(target=teardown)
+                thread.start()
+                with jc.bootstrap(
+                        on_bootstrapped=on_bootstrapped.append) as models:
+                    self.assertEqual(models, [])
+                thread.join(5)
+        killed = [c[0][0][3] for c in jrc_mock.call_args_list
+                  if 'kill-controller' in c[0][0]]
+        self.assertEqual(killed, ['cwr-aws', 'cwr-gce'])
+        self.assertEqual(on_bootstrapped, ['cwr-aws'])
+        self.assertEqual(jc.bootstrapped, [])
+        self.assertIn('Killing the controllers left after the teardown: '
+                      'cwr-gce', self.log_stream.getvalue())
+
+    def test__bootstrap_controller_interrupted(self):
+        jc = JujuClient('/foo/bar/juju', FakeHost(), None)
+        jc.interrupt(60)
+        with patch('buildcloud.juju.run_command', autospec=True) as jrc_mock:
+            self.assertFalse(
+                jc._bootstrap_controller(('cwr-aws', ['aws'])))
+        self.assertFalse(jrc_mock.called)
+        self.assertIn('Not bootstrapping cwr-aws after the interruption.',
+                      self.log_stream.getvalue())
+
+    def test_teardown_log_timeout(self):
+        jc = JujuClient('/foo/bar/juju', FakeHost(), None)
+        jc.bootstrapped = ['cwr-gce']
+        release = Event()
+        self.addCleanup(release.set)
+        with patch.object(jc, 'copy_remote_logs', autospec=True,
+                          side_effect=lambda: release.wait(5)):
+            with patch('buildcloud.juju.run_command',
+                       autospec=True) as jrc_mock:
+                jc.teardown(0.1)
+        self.assertEqual(jrc_mock.call_count, 1)
+        self.assertEqual(jc.bootstrapped, [])
+        self.assertIn('Gave up collecting logs after 0.1 seconds.',
+                      self.log_stream.getvalue())
+
+    def test_teardown_abort(self):
+        jc = JujuClient('/foo/bar/juju', FakeHost(), None)
+        jc.bootstrapped = ['cwr-gce']
+        release = Event()
+        self.addCleanup(release.set)
+        abort = Event()
+        abort.set()
+        with patch.object(jc, 'copy_remote_logs', autospec=True,
+                          side_effect=lambda: release.wait(5)):
+            with patch('buildcloud.juju.run_command',
+                       autospec=True) as jrc_mock:
+                jc.teardown(60, abort=abort)
+        self.assertEqual(jrc_mock.call_count, 1)
+        self.assertIn('without waiting for their logs',
+                      self.log_stream.getvalue())
+
+    def test__destroy_concurrent(self):
+        fake_host = FakeHost()
+        jc = JujuClient('/foo/bar/juju', fake_host, None,
+                        destroy_concurrency=2, kill_timeout=600)
+        jc.bootstrapped = ['cwr-gce', 'cwr-azure', 'cwr-aws']
+        azure_started = Event()
+
+        def fake_run_command(command, timeout, keep_output):
+            if 'cwr-gce' in command:
+                self.assertTrue(azure_started.wait(5))
+                raise subprocess.CalledProcessError(-9, command)
+            azure_started.set()
+
+        with patch('buildcloud.juju.run_command', autospec=True,
+                   side_effect=fake_run_command) as jrc_mock:
+            jc._destroy()
+        calls = ([
+            call(['/foo/bar/juju', '--debug', 'kill-controller', 'cwr-gce',
+                  '-y'],
+                 timeout=600, keep_output=False),
+            call(['/foo/bar/juju', '--debug', 'kill-controller', 'cwr-azure',
+                  '-y'],
+                 timeout=600, keep_output=False),
+            call(['/foo/bar/juju', '--debug', 'kill-controller', 'cwr-aws',
+                  '-y'],
+                 timeout=600, keep_output=False)])
+        self.assertItemsEqual(jrc_mock.call_args_list, calls)
+        self.assertEqual(jc.bootstrapped, ['cwr-gce'])
+
+    def test__bootstrap_pool_lease(self):
+        with temp_dir() as juju_home:
+            fake_host = FakeHost()
+            fake_host.tmp_juju_home = juju_home
+            pool = ControllerPool(os.path.join(juju_home, 'pool.yaml'))
+            jc = JujuClient('/foo/bar', fake_host, None, constraints='mem=3G',
+                            config='test-mode=true', pool=pool)
+            pool.release('cwr-old-gce', jc.get_pool_key('google/europe-west1'),
+                         {'controllers.yaml': {'uuid': '1'}})
+            with patch('buildcloud.juju.run_command', autospec=True
+                       ) as jrc_mock:
+                with patch('buildcloud.juju.generate_test_id',
+                           return_value='abcdef0123'):
+                    jc._bootstrap()
+            with open(os.path.join(juju_home, 'controllers.yaml')) as f:
+                controllers = yaml.safe_load(f)
+        calls = [
+            call(['/foo/bar', 'models', '-c', 'cwr-old-gce'], timeout=120),
+            call(['/foo/bar', 'add-model', '-c', 'cwr-old-gce', 'cwr-abcdef01',
+                  '--config', 'test-mode=true']),
+            call(['/foo/bar', 'set-model-constraints', '-m',
+                  'cwr-old-gce:cwr-abcdef01', 'mem=3G']),
+            call(['/foo/bar', 'bootstrap', '--show-log', 'azure/northeurope',
+                  'azure', '--default-model', 'azure', '--no-gui',
+                  '--constraints', 'mem=3G', '--config', 'test-mode=true'],
+                 keep_output=False),
+        ]
+        self.assertEqual(jrc_mock.call_args_list, calls)
+        self.assertEqual(controllers,
+                         {'controllers': {'cwr-old-gce': {'uuid': '1'}}})
+        self.assertEqual(jc.bootstrapped, ['cwr-old-gce', 'azure'])
+        self.assertEqual(jc.host.controllers,
+                         ['cwr-old-gce:cwr-abcdef01', 'azure:azure'])
+
+    def test__bootstrap_pool_unusable_controller(self):
+        with temp_dir() as juju_home:
+            fake_host = FakeHost()
+            fake_host.controllers = ['gce']
+            fake_host.tmp_juju_home = juju_home
+            pool = ControllerPool(os.path.join(juju_home, 'pool.yaml'))
+            jc = JujuClient('/foo/bar', fake_host, None, pool=pool)
+            pool.release('cwr-old-gce', jc.get_pool_key('google/europe-west1'),
+                         {})
+            with patch('buildcloud.juju.run_command', autospec=True,
+                       side_effect=[subprocess.CalledProcessError(1, ''),
+                                    None, None]) as jrc_mock:
+                jc._bootstrap()
+        calls = [
+            call(['/foo/bar', 'models', '-c', 'cwr-old-gce'], timeout=120),
+            call(['/foo/bar', '--debug', 'kill-controller', 'cwr-old-gce',
+                  '-y'],
+                 timeout=None, keep_output=False),
+            call(['/foo/bar', 'bootstrap', '--show-log', 'google/europe-west1',
+                  'gce', '--default-model', 'gce', '--no-gui'],
+                 keep_output=False),
+        ]
+        self.assertEqual(jrc_mock.call_args_list, calls)
+        self.assertEqual(jc.bootstrapped, ['gce'])
+
+    def test__bootstrap_pool_evicts_expired(self):
+        with temp_dir() as juju_home:
+            fake_host = FakeHost()
+            fake_host.controllers = ['gce']
+            fake_host.tmp_juju_home = juju_home
+            pool = ControllerPool(os.path.join(juju_home, 'pool.yaml'),
+                                  ttl=60)
+            jc = JujuClient('/foo/bar', fake_host, None, pool=pool)
+            with patch('buildcloud.pool.time', return_value=0):
+                pool.release('cwr-old-gce',
+                             jc.get_pool_key('google/europe-west1'), {})
+            with patch('buildcloud.juju.run_command', autospec=True
+                       ) as jrc_mock:
+                jc._bootstrap()
+        calls = [
+            call(['/foo/bar', '--debug', 'kill-controller', 'cwr-old-gce',
+                  '-y'],
+                 timeout=None, keep_output=False),
+            call(['/foo/bar', 'bootstrap', '--show-log', 'google/europe-west1',
+                  'gce', '--default-model', 'gce', '--no-gui'],
+                 keep_output=False),
+        ]
+        self.assertEqual(jrc_mock.call_args_list, calls)
+
+    def test__destroy_pool_release(self):
+        with temp_dir() as juju_home:
+            fake_host = FakeHost()
+            fake_host.tmp_juju_home = juju_home
+            with open(os.path.join(juju_home, 'controllers.yaml'), 'w') as f:
+                yaml.safe_dump({'controllers': {'gce': {'uuid': '1'},
+                                                'azure': {'uuid': '2'}}}, f)
+            pool = ControllerPool(os.path.join(juju_home, 'pool.yaml'),
+                                  max_size=1)
+            jc = JujuClient('/foo/bar', fake_host, None, pool=pool)
+            pool.release('cwr-old-azure',
+                         jc.get_pool_key('azure/northeurope'), {})
+            jc.bootstrapped = ['gce', 'azure']
+            jc.pool_keys = {'gce': jc.get_pool_key('google/europe-west1'),
+                            'azure': jc.get_pool_key('azure/northeurope')}
+            with patch('buildcloud.juju.run_command', autospec=True
+                       ) as jrc_mock:
+                jc._destroy()
+            entry = pool.lease(jc.get_pool_key('google/europe-west1'))
+        calls = [
+            call(['/foo/bar', 'destroy-model', '-y', 'gce:gce']),
+            call(['/foo/bar', 'destroy-model', '-y', 'azure:azure']),
+            call(['/foo/bar', '--debug', 'kill-controller', 'azure', '-y'],
+                 timeout=None, keep_output=False),
+        ]
+        self.assertEqual(jrc_mock.call_args_list, calls)
+        self.assertEqual(entry['controller'], 'gce')
+        self.assertEqual(entry['data'],
+                         {'controllers.yaml': {'uuid': '1'}})
+        self.assertEqual(jc.bootstrapped, [])
+
+    def test__bootstrap_journal(self):
+        with temp_dir() as juju_home:
+            fake_host = FakeHost()
+            fake_host.tmp_juju_home = juju_home
+            with open(os.path.join(juju_home, 'controllers.yaml'), 'w') as f:
+                yaml.safe_dump({'controllers': {'gce': {'uuid': '1'}}}, f)
+            journal = Journal(os.path.join(juju_home, 'journal'),
+                              os.path.join(juju_home, 'data.json'))
+            jc = JujuClient('/foo/bar', fake_host, None, journal=journal)
+            with patch('buildcloud.juju.run_command', autospec=True):
+                jc._bootstrap()
+                live = journal.get_live_controllers()
+                data = journal.load_controller('gce')
+                jc._destroy()
+            self.assertEqual(journal.get_live_controllers(), {})
+        self.assertEqual(sorted(live), ['azure', 'gce'])
+        self.assertNotIn('data', live['gce'])
+        self.assertEqual(data, {'controllers.yaml': {'uuid': '1'}})
+        self.assertEqual(live['gce']['cloud'], 'google/europe-west1')
+        self.assertEqual(live['gce']['requested'], 'gce')
+        self.assertIsNone(live['gce']['model'])
+
+    def test_resume(self):
+        with temp_dir() as juju_home:
+            fake_host = FakeHost()
+            fake_host.tmp_juju_home = juju_home
+            journal = Journal(os.path.join(juju_home, 'journal'),
+                              os.path.join(juju_home, 'data.json'))
+            jc = JujuClient('/foo/bar', fake_host, None, journal=journal)
+            for controller, model in [('gce', 'cwr-1'), ('cwr-old', None)]:
+                journal.record(
+                    BOOTSTRAPPED, controller=controller, requested=controller,
+                    cloud='google/europe-west1', model=model,
+                    key=jc.get_pool_key('google/europe-west1'))
+                journal.save_controller(
+                    controller, {'controllers.yaml': {'uuid': controller}})
+            with patch('buildcloud.juju.run_command', autospec=True,
+                       side_effect=[subprocess.CalledProcessError(1, ''),
+                                    None, None, None]) as jrc_mock:
+                self.assertEqual(jc.resume(), ['gce'])
+                started = []
+                jc._bootstrap(on_bootstrapped=started.append)
+            with open(os.path.join(juju_home, 'controllers.yaml')) as f:
+                controllers = yaml.safe_load(f)
+            self.assertEqual(sorted(journal.get_live_controllers()),
+                             ['azure', 'gce'])
+        calls = [
+            call(['/foo/bar', 'models', '-c', 'cwr-old'], timeout=120),
+            call(['/foo/bar', '--debug', 'kill-controller', 'cwr-old', '-y'],
+                 timeout=None, keep_output=False),
+            call(['/foo/bar', 'models', '-c', 'gce'], timeout=120),
+            call(['/foo/bar', 'bootstrap', '--show-log', 'azure/northeurope',
+                  'azure', '--default-model', 'azure', '--no-gui'],
+                 keep_output=False),
+        ]
+        self.assertEqual(jrc_mock.call_args_list, calls)
+        self.assertEqual(sorted(controllers['controllers']),
+                         ['cwr-old', 'gce'])
+        self.assertEqual(started, ['gce', 'azure'])
+        self.assertEqual(jc.bootstrapped, ['gce', 'azure'])
+        self.assertEqual(jc.host.controllers, ['gce:cwr-1', 'azure:azure'])
 
     def test_get_model(self):
         fake_host = FakeHost()
@@ -293,13 +924,311 @@ class TestJujuClient(TestCase):
         jc = JujuClient('/foo/bar', fake_host, None)
         with patch('buildcloud.juju.run_command', autospec=True,
                    return_value='foo') as jrc_mock:
-            result = jc.run('bzr', '--version', 'bzr-model')
-        jrc_mock.assert_called_once_with('/foo/bar bzr -m bzr-model --version')
+            result = jc.run('bzr', ['--version'], 'bzr-model')
+        jrc_mock.assert_called_once_with(['/foo/bar', 'bzr', '-m', 'bzr-model',
+                                          '--version'])
         self.assertEqual(result, 'foo')
 
+    def test_run_async(self):
+        fake_host = FakeHost()
+        runner = Mock(spec=['submit'])
+        jc = JujuClient('/foo/bar', fake_host, None, runner=runner)
+        future = jc.run_async('bzr', ['--version'], 'bzr-model')
+        runner.submit.assert_called_once_with(['/foo/bar', 'bzr', '-m',
+                                               'bzr-model', '--version'])
+        self.assertIs(future, runner.submit.return_value)
+
+    def test_get_status_async(self):
+        fake_host = FakeHost()
+        jc = JujuClient('echo', fake_host, None)
+        futures = [jc.get_status_async(model=m) for m in ['foo', 'bar']]
+        self.assertEqual([f.result(10) for f in futures], [
+            'status -m foo --format json\n',
+            'status -m bar --format json\n'])
+
+    def test_get_status(self):
+        jc = JujuClient('/foo/bar', FakeHost(), None)
+        with patch.object(jc, 'run', autospec=True,
+                          return_value=json.dumps(STATUS)) as r_mock:
+            status = jc.get_status(model='foo')
+            self.assertIs(jc.get_status(model='foo'), status)
+            jc.get_status(model='bar')
+            jc.get_status(model='foo', refresh=True)
+            jc.invalidate_status('foo')
+            jc.get_status(model='foo')
+        self.assertEqual(r_mock.call_args_list, [
+            call('status', ['--format', 'json'], model='foo'),
+            call('status', ['--format', 'json'], model='bar'),
+            call('status', ['--format', 'json'], model='foo'),
+            call('status', ['--format', 'json'], model='foo')])
+        self.assertEqual(status.machines.keys(), ['0'])
+
+    def test_get_status_expired(self):
+        jc = JujuClient('/foo/bar', FakeHost(), None, status_ttl=0)
+        with patch.object(jc, 'run', autospec=True,
+                          return_value='{}') as r_mock:
+            jc.get_status(model='foo')
+            jc.get_status(model='foo')
+        self.assertEqual(r_mock.call_count, 2)
+
+    def test_add_model(self):
+        jc = JujuClient('/foo/bar', FakeHost(), None, config='foo=bar',
+                        constraints='mem=3G')
+        with patch.object(jc, 'run', autospec=True) as r_mock:
+            model = jc.add_model('gce', 'plan')
+        self.assertEqual(model, 'gce:plan')
+        self.assertEqual(r_mock.call_args_list, [
+            call('add-model', ['-c', 'gce', 'plan', '--config', 'foo=bar']),
+            call('set-model-constraints', ['mem=3G'], model='gce:plan')])
+
+    def test_get_constraints(self):
+        jc = JujuClient('/foo/bar', FakeHost(), None, constraints='mem=3G')
+        route = Route('gce', 'google', None, 'cores=4 mem=8G', None,
+                      None)
+        with patch('buildcloud.juju.get_route', autospec=True,
+                   return_value=route) as gr_mock:
+            self.assertEqual(jc.get_constraints('cwr-gce'), 'cores=4 mem=3G')
+            self.assertEqual(jc.get_args('cwr-gce'), [
+                '--constraints', 'cores=4 mem=3G'])
+        gr_mock.assert_called_with('cwr-gce')
+        self.assertEqual(jc.get_constraints('cwr-gce'), 'mem=3G')
+
+    def test_merge_constraints(self):
+        self.assertEqual(merge_constraints(None, 'mem=3G'), 'mem=3G')
+        self.assertEqual(merge_constraints('mem=8G', None), 'mem=8G')
+        self.assertEqual(
+            merge_constraints('cores=4 mem=8G arch=amd64', 'mem=3G cores=2'),
+            'arch=amd64 mem=3G cores=2')
+
+    def test_get_model_limit(self):
+        jc = JujuClient('/foo/bar', FakeHost(), None,
+                        model_limits={'aws': 2, 'azure/northeurope': 1})
+        self.assertEqual(jc.get_model_limit('aws/sa-east-1'), 2)
+        self.assertEqual(jc.get_model_limit('azure/northeurope'), 1)
+        self.assertIsNone(jc.get_model_limit('azure/westus'))
+        self.assertIsNone(jc.get_model_limit(None))
+
+    def test_temp_models_limit_across_regions(self):
+        jc = JujuClient('/foo/bar', FakeHost(), None,
+                        model_limits={'aws': 1})
+        jc.pool_keys = {'aws-1': jc.get_pool_key('aws/sa-east-1'),
+                        'aws-2': jc.get_pool_key('aws/us-east-1')}
+        in_use = []
+        peak = []
+
+        def use_model(controller):
+            with jc.temp_models([controller]):
+                in_use.append(controller)
+                peak.append(len(in_use))
+                sleep(0.05)
+                in_use.remove(controller)
+
+        with patch.object(jc, 'run', autospec=True):
+            results = run_concurrently(
+                use_model, ['aws-1', 'aws-2'], max_workers=2)
+        self.assertEqual([e for _, _, e in results], [None] * 2)
+        self.assertEqual(peak, [1, 1])
+
+    def test_temp_models(self):
+        jc = JujuClient('/foo/bar', FakeHost(), None)
+        with patch('buildcloud.juju.generate_test_id', autospec=True,
+                   side_effect=['1' * 32, '2' * 32]):
+            with patch.object(jc, 'run', autospec=True) as r_mock:
+                with jc.temp_models(['gce', 'azure']) as models:
+                    self.assertEqual(len(r_mock.call_args_list), 2)
+        self.assertEqual(models, ['gce:cwr-11111111', 'azure:cwr-22222222'])
+        self.assertEqual(r_mock.call_args_list[2:], [
+            call('destroy-model', ['-y', 'gce:cwr-11111111']),
+            call('destroy-model', ['-y', 'azure:cwr-22222222'])])
+
+    def test_temp_models_limit(self):
+        jc = JujuClient('/foo/bar', FakeHost(), None,
+                        model_limits={'google': 1})
+        in_use = []
+        peak = []
+
+        def use_model(item):
+            with jc.temp_models(['gce']):
+                in_use.append(item)
+                peak.append(len(in_use))
+                sleep(0.05)
+                in_use.remove(item)
+
+        with patch.object(jc, 'run', autospec=True):
+            results = run_concurrently(use_model, range(3), max_workers=3)
+        self.assertEqual([e for _, _, e in results], [None] * 3)
+        self.assertEqual(peak, [1, 1, 1])
+
+    def test_temp_models_destroy_fails(self):
+        jc = JujuClient('/foo/bar', FakeHost(), None)
+
+        def run(command, args='', model=''):
+            if command == 'destroy-model':
+                raise subprocess.CalledProcessError(1, command)
+
+        with patch.object(jc, 'run', autospec=True, side_effect=run):
+            with jc.temp_models(['gce']) as models:
+                pass
+        self.assertIn('Could not destroy model {}.'.format(models[0]),
+                      self.log_stream.getvalue())
+
+    def test_wait_for(self):
+        jc = JujuClient('/foo/bar', FakeHost(), None)
+        pending = Status({'machines': {'0': {
+            'juju-status': {'current': 'pending'}}}})
+        statuses = {'foo': [subprocess.CalledProcessError(1, 'status'),
+                            pending, Status(STATUS)],
+                    'bar': [Status({})]}
+
+        def get_status(model, refresh):
+            result = statuses[model].pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        with patch.object(jc, 'get_status', autospec=True,
+                          side_effect=get_status):
+            with patch('buildcloud.juju.sleep', autospec=True) as s_mock:
+                not_ready = jc.wait_for(
+                    ['foo', 'bar'], predicate=lambda s: s is not pending,
+                    interval=2, max_interval=3)
+        self.assertEqual(not_ready, [])
+        self.assertEqual(s_mock.call_args_list, [call(2), call(3)])
+
+    def test_wait_for_timeout(self):
+        jc = JujuClient('/foo/bar', FakeHost(), None)
+        with patch.object(jc, 'get_status', autospec=True,
+                          return_value=Status({})):
+            with patch('buildcloud.juju.sleep', autospec=True):
+                not_ready = jc.wait_for(
+                    ['foo', 'bar'], predicate=lambda s: False, timeout=0)
+        self.assertEqual(not_ready, ['foo', 'bar'])
+        self.assertIn('foo was not ready after 0 seconds.',
+                      self.log_stream.getvalue())
+
+
+class TestLogs(TestCase):
+
+    def test_make_log_command(self):
+        self.assertEqual(
+            make_log_command(),
+            'sudo rm -f /tmp/cwr-logs.tar.gz ; '
+            'sudo tar -czf /tmp/cwr-logs.tar.gz --ignore-failed-read '
+            '/var/log/cloud-init*.log /var/log/juju/*.log /var/log/syslog && '
+            'sudo chmod go+r /tmp/cwr-logs.tar.gz')
+
+    def test_make_log_command_since(self):
+        self.assertEqual(
+            make_log_command(since=1500000000.5),
+            'sudo rm -f /tmp/cwr-logs.tar.gz ; '
+            'sudo tar -czf /tmp/cwr-logs.tar.gz --ignore-failed-read '
+            '$(sudo find /var/log/cloud-init*.log /var/log/juju/*.log '
+            '/var/log/syslog -maxdepth 0 -type f -newermt @1500000000 '
+            '2>/dev/null) && sudo chmod go+r /tmp/cwr-logs.tar.gz')
+
+    def test_make_log_command_file_cap(self):
+        self.assertEqual(
+            make_log_command(file_cap=1024),
+            'sudo rm -rf /tmp/cwr-logs /tmp/cwr-logs.tar.gz ; '
+            'sudo mkdir -p /tmp/cwr-logs ; '
+            'for f in /var/log/cloud-init*.log /var/log/juju/*.log '
+            '/var/log/syslog ; do [ -f $f ] && sudo tail -c 1024 $f | '
+            'sudo tee /tmp/cwr-logs/${f##*/} > /dev/null ; done ; '
+            'sudo tar -czf /tmp/cwr-logs.tar.gz -C /tmp/cwr-logs . && '
+            'sudo chmod go+r /tmp/cwr-logs.tar.gz')
+
+    def test_unpack_logs(self):
+        with temp_dir() as tmp:
+            archive = os.path.join(tmp, 'logs.tar.gz')
+            FakeRemoteLogs(['syslog', 'juju/unit-0.log'])(
+                'scp', [archive])
+            log_dir = os.path.join(tmp, 'logs')
+            os.mkdir(log_dir)
+            budget = [14]
+
+            def reserve(size):
+                allowed = min(size, budget[0])
+                budget[0] -= allowed
+                return allowed
+
+            unpack_logs(archive, log_dir, 'm', compress=True,
+                        reserve=reserve)
+            self.assertEqual(os.listdir(log_dir), ['m--syslog.gz'])
+            with gzip.open(os.path.join(log_dir, 'm--syslog.gz')) as f:
+                self.assertEqual(f.read(), 'syslog content')
+            unpack_logs(archive, log_dir, 'n', reserve=lambda size: 7)
+            with open(os.path.join(log_dir, 'n--unit-0.log')) as f:
+                self.assertEqual(f.read(), 'content')
+
+
+class TestStatus(TestCase):
+
+    def test_from_text(self):
+        self.assertEqual(Status.from_text('').data, {})
+        self.assertEqual(Status.from_text(json.dumps(STATUS)).data, STATUS)
+
+    def test_machine_states(self):
+        self.assertEqual(Status(STATUS).machine_states(), {'0': 'started'})
+        self.assertEqual(Status({}).machine_states(), {})
+
+    def test_units(self):
+        units = Status(STATUS).units
+        self.assertEqual(sorted(units), ['mysql/0', 'nrpe/0'])
+
+    def test_agent_states(self):
+        self.assertEqual(Status(STATUS).agent_states(),
+                         {'mysql/0': 'idle', 'nrpe/0': 'executing'})
+
+    def test_is_ready(self):
+        self.assertTrue(is_ready(Status({})))
+        self.assertFalse(is_ready(Status(STATUS)))
+        status = Status(deepcopy(STATUS))
+        status.units['nrpe/0']['juju-status']['current'] = 'idle'
+        self.assertTrue(is_ready(status))
+        status.units['nrpe/0']['workload-status']['current'] = 'error'
+        self.assertFalse(is_ready(status))
+
+    def test_workload_states(self):
+        self.assertEqual(Status(STATUS).workload_states(),
+                         {'mysql/0': 'active', 'nrpe/0': 'maintenance'})
+
+
+STATUS = {
+    'machines': {'0': {'juju-status': {'current': 'started'}}},
+    'applications': {
+        'mysql': {'units': {'mysql/0': {
+            'juju-status': {'current': 'idle'},
+            'workload-status': {'current': 'active'},
+            'subordinates': {'nrpe/0': {
+                'juju-status': {'current': 'executing'},
+                'workload-status': {'current': 'maintenance'}}}}}},
+        'nrpe': {'subordinate-to': ['mysql']},
+    },
+}
+
 
 class FakeHost:
 
     def __init__(self):
         self.controllers = ['gce', 'azure']
         self.tmp_juju_home = '/foo/home'
+
+
+class FakeRemoteLogs:
+    """Fake JujuClient.run that serves a log archive on scp."""
+
+    def __init__(self, names):
+        self.names = names
+
+    def __call__(self, command, args=(), model=''):
+        if command != 'scp':
+            return ''
+        dst_path = args[-1]
+        with temp_dir() as tmp:
+            with tarfile.open(dst_path, 'w:gz') as tar:
+                for name in self.names:
+                    path = os.path.join(tmp, os.path.basename(name))
+                    with open(path, 'w') as f:
+                        f.write('{} content'.format(os.path.basename(name)))
+                    tar.add(path, arcname=os.path.join('var/log', name))
+        return ''
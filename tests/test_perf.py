@@ -0,0 +1,40 @@
+from benchmarks.perf import (
+    compare,
+    get_controllers,
+    run_suite,
+)
+from tests import TestCase
+
+
+class TestPerf(TestCase):
+
+    def test_get_controllers(self):
+        self.assertEqual(get_controllers(5),
+                         ['aws-0', 'gce-1', 'azure-2', 'joyent-3', 'aws-4'])
+
+    def test_compare(self):
+        baseline = [{'controllers': 1, 'wall_time': 10, 'subprocesses': 10,
+                     'peak_rss_kb': 0, 'bytes_copied': 100}]
+        results = [{'controllers': 1, 'wall_time': 11, 'subprocesses': 13,
+                    'peak_rss_kb': 10, 'bytes_copied': 100},
+                   {'controllers': 2, 'wall_time': 50, 'subprocesses': 50,
+                    'peak_rss_kb': 50, 'bytes_copied': 500}]
+        self.assertEqual(compare(results, baseline), [
+            '1 controllers: subprocesses 10 -> 13 (+30.0%)'])
+        self.assertEqual(compare(results, baseline, threshold=0.05), [
+            '1 controllers: wall_time 10 -> 11 (+10.0%)',
+            '1 controllers: subprocesses 10 -> 13 (+30.0%)'])
+
+    def test_run_suite(self):
+        config = {'bootstrap_delay': 0, 'kill_delay': 0, 'test_delay': 0,
+                  'machines': 2, 'applications': 1, 'log_size': 100}
+        results = run_suite(config, 1, extra_args=['--no-container'])
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertEqual(result['errors'], [])
+        self.assertEqual(result['controllers'], 1)
+        # --version twice, bootstrap, status, ssh and scp for two machines
+        # and the controller machine, cwr and kill-controller.
+        self.assertEqual(result['subprocesses'], 12)
+        self.assertGreater(result['bytes_copied'], 900)
+        self.assertGreater(result['peak_rss_kb'], 0)
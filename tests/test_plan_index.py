@@ -0,0 +1,113 @@
+import json
+import os
+
+from mock import patch
+
+from buildcloud.plan_index import (
+    get_test_labels,
+    InvalidPlan,
+    load_plan,
+    Plan,
+    PlanIndex,
+    select_plans,
+    validate_plan,
+)
+from buildcloud.utility import temp_dir
+from tests import TestCase
+
+
+def write_plan(path, content='bundle: cs:foo\nbundle_name: foo\n'):
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+class TestPlanIndex(TestCase):
+
+    def test_validate_plan(self):
+        validate_plan('p', {'bundle': 'cs:foo', 'bundle_name': 'foo',
+                            'test_label': ['cwr-aws'],
+                            'benchmark': {'foo': 'bar'}})
+        with self.assertRaisesRegexp(InvalidPlan, 'p: not a mapping'):
+            validate_plan('p', ['bundle'])
+        with self.assertRaisesRegexp(InvalidPlan, 'p: missing bundle_name'):
+            validate_plan('p', {'bundle': 'cs:foo'})
+        with self.assertRaisesRegexp(InvalidPlan, 'p: invalid benchmark'):
+            validate_plan('p', {'bundle': 'cs:foo', 'bundle_name': 'foo',
+                                'benchmark': 'terasort'})
+
+    def test_load_plan(self):
+        with temp_dir() as plans:
+            path = write_plan(os.path.join(plans, 'foo.yaml'))
+            self.assertEqual(load_plan(path),
+                             {'bundle': 'cs:foo', 'bundle_name': 'foo'})
+            write_plan(path, '!!python/object:os.system {}\n')
+            with self.assertRaises(Exception):
+                load_plan(path)
+
+    def test_load(self):
+        with temp_dir() as plans:
+            index_file = os.path.join(plans, 'cache', 'index.json')
+            foo = write_plan(os.path.join(plans, 'foo.yaml'))
+            bar = write_plan(os.path.join(plans, 'bar.yml'),
+                             'bundle: cs:bar\nbundle_name: bar\n')
+            write_plan(os.path.join(plans, 'README'), 'not a plan')
+            index = PlanIndex(plans, index_file)
+            with patch('buildcloud.plan_index.load_plan',
+                       wraps=load_plan) as lp_mock:
+                loaded = index.load()
+                self.assertEqual(PlanIndex(plans, index_file).load(), loaded)
+                write_plan(foo, 'bundle: cs:foo\nbundle_name: foo2\n')
+                reloaded = index.load()
+            with open(index_file) as f:
+                self.assertEqual(sorted(json.load(f)['plans']), [bar, foo])
+        self.assertEqual(loaded, [
+            Plan(bar, {'bundle': 'cs:bar', 'bundle_name': 'bar'}),
+            Plan(foo, {'bundle': 'cs:foo', 'bundle_name': 'foo'})])
+        self.assertEqual(reloaded[1].data['bundle_name'], 'foo2')
+        self.assertEqual([c[0][0] for c in lp_mock.call_args_list],
+                         [bar, foo, foo])
+
+    def test_load_names(self):
+        with temp_dir() as plans:
+            foo = write_plan(os.path.join(plans, 'foo.yaml'))
+            bar = write_plan(os.path.join(plans, 'bar.yaml'))
+            index = PlanIndex(plans)
+            self.assertEqual([p.path for p in index.load(['foo', 'bar.yaml'])],
+                             [foo, bar])
+            with self.assertRaisesRegexp(ValueError,
+                                         'Unknown test plans: baz'):
+                index.load(['baz'])
+
+    def test_load_relative_dir(self):
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        with temp_dir() as parent:
+            os.chdir(parent)
+            os.mkdir('plans')
+            write_plan(os.path.join('plans', 'foo.yaml'))
+            index_file = os.path.join(parent, 'index.json')
+            plans = PlanIndex('plans', index_file).load()
+            with open(index_file) as f:
+                keys = list(json.load(f)['plans'])
+            os.chdir(cwd)
+        self.assertEqual([p.path for p in plans], ['plans/foo.yaml'])
+        self.assertEqual(keys, [os.path.join(parent, 'plans', 'foo.yaml')])
+
+    def test_load_invalid(self):
+        with temp_dir() as plans:
+            write_plan(os.path.join(plans, 'foo.yaml'), 'bundle: cs:foo\n')
+            with self.assertRaisesRegexp(InvalidPlan, 'missing bundle_name'):
+                PlanIndex(plans).load()
+
+    def test_select_plans(self):
+        aws = Plan('aws', {'test_label': 'cwr-aws'})
+        both = Plan('both', {'test_label': ['cwr-aws', 'cwr-gce'],
+                             'benchmark': {'foo': 'bar'}})
+        none = Plan('none', {})
+        plans = [aws, both, none]
+        self.assertEqual(select_plans(plans), plans)
+        self.assertEqual(select_plans(plans, label='cwr-aws'), [aws, both])
+        self.assertEqual(select_plans(plans, benchmark=True), [both])
+        self.assertEqual(get_test_labels(aws), ['cwr-aws'])
+        self.assertEqual(get_test_labels(none), [])
@@ -0,0 +1,112 @@
+import os
+
+from mock import patch
+import yaml
+
+from buildcloud.pool import (
+    ControllerPool,
+    export_controller,
+    import_controller,
+)
+from buildcloud.utility import temp_dir
+from tests import TestCase
+
+
+KEY = {'cloud': 'aws/sa-east-1', 'constraints': 'mem=3G',
+       'bootstrap_constraints': None, 'config': 'test-mode=true'}
+
+
+class TestControllerPool(TestCase):
+
+    def test_lease_empty(self):
+        with temp_dir() as d:
+            pool = ControllerPool(os.path.join(d, 'pool.yaml'))
+            self.assertIsNone(pool.lease(KEY))
+
+    def test_release_and_lease(self):
+        with temp_dir() as d:
+            pool = ControllerPool(os.path.join(d, 'pool.yaml'))
+            self.assertTrue(pool.release('cwr-aws', KEY, {'a': 'b'}))
+            other_key = dict(KEY, constraints='mem=8G')
+            self.assertIsNone(pool.lease(other_key))
+            entry = pool.lease(KEY)
+            self.assertEqual(entry['controller'], 'cwr-aws')
+            self.assertEqual(entry['data'], {'a': 'b'})
+            self.assertEqual(entry['key'], KEY)
+            self.assertIsNone(pool.lease(KEY))
+
+    def test_lease_newest(self):
+        with temp_dir() as d:
+            pool = ControllerPool(os.path.join(d, 'pool.yaml'), max_size=3)
+            with patch('buildcloud.pool.time', return_value=100):
+                pool.release('cwr-aws-1', KEY, {})
+            with patch('buildcloud.pool.time', return_value=200):
+                pool.release('cwr-aws-2', KEY, {})
+            with patch('buildcloud.pool.time', return_value=300):
+                entry = pool.lease(KEY)
+        self.assertEqual(entry['controller'], 'cwr-aws-2')
+
+    def test_release_full(self):
+        with temp_dir() as d:
+            pool = ControllerPool(os.path.join(d, 'pool.yaml'), max_size=1)
+            self.assertTrue(pool.release('cwr-aws-1', KEY, {}))
+            self.assertFalse(pool.release('cwr-aws-2', KEY, {}))
+            self.assertTrue(pool.release(
+                'cwr-gce', dict(KEY, cloud='google/europe-west1'), {}))
+
+    def test_release_duplicate_name(self):
+        with temp_dir() as d:
+            pool = ControllerPool(os.path.join(d, 'pool.yaml'), max_size=3)
+            self.assertTrue(pool.release('cwr-aws', KEY, {}))
+            self.assertFalse(pool.release('cwr-aws', KEY, {}))
+
+    def test_evict_expired(self):
+        with temp_dir() as d:
+            pool = ControllerPool(os.path.join(d, 'pool.yaml'), ttl=60,
+                                  max_size=3)
+            with patch('buildcloud.pool.time', return_value=100):
+                pool.release('cwr-aws-1', KEY, {})
+            with patch('buildcloud.pool.time', return_value=150):
+                pool.release('cwr-aws-2', KEY, {})
+            with patch('buildcloud.pool.time', return_value=170):
+                self.assertIsNone(pool.lease(dict(KEY, config=None)))
+                expired = pool.evict_expired()
+                entry = pool.lease(KEY)
+                self.assertIsNone(pool.lease(KEY))
+        self.assertEqual([e['controller'] for e in expired], ['cwr-aws-1'])
+        self.assertEqual(entry['controller'], 'cwr-aws-2')
+
+    def test_registry_is_private(self):
+        with temp_dir() as d:
+            path = os.path.join(d, 'pool.yaml')
+            ControllerPool(path).release('cwr-aws', KEY, {})
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+
+class TestControllerData(TestCase):
+
+    def test_export_import_controller(self):
+        with temp_dir() as src:
+            with open(os.path.join(src, 'controllers.yaml'), 'w') as f:
+                yaml.safe_dump({'controllers': {
+                    'cwr-aws': {'uuid': '1'}, 'cwr-gce': {'uuid': '2'}},
+                    'current-controller': 'cwr-gce'}, f)
+            with open(os.path.join(src, 'accounts.yaml'), 'w') as f:
+                yaml.safe_dump({'controllers': {
+                    'cwr-aws': {'user': 'admin', 'password': 'pw'}}}, f)
+            data = export_controller(src, 'cwr-aws')
+        self.assertEqual(data, {
+            'controllers.yaml': {'uuid': '1'},
+            'accounts.yaml': {'user': 'admin', 'password': 'pw'}})
+        with temp_dir() as dst:
+            with open(os.path.join(dst, 'controllers.yaml'), 'w') as f:
+                yaml.safe_dump({'controllers': {'cwr-gce': {'uuid': '2'}}}, f)
+            import_controller(dst, 'cwr-aws', data)
+            with open(os.path.join(dst, 'controllers.yaml')) as f:
+                controllers = yaml.safe_load(f)
+            with open(os.path.join(dst, 'accounts.yaml')) as f:
+                accounts = yaml.safe_load(f)
+        self.assertEqual(controllers, {'controllers': {
+            'cwr-aws': {'uuid': '1'}, 'cwr-gce': {'uuid': '2'}}})
+        self.assertEqual(accounts, {'controllers': {
+            'cwr-aws': {'user': 'admin', 'password': 'pw'}}})
@@ -0,0 +1,57 @@
+import os
+
+from mock import patch
+
+from buildcloud.regions import RegionStats
+from buildcloud.utility import temp_dir
+from tests import TestCase
+
+
+class TestRegions(TestCase):
+
+    def test_record(self):
+        with temp_dir() as tmp:
+            stats = RegionStats(os.path.join(tmp, 'cache', 'regions.json'))
+            self.assertEqual(stats.load(), {})
+            stats.record_bootstrap('aws/a', 100)
+            stats.record_bootstrap('aws/a', 200)
+            with patch('buildcloud.regions.time', return_value=50):
+                stats.record_capacity_failure('aws/b')
+            loaded = stats.load()
+        self.assertEqual(loaded, {
+            'aws/a': {'bootstrap_time': 130, 'bootstraps': 2},
+            'aws/b': {'capacity_failure': 50}})
+
+    def test_rank(self):
+        with temp_dir() as tmp:
+            stats = RegionStats(os.path.join(tmp, 'regions.json'),
+                                cooldown=100)
+            stats.record_bootstrap('aws/slow', 300)
+            stats.record_bootstrap('aws/fast', 100)
+            with patch('buildcloud.regions.time', return_value=1000):
+                stats.record_capacity_failure('aws/full')
+                clouds = ['aws/slow', 'aws/full', 'aws/fast', 'aws/new']
+                self.assertEqual(stats.rank(clouds), [
+                    'aws/fast', 'aws/slow', 'aws/new', 'aws/full'])
+                self.assertEqual(stats.rank(clouds, {'aws/fast': 1}), [
+                    'aws/slow', 'aws/new', 'aws/fast', 'aws/full'])
+            with patch('buildcloud.regions.time', return_value=1200):
+                self.assertEqual(stats.rank(clouds), [
+                    'aws/fast', 'aws/slow', 'aws/full', 'aws/new'])
+
+    def test_rank_without_history(self):
+        with temp_dir() as tmp:
+            stats = RegionStats(os.path.join(tmp, 'regions.json'))
+            clouds = ['aws/sa-east-1', 'aws/us-east-1', 'aws/us-west-2']
+            self.assertEqual(stats.rank(clouds), clouds)
+            # A recorded bootstrap does not move the run to a new region.
+            stats.record_bootstrap('aws/sa-east-1', 600)
+            self.assertEqual(stats.rank(clouds), clouds)
+            stats.record_bootstrap('aws/us-west-2', 300)
+            self.assertEqual(stats.rank(clouds), [
+                'aws/us-west-2', 'aws/sa-east-1', 'aws/us-east-1'])
+        # The preferred region gets a bootstrap even without history.
+        with temp_dir() as tmp:
+            stats = RegionStats(os.path.join(tmp, 'regions.json'))
+            stats.record_bootstrap('aws/us-west-2', 300)
+            self.assertEqual(stats.rank(clouds)[0], 'aws/sa-east-1')
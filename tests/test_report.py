@@ -0,0 +1,73 @@
+import json
+import os
+
+from mock import patch
+
+from buildcloud.report import (
+    get_report,
+    phase,
+    reset_report,
+    RunReport,
+)
+from buildcloud.utility import (
+    run_command,
+    temp_dir,
+)
+from tests import TestCase
+
+
+class TestRunReport(TestCase):
+
+    def setUp(self):
+        super(TestRunReport, self).setUp()
+        self.addCleanup(reset_report)
+
+    def test_phase(self):
+        report = RunReport()
+        with patch('buildcloud.report.time', side_effect=[10, 15]):
+            with report.phase('bootstrap', cloud='aws') as record:
+                record['extra'] = 1
+        self.assertEqual(report.phases, [{
+            'name': 'bootstrap', 'cloud': 'aws', 'extra': 1,
+            'started': 10, 'duration': 5, 'status': 'ok'}])
+
+    def test_phase_error(self):
+        report = RunReport()
+        with self.assertRaises(ValueError):
+            with report.phase('bootstrap'):
+                raise ValueError()
+        self.assertEqual(report.phases[0]['status'], 'error')
+
+    def test_phase_uses_current_report(self):
+        report = reset_report()
+        self.assertIs(get_report(), report)
+        with phase('destroy'):
+            pass
+        self.assertEqual([p['name'] for p in report.phases], ['destroy'])
+
+    def test_run_command_is_recorded(self):
+        report = reset_report()
+        run_command(['sh', '-c', 'echo out; echo error >&2'])
+        self.assertEqual(len(report.commands), 1)
+        command = report.commands[0]
+        self.assertEqual(command['command'], 'sh -c echo out; echo error >&2')
+        self.assertEqual(command['returncode'], 0)
+        self.assertEqual(command['output_size'], 4)
+        self.assertEqual(command['error_size'], 6)
+        self.assertGreaterEqual(command['duration'], 0)
+
+    def test_write(self):
+        report = RunReport()
+        report.info['test_id'] = '1'
+        with report.phase('bootstrap'):
+            pass
+        report.record_command('juju --version', report.started, 0, 6, 0)
+        with temp_dir() as d:
+            path = report.write(d)
+            self.assertEqual(path, os.path.join(d, 'run-report.json'))
+            with open(path) as f:
+                data = json.load(f)
+        self.assertEqual(data['info'], {'test_id': '1'})
+        self.assertEqual([p['name'] for p in data['phases']], ['bootstrap'])
+        self.assertEqual(data['commands'][0]['command'], 'juju --version')
+        self.assertIn('duration', data)
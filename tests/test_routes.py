@@ -0,0 +1,97 @@
+import os
+
+from mock import patch
+
+from buildcloud.routes import (
+    get_clouds,
+    get_route,
+    get_routing_table,
+    InvalidRoutes,
+    load_routing_table,
+    make_route,
+    Route,
+    ROUTES_FILE,
+    RoutingTable,
+)
+from buildcloud.utility import temp_dir
+from tests import TestCase
+
+
+class TestRoutes(TestCase):
+
+    def test_default_routes(self):
+        self.assertEqual(get_route('cwr-aws').cloud, 'aws/sa-east-1')
+        self.assertEqual(get_route('cwr-aws-china').cloud, 'aws-china')
+        self.assertEqual(get_route('china-aws').job, 'cwr-aws')
+        self.assertEqual(get_route('cwr-GCE').job, 'cwr-gce')
+        self.assertEqual(get_route('cwr-maas-ob').job, 'cwr-maas-ob')
+        self.assertEqual(get_route('prodstack').cloud, 'prodstack45')
+        self.assertIsNone(get_route('prodstack').job)
+        self.assertIsNone(get_route('lxd'))
+
+    def test_first_route_wins(self):
+        table = RoutingTable([
+            Route('aws', 'aws', None, None, None, None),
+            Route('gce|google', 'google', None, None, None, None)])
+        self.assertEqual(table.get_route('gce-aws').cloud, 'aws')
+        self.assertEqual(table.get_route('google').cloud, 'google')
+        self.assertIsNone(RoutingTable([]).get_route('aws'))
+
+    def test_get_route_memoized(self):
+        table = RoutingTable([Route('aws', 'aws', None, None, None, None)])
+        route = table.get_route('AWS')
+        with patch.object(table, '_regex') as regex_mock:
+            regex_mock.match.return_value = None
+            self.assertIs(table.get_route('aws'), route)
+            self.assertIsNone(table.get_route('azure'))
+            self.assertIsNone(table.get_route('Azure'))
+        regex_mock.match.assert_called_once_with('azure')
+
+    def test_make_route(self):
+        self.assertEqual(
+            make_route(0, {'pattern': 'aws', 'cloud': 'aws',
+                           'constraints': 'mem=4G', 'max_concurrency': 2}),
+            Route('aws', 'aws', None, 'mem=4G', 2, None))
+        with self.assertRaisesRegexp(InvalidRoutes, 'route 1: missing cloud'):
+            make_route(1, {'pattern': 'aws'})
+        with self.assertRaisesRegexp(InvalidRoutes,
+                                     'route 2: invalid max_concurrency'):
+            make_route(2, {'pattern': 'aws', 'cloud': 'aws',
+                           'max_concurrency': 'two'})
+        with self.assertRaisesRegexp(InvalidRoutes,
+                                     'route 3: invalid pattern'):
+            make_route(3, {'pattern': 'aws(', 'cloud': 'aws'})
+        with self.assertRaisesRegexp(InvalidRoutes, 'named groups'):
+            make_route(4, {'pattern': '(?P<x>aws)', 'cloud': 'aws'})
+
+    def test_get_clouds(self):
+        self.assertEqual(
+            get_clouds(Route('aws', 'aws/sa-east-1', None, None, None,
+                             ['us-east-1', 'eu-west-1'])),
+            ['aws/us-east-1', 'aws/eu-west-1'])
+        self.assertEqual(
+            get_clouds(Route('joyent', 'joyent/us-sw-1', None, None, None,
+                             None)),
+            ['joyent/us-sw-1'])
+        self.assertEqual(get_clouds(get_route('cwr-gce'))[0],
+                         'google/europe-west1')
+
+    def test_load_routing_table(self):
+        with temp_dir() as tmp:
+            path = os.path.join(tmp, 'routes.yaml')
+            with open(path, 'w') as f:
+                f.write('routes:\n'
+                        '- {pattern: lxd, cloud: localhost, job: cwr-lxd,\n'
+                        '   max_concurrency: 3}\n')
+            try:
+                table = load_routing_table(path)
+                self.assertIs(get_routing_table(), table)
+                self.assertEqual(get_route('cwr-lxd').job, 'cwr-lxd')
+                self.assertIsNone(get_route('cwr-aws'))
+            finally:
+                load_routing_table(ROUTES_FILE)
+            self.assertEqual(table.get_max_concurrency(), {'localhost': 3})
+            with open(path, 'w') as f:
+                f.write('{}\n')
+            with self.assertRaisesRegexp(InvalidRoutes, 'missing routes'):
+                RoutingTable.from_file(path)
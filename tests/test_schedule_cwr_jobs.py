@@ -1,7 +1,19 @@
 from argparse import Namespace
+from BaseHTTPServer import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
 from contextlib import contextmanager
 import os
+from StringIO import StringIO
+import subprocess
+import sys
+from threading import (
+    Lock,
+    Thread,
+)
 from unittest import TestCase
+from urllib2 import HTTPError
 
 from mock import (
     patch,
@@ -9,12 +21,19 @@ from mock import (
 )
 import yaml
 
+from buildcloud.plan_index import get_default_index_file
+import buildcloud.schedule_cwr_jobs
 from buildcloud.schedule_cwr_jobs import (
+    build_job,
     build_jobs,
     Credentials,
     get_credentials,
     get_job_name,
     get_test_plans,
+    is_transient,
+    Job,
+    JenkinsPool,
+    make_jobs,
     make_parameters,
     parse_args
 )
@@ -33,9 +52,24 @@ class TestSchedule(TestCase):
                 test_plan_dir='test_dir',
                 test_plans=None,
                 user='foo',
+                jenkins_url='http://juju-ci.vapour.ws:8080',
+                label=None,
+                benchmark=False,
+                plan_index=get_default_index_file(),
+                concurrency=4,
+                retries=3,
+                routes=None,
             )
             self.assertEqual(args, expected)
 
+    def test_run_as_script(self):
+        script = os.path.splitext(os.path.abspath(
+            buildcloud.schedule_cwr_jobs.__file__))[0]
+        with temp_dir() as tmp:
+            output = subprocess.check_output(
+                [sys.executable, script + '.py', '--help'], cwd=tmp)
+        self.assertIn('usage: schedule_cwr_jobs.py', output)
+
     def test_make_parameters(self):
         with temp_dir() as test_dir:
             test_plan = self.fake_parameters(
@@ -55,19 +89,56 @@ class TestSchedule(TestCase):
 
     def test_get_test_plans(self):
         args = Namespace(controllers=['default-aws'], password='bar',
-                         test_plan_dir='', test_plans=None, user='foo')
+                         test_plan_dir='', test_plans=None, user='foo',
+                         label=None, benchmark=False, plan_index=None)
         with temp_dir() as test_dir:
             args.test_plan_dir = test_dir
             self.fake_parameters(test_dir)
             self.fake_parameters(test_dir, 2)
             self.fake_parameters(test_dir, 3, ext='.py')
-            parameters = list(get_test_plans(args))
+            parameters = [p.path for p in get_test_plans(args)]
         expected = [
             os.path.join(test_dir, 'test1.yaml'),
             os.path.join(test_dir, 'test2.yaml'),
         ]
         self.assertItemsEqual(parameters, expected)
 
+    def test_get_test_plans_relative_dir(self):
+        args = Namespace(test_plan_dir='test_plans', test_plans=None,
+                         label=None, benchmark=False, plan_index=None)
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        with temp_dir() as parent:
+            os.chdir(parent)
+            os.mkdir('test_plans')
+            self.fake_parameters('test_plans')
+            with patch('buildcloud.schedule_cwr_jobs.generate_test_id',
+                       return_value='1'):
+                jobs = make_jobs(get_test_plans(args), ['default-aws'])
+            os.chdir(cwd)
+        # Jenkins resolves the plan in the job workspace, not here.
+        self.assertEqual(jobs[0].parameters['test_plan'],
+                         'test_plans/test1.yaml')
+
+    def test_get_test_plans_filters(self):
+        args = Namespace(test_plan_dir='', test_plans=None, label='cwr-gce',
+                         benchmark=False, plan_index=None)
+        with temp_dir() as test_dir:
+            args.test_plan_dir = test_dir
+            self.fake_parameters(test_dir, test_label='cwr-aws')
+            self.fake_parameters(test_dir, 2, test_label=['cwr-gce'])
+            self.fake_parameters(test_dir, 3, benchmark={'foo': 'bar'})
+            self.assertEqual(
+                [os.path.basename(p.path) for p in get_test_plans(args)],
+                ['test2.yaml'])
+            args.label = None
+            args.benchmark = True
+            self.assertEqual(
+                [os.path.basename(p.path) for p in get_test_plans(args)],
+                ['test3.yaml'])
+            args.test_plans = ['test1.yaml', 'test2.yaml']
+            self.assertEqual(get_test_plans(args), [])
+
     def test_get_credentials(self):
         args = Namespace(controllers=['default-aws'], password='bar',
                          test_plan_dir='', test_plans=None, user='foo')
@@ -76,7 +147,8 @@ class TestSchedule(TestCase):
         self.assertEqual(cred.password, 'bar')
 
     def fake_parameters(self, test_dir, count=1, ext='.yaml', test_label=None,
-                        bucket=None, results_dir=None, s3_private=None):
+                        bucket=None, results_dir=None, s3_private=None,
+                        benchmark=None):
         test_plan = os.path.join(test_dir, 'test' + str(count) + ext)
         plan = {
             'bundle': 'make life easy',
@@ -91,6 +163,8 @@ class TestSchedule(TestCase):
 
         if test_label:
             plan['test_label'] = test_label
+        if benchmark:
+            plan['benchmark'] = benchmark
         with open(test_plan, 'w') as f:
             yaml.dump(plan, f)
         return test_plan
@@ -99,7 +173,8 @@ class TestSchedule(TestCase):
         credentials = Credentials('joe', 'pass')
         args = Namespace(cwr_test_token='fake',
                          controllers=['default-aws', 'default-gce'],
-                         test_plan_dir='')
+                         test_plan_dir='', concurrency=1, retries=0,
+                         jenkins_url='http://juju-ci.vapour.ws:8080')
         with patch('buildcloud.schedule_cwr_jobs.Jenkins',
                    autospec=True) as jenkins_mock:
             with patch('buildcloud.schedule_cwr_jobs.generate_test_id',
@@ -113,7 +188,8 @@ class TestSchedule(TestCase):
                         test_dir, 2, bucket='foo', results_dir='bar',
                         s3_private=True)
                     test_plans = [test_plan1, test_plan2]
-                    build_jobs(credentials, test_plans, args)
+                    with patch('sys.stdout', new_callable=StringIO):
+                        build_jobs(credentials, test_plans, args)
         jenkins_mock.assert_called_once_with(
             'http://juju-ci.vapour.ws:8080', 'joe', 'pass')
         self.assertEqual(gti_mock.mock_calls, [call(), call()])
@@ -163,7 +239,8 @@ class TestSchedule(TestCase):
         credentials = Credentials('joe', 'pass')
         args = Namespace(cwr_test_token='fake',
                          controllers=['default-aws', 'default-gce'],
-                         test_plan_dir='')
+                         test_plan_dir='', concurrency=1, retries=0,
+                         jenkins_url='http://juju-ci.vapour.ws:8080')
         with patch('buildcloud.schedule_cwr_jobs.Jenkins',
                    autospec=True) as jenkins_mock:
             with patch('buildcloud.schedule_cwr_jobs.generate_test_id',
@@ -175,7 +252,8 @@ class TestSchedule(TestCase):
                     self.fake_parameters(test_dir, test_label='cwr-aws')
                     self.fake_parameters(test_dir, 2, test_label='cwr-gce')
                     test_plans = [test_plan1, test_plan2]
-                    build_jobs(credentials, test_plans, args)
+                    with patch('sys.stdout', new_callable=StringIO):
+                        build_jobs(credentials, test_plans, args)
         jenkins_mock.assert_called_once_with(
             'http://juju-ci.vapour.ws:8080', 'joe', 'pass')
         self.assertEqual(gti_mock.mock_calls, [call(), call()])
@@ -210,6 +288,135 @@ class TestSchedule(TestCase):
         self.assertEqual(job_name, 'cwr-joyent')
         job_name = get_job_name('default-azure-')
         self.assertEqual(job_name, 'cwr-azure')
+        with self.assertRaisesRegexp(Exception, 'Unknown Jenkins job name'):
+            get_job_name('prodstack')
+        with self.assertRaisesRegexp(Exception, 'Unknown Jenkins job name'):
+            get_job_name('lxd')
+
+    def test_make_jobs_parses_plan_once(self):
+        with temp_dir() as test_dir:
+            test_plan = self.fake_parameters(test_dir)
+            with patch('buildcloud.schedule_cwr_jobs.load_test_plan',
+                       autospec=True,
+                       return_value={'bundle_name': 'foo'}) as ltp_mock:
+                with patch('buildcloud.schedule_cwr_jobs.generate_test_id',
+                           return_value='1'):
+                    jobs = make_jobs([test_plan], ['default-aws', 'gce'])
+        ltp_mock.assert_called_once_with(test_plan)
+        self.assertEqual(jobs, [
+            Job('cwr-aws', {'test_plan': test_plan, 'test_id': '1',
+                            'controllers': 'default-aws',
+                            'bundle_name': 'foo'}),
+            Job('cwr-gce', {'test_plan': test_plan, 'test_id': '1',
+                            'controllers': 'gce', 'bundle_name': 'foo'}),
+        ])
+
+    def test_is_transient(self):
+        self.assertTrue(is_transient(HTTPError('', 503, '', {}, None)))
+        self.assertTrue(is_transient(HTTPError('', 429, '', {}, None)))
+        self.assertFalse(is_transient(HTTPError('', 404, '', {}, None)))
+        self.assertTrue(is_transient(IOError('Connection reset')))
+
+    def test_build_job_retries_transient_errors(self):
+        pool = JenkinsPool('http://example.com', Credentials('joe', 'pass'))
+        job = Job('cwr-aws', {'controllers': 'aws', 'test_plan': 'foo'})
+        error = HTTPError('', 503, '', {}, None)
+        with patch('buildcloud.schedule_cwr_jobs.Jenkins',
+                   autospec=True) as jenkins_mock:
+            jenkins_mock.return_value.build_job.side_effect = [error, error,
+                                                               None]
+            with patch('buildcloud.schedule_cwr_jobs.sleep',
+                       autospec=True) as s_mock:
+                built = build_job(pool, job, 'token', retries=3, backoff=2)
+        self.assertTrue(built)
+        self.assertEqual(s_mock.mock_calls, [call(2), call(4)])
+        jenkins_mock.assert_called_once_with('http://example.com', 'joe',
+                                             'pass')
+
+    def test_build_job_gives_up(self):
+        pool = JenkinsPool('http://example.com', Credentials('joe', 'pass'))
+        job = Job('cwr-aws', {'controllers': 'aws', 'test_plan': 'foo'})
+        with patch('buildcloud.schedule_cwr_jobs.Jenkins',
+                   autospec=True) as jenkins_mock:
+            jenkins_mock.return_value.build_job.side_effect = HTTPError(
+                '', 403, '', {}, None)
+            with patch('buildcloud.schedule_cwr_jobs.sleep',
+                       autospec=True) as s_mock:
+                built = build_job(pool, job, 'token', retries=3)
+        self.assertFalse(built)
+        self.assertFalse(s_mock.called)
+        self.assertEqual(jenkins_mock.return_value.build_job.call_count, 1)
+
+    def test_build_jobs_fake_jenkins(self):
+        server = FakeJenkins(failures=2)
+        self.addCleanup(server.stop)
+        credentials = Credentials('joe', 'pass')
+        args = Namespace(cwr_test_token='fake',
+                         controllers=['default-aws', 'default-gce'],
+                         concurrency=2, retries=3, jenkins_url=server.url)
+        with temp_dir() as test_dir:
+            test_plans = [self.fake_parameters(test_dir, i)
+                          for i in range(3)]
+            with patch('buildcloud.schedule_cwr_jobs.sleep', autospec=True):
+                with patch('sys.stdout', new_callable=StringIO) as out:
+                    failed = build_jobs(credentials, test_plans, args)
+        self.assertEqual(failed, [])
+        self.assertEqual(len(server.builds), 6)
+        self.assertEqual(
+            sorted(set(path.split('?')[0] for path in server.builds)),
+            ['/job/cwr-aws/buildWithParameters',
+             '/job/cwr-gce/buildWithParameters'])
+        self.assertIn('Scheduled 6 of 6 jobs.', out.getvalue())
+
+
+class FakeJenkins:
+    """A local HTTP server that accepts Jenkins build requests.
+
+    The first failures build requests get a 503 response.
+    """
+
+    def __init__(self, failures=0):
+        self.builds = []
+        self.failures = failures
+        self.lock = Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.respond(404)
+
+            def do_POST(self):
+                with fake.lock:
+                    if fake.failures:
+                        fake.failures -= 1
+                        return self.respond(503)
+                    fake.builds.append(self.path)
+                    number = len(fake.builds)
+                self.respond(201, {'Location': '{}/queue/item/{}/'.format(
+                    fake.url, number)})
+
+            def respond(self, code, headers=None):
+                self.send_response(code)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
 
 
 @contextmanager
@@ -1,15 +1,26 @@
 import os
+import shutil
+from StringIO import StringIO
 import subprocess
+from threading import Event
 
 from mock import patch
 import yaml
 
 from buildcloud.utility import (
     cloud_from_env,
+    CommandCancelled,
+    CommandRunner,
+    CommandTimeout,
     copytree_force,
     generate_controller_names,
+    link_tree,
+    load_patterns,
+    merge_tree,
     rename_env,
     run_command,
+    run_command_async,
+    run_concurrently,
     temp_dir,
 )
 from tests import TestCase
@@ -42,7 +53,8 @@ class TestUtility(TestCase):
         with patch('subprocess.Popen', autospec=True,
                    return_value=proc) as p_mock:
                 run_command(cmd)
-        p_mock.assert_called_once_with(cmd, stdout=subprocess.PIPE)
+        p_mock.assert_called_once_with(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     def test_run_command_str(self):
         proc = FakeProc()
@@ -50,7 +62,8 @@ class TestUtility(TestCase):
         with patch('subprocess.Popen', autospec=True,
                    return_value=proc) as p_mock:
             run_command(cmd, verbose=True)
-        p_mock.assert_called_once_with(cmd, stdout=subprocess.PIPE)
+        p_mock.assert_called_once_with(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     def test_run_command_verbose(self):
         proc = FakeProc()
@@ -58,7 +71,162 @@ class TestUtility(TestCase):
         with patch('subprocess.Popen', autospec=True,
                    return_value=proc) as p_mock:
             run_command(cmd, verbose=True)
-        p_mock.assert_called_once_with(cmd, stdout=subprocess.PIPE)
+        p_mock.assert_called_once_with(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def test_run_command_output(self):
+        proc = FakeProc(stdout=['foo\n', 'bar\n'])
+        with patch('subprocess.Popen', autospec=True, return_value=proc):
+            output = run_command(['foo', 'bar'])
+        self.assertEqual(output, 'foo\nbar\n')
+
+    def test_run_command_no_keep_output(self):
+        proc = FakeProc(stdout=['foo\n', 'bar\n'])
+        with patch('subprocess.Popen', autospec=True, return_value=proc):
+            output = run_command(['foo', 'bar'], keep_output=False)
+        self.assertIsNone(output)
+
+    def test_run_command_spools_large_output(self):
+        lines = ['{}\n'.format('x' * 1023)] * 10
+        proc = FakeProc(stdout=lines)
+        with patch('buildcloud.utility.OUTPUT_SPOOL_SIZE', 4096):
+            with patch('subprocess.Popen', autospec=True, return_value=proc):
+                output = run_command(['foo', 'bar'])
+        self.assertEqual(output, ''.join(lines))
+
+    def test_run_command_error(self):
+        proc = FakeProc(stdout=['foo\n'], stderr=['bad\n', 'worse\n'],
+                        returncode=2)
+        with patch('subprocess.Popen', autospec=True, return_value=proc):
+            with self.assertRaises(subprocess.CalledProcessError) as ctx:
+                run_command(['foo', 'bar'])
+        self.assertEqual(ctx.exception.returncode, 2)
+        self.assertEqual(ctx.exception.stderr, 'bad\nworse\n')
+        self.assertEqual(ctx.exception.output, 'bad\nworse\n')
+
+    def test_run_command_error_passed_through(self):
+        proc = FakeProc(stderr=['bad\n', 'worse\n'], returncode=2)
+        stderr = StringIO()
+        with patch('subprocess.Popen', autospec=True, return_value=proc):
+            with patch('sys.stderr', stderr):
+                with self.assertRaises(subprocess.CalledProcessError):
+                    run_command(['foo', 'bar'])
+        self.assertEqual(stderr.getvalue(), 'bad\nworse\n')
+        self.assertIn("ERROR Command failed with exit status 2: "
+                      "['foo', 'bar']", self.log_stream.getvalue())
+
+    def test_run_command_stderr_tail(self):
+        proc = FakeProc(stderr=['{}\n'.format(i) for i in range(5)],
+                        returncode=1)
+        with patch('buildcloud.utility.STDERR_TAIL_LINES', 2):
+            with patch('subprocess.Popen', autospec=True, return_value=proc):
+                with self.assertRaises(subprocess.CalledProcessError) as ctx:
+                    run_command(['foo', 'bar'])
+        self.assertEqual(ctx.exception.stderr, '3\n4\n')
+
+    def test_run_command_real_process(self):
+        stderr = StringIO()
+        with patch('sys.stderr', stderr):
+            output = run_command(['sh', '-c', 'echo out; echo err >&2'])
+        self.assertEqual(output, 'out\n')
+        self.assertEqual(stderr.getvalue(), 'err\n')
+
+    def test_run_command_timeout(self):
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            run_command(['sleep', '10'], timeout=0.1)
+        self.assertEqual(ctx.exception.returncode, -9)
+        self.assertIn('Command timed out after 0.1 seconds',
+                      self.log_stream.getvalue())
+
+    def test_run_command_timeout_not_reached(self):
+        output = run_command(['echo', 'foo'], timeout=10)
+        self.assertEqual(output, 'foo\n')
+
+    def test_run_command_async(self):
+        future = run_command_async(['sh', '-c', 'echo out; echo err >&2'])
+        self.assertEqual(future.result(10), 'out\n')
+        self.assertTrue(future.done())
+        self.assertIsNone(future.exception())
+
+    def test_run_command_async_error(self):
+        future = run_command_async(['sh', '-c', 'echo bad >&2; exit 3'])
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            future.result(10)
+        self.assertEqual(ctx.exception.returncode, 3)
+        self.assertEqual(ctx.exception.stderr, 'bad\n')
+
+    def test_run_command_async_cancel(self):
+        future = run_command_async(['sleep', '10'])
+        self.assertTrue(future.cancel())
+        with self.assertRaises(CommandCancelled):
+            future.result(10)
+        self.assertTrue(future.cancelled())
+
+    def test_run_command_async_result_timeout(self):
+        future = run_command_async(['sleep', '10'])
+        with self.assertRaises(CommandTimeout):
+            future.result(0.1)
+        future.cancel()
+        future.wait(10)
+
+    def test_command_runner_run_all(self):
+        runner = CommandRunner(max_workers=2)
+        results = runner.run_all(
+            [['echo', str(i)] for i in range(5)], timeout=10)
+        self.assertEqual(results, ['0\n', '1\n', '2\n', '3\n', '4\n'])
+
+    def test_command_runner_run_all_error(self):
+        runner = CommandRunner(max_workers=2)
+        with self.assertRaises(subprocess.CalledProcessError):
+            runner.run_all([['true'], ['false'], ['true']])
+        results = runner.run_all([['true'], ['false']],
+                                 return_exceptions=True)
+        self.assertEqual(results[0], '')
+        self.assertIsInstance(results[1], subprocess.CalledProcessError)
+
+    def test_command_runner_concurrency(self):
+        runner = CommandRunner(max_workers=1)
+        first = runner.submit(['sleep', '10'])
+        second = runner.submit(['echo', 'foo'])
+        self.assertFalse(second.wait(0.2))
+        runner.cancel_all()
+        with self.assertRaises(CommandCancelled):
+            first.result(10)
+        with self.assertRaises(CommandCancelled):
+            second.result(10)
+
+    def test_run_concurrently(self):
+        results = run_concurrently(lambda x: x * 2, [1, 2, 3], max_workers=2)
+        self.assertEqual(results, [(1, 2, None), (2, 4, None), (3, 6, None)])
+
+    def test_run_concurrently_exception(self):
+        error = ValueError('bad')
+
+        def func(x):
+            if x == 2:
+                raise error
+            return x
+
+        results = run_concurrently(func, [1, 2, 3], max_workers=0)
+        self.assertEqual(results, [(1, 1, None), (2, None, error),
+                                   (3, 3, None)])
+
+    def test_run_concurrently_parallel(self):
+        started = Event()
+
+        def func(x):
+            if x == 1:
+                return started.wait(5)
+            started.set()
+            return True
+
+        results = run_concurrently(func, [1, 2], max_workers=2)
+        self.assertEqual(results, [(1, True, None), (2, True, None)])
+
+    def test_run_concurrently_serial(self):
+        seen = []
+        run_concurrently(seen.append, [1, 2, 3])
+        self.assertEqual(seen, [1, 2, 3])
 
     def test_copytree_force(self):
         with temp_dir() as src:
@@ -70,6 +238,126 @@ class TestUtility(TestCase):
                 copytree_force(src, dst)
                 self.assertTrue(os.path.exists(sub_dst_dir))
 
+    def test_copytree_force_keep(self):
+        with temp_dir() as src:
+            with temp_dir() as dst:
+                for name in ['journal', 'stale']:
+                    with open(os.path.join(dst, name), 'w') as f:
+                        f.write(name)
+                copytree_force(src, dst,
+                               keep=shutil.ignore_patterns('journal'))
+                self.assertEqual(os.listdir(dst), ['journal'])
+
+    def test_copytree_force_incremental(self):
+        with temp_dir() as src:
+            with temp_dir() as dst:
+                for name in ['same', 'changed', 'new']:
+                    with open(os.path.join(src, name), 'w') as f:
+                        f.write(name)
+                os.mkdir(os.path.join(src, 'static'))
+                os.mkdir(os.path.join(src, 'sub'))
+                with open(os.path.join(src, 'sub', 'file'), 'w') as f:
+                    f.write('file')
+                copytree_force(src, dst)
+                same_inode = os.stat(os.path.join(dst, 'same')).st_ino
+                with open(os.path.join(src, 'changed'), 'w') as f:
+                    f.write('changed more')
+                os.remove(os.path.join(src, 'new'))
+                os.mkdir(os.path.join(dst, 'stale'))
+                with patch('buildcloud.utility.copy2',
+                           wraps=shutil.copy2) as c_mock:
+                    copytree_force(src, dst,
+                                   ignore=shutil.ignore_patterns('static'))
+                self.assertEqual(
+                    c_mock.call_args_list,
+                    [((os.path.join(src, 'changed'),
+                       os.path.join(dst, 'changed')),)])
+                self.assertEqual(sorted(os.listdir(dst)),
+                                 ['changed', 'same', 'sub'])
+                with open(os.path.join(dst, 'changed')) as f:
+                    self.assertEqual(f.read(), 'changed more')
+                self.assertEqual(os.stat(os.path.join(dst, 'same')).st_ino,
+                                 same_inode)
+
+    def test_merge_tree(self):
+        with temp_dir() as src:
+            with temp_dir() as dst:
+                os.mkdir(os.path.join(src, 'sub'))
+                for name in ['a', os.path.join('sub', 'b')]:
+                    with open(os.path.join(src, name), 'w') as f:
+                        f.write('new')
+                with open(os.path.join(dst, 'a'), 'w') as f:
+                    f.write('old')
+                with open(os.path.join(dst, 'kept'), 'w') as f:
+                    f.write('kept')
+                merge_tree(src, dst)
+                self.assertEqual(sorted(os.listdir(dst)),
+                                 ['a', 'kept', 'sub'])
+                with open(os.path.join(dst, 'a')) as f:
+                    self.assertEqual(f.read(), 'new')
+                self.assertTrue(os.path.isfile(os.path.join(dst, 'sub', 'b')))
+
+    def test_link_tree(self):
+        with temp_dir() as root:
+            src = os.path.join(root, 'src')
+            dst = os.path.join(root, 'dst')
+            os.makedirs(os.path.join(src, 'cookies'))
+            os.makedirs(os.path.join(src, 'environments'))
+            os.makedirs(os.path.join(src, 'charms'))
+            for path in ['controllers.yaml', 'cookies/jar', 'charms/big',
+                         'environments/old', 'staging-juju-rsa']:
+                with open(os.path.join(src, path), 'w') as f:
+                    f.write(path)
+            link_tree(src, dst, mutable=['*.yaml', 'cookies'],
+                      exclude=['environments'])
+            self.assertEqual(sorted(os.listdir(dst)),
+                             ['charms', 'controllers.yaml', 'cookies',
+                              'staging-juju-rsa'])
+
+            def linked(path):
+                return (os.stat(os.path.join(src, path)).st_ino ==
+                        os.stat(os.path.join(dst, path)).st_ino)
+
+            self.assertTrue(linked('charms/big'))
+            self.assertTrue(linked('staging-juju-rsa'))
+            self.assertFalse(linked('controllers.yaml'))
+            self.assertFalse(linked('cookies/jar'))
+            with open(os.path.join(dst, 'cookies/jar')) as f:
+                self.assertEqual(f.read(), 'cookies/jar')
+
+    def test_link_tree_include(self):
+        with temp_dir() as root:
+            src = os.path.join(root, 'src')
+            dst = os.path.join(root, 'dst')
+            os.makedirs(os.path.join(src, 'charms'))
+            for path in ['credentials.yaml', 'charms/big', 'old.log']:
+                with open(os.path.join(src, path), 'w') as f:
+                    f.write(path)
+            link_tree(src, dst, include=['*.yaml', 'charms/*'])
+            self.assertEqual(sorted(os.listdir(dst)),
+                             ['charms', 'credentials.yaml'])
+            self.assertEqual(os.listdir(os.path.join(dst, 'charms')),
+                             ['big'])
+
+    def test_link_tree_copies_when_link_fails(self):
+        with temp_dir() as root:
+            src = os.path.join(root, 'src')
+            os.mkdir(src)
+            with open(os.path.join(src, 'file'), 'w') as f:
+                f.write('data')
+            with patch('os.link', autospec=True,
+                       side_effect=OSError(18, 'Invalid cross-device link')):
+                link_tree(src, os.path.join(root, 'dst'))
+            with open(os.path.join(root, 'dst', 'file')) as f:
+                self.assertEqual(f.read(), 'data')
+
+    def test_load_patterns(self):
+        with temp_dir() as d:
+            path = os.path.join(d, 'manifest')
+            with open(path, 'w') as f:
+                f.write('# cached charms\ncharms\n\n  *.log \n')
+            self.assertEqual(load_patterns(path), ['charms', '*.log'])
+
     def test_rename_env(self):
         with temp_dir() as tmp_dir:
             env = {'environments': {
@@ -99,7 +387,10 @@ class TestUtility(TestCase):
 
 class FakeProc:
 
-    returncode = 0
+    def __init__(self, stdout=(), stderr=(), returncode=0):
+        self.stdout = StringIO(''.join(stdout))
+        self.stderr = StringIO(''.join(stderr))
+        self.returncode = returncode
 
-    def poll(self):
-        return True
+    def wait(self):
+        return self.returncode